@@ -1,7 +1,6 @@
 import numpy as np
 import scipy as sp
 from . import (Simulator, MathUtils)
-from scipy.spatial import cKDTree
 from scipy import ndimage
 from matplotlib.contour import QuadContourSet
 import matplotlib.pyplot as plt
@@ -201,32 +200,17 @@ class dataGrid(object):
         if getattr(self, '_valuesFilled', None) is None:
             values = self.values.flatten(order='F')
 
-            # Do a minimum curvature extrapolation
+            # Do a minimum curvature extrapolation on the grid nodes,
+            # constrained by all the real values
             isNan = np.isnan(values)
-
-            # Get the real values on the outer edge
             indVal = np.where(~isNan)[0]
-            tree = cKDTree(self.gridCC[indVal, :])
-            dists, indexes = tree.query(self.gridCC[isNan, :])
-
-            uInd = np.unique(indVal[indexes])
-
-            xyz = self.gridCC[uInd, :]
-
-            _, values[isNan] = MathUtils.minCurvatureInterp(
-                            xyz, values[uInd],
-                            xyzOut=self.gridCC[isNan, :],
-                            overlap=np.max([self.dx, self.dy]))
 
-            # If there are still NDV, just do a nearest neighbour
+            _, grid = MathUtils.minCurvatureInterp(
+                            self.gridCC[indVal, :], values[indVal],
+                            vectorX=self.hx, vectorY=self.hy,
+                            method='relaxation')
 
-            while np.isnan(values).sum() > 0:
-                isNan = np.isnan(values)
-                # Get the real values on the outer edge
-                indVal = np.where(~isNan)[0]
-                tree = cKDTree(self.gridCC[indVal, :])
-                dists, indexes = tree.query(self.gridCC[isNan, :])
-                values[isNan] = values[indVal[indexes]]
+            values[isNan] = grid.flatten(order='F')[isNan]
 
             self._valuesFilled = values.reshape(self.values.shape, order='F')
 
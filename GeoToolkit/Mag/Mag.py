@@ -1,185 +1,2513 @@
 from . import MathUtils
 from scipy.constants import mu_0
+from multiprocessing import Pool, RawArray
+from scipy.sparse.linalg import LinearOperator
+from scipy.sparse import csr_matrix
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import json
+import os
 import re
+import time
+import math
+import warnings
 import numpy as np
 # from SimPEG import Utils, PF
 # from SimPEG.PF import BaseMag
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Implementation of the prism kernel used by calcRow: 'numpy' | 'numba'
+kernel = {'backend': 'numpy'}
+
+# Components of the gradient tensor of the fields
+gradientTypes = ['bxx', 'bxy', 'bxz', 'byy', 'byz', 'bzz']
+
+# Number of receiver-prism pairs evaluated with the prism kernel and with
+# the far-field dipole approximation, see prismBlockTensor
+kernelCounts = {'prism': 0, 'dipole': 0}
+
+# Parameters of a prism, in the order used by prismResponse and fitPrisms
+prismParameters = [
+    'x0', 'y0', 'z0', 'dx', 'dy', 'dz', 'pinc', 'pdec',
+    'susc', 'Q', 'rinc', 'rdec'
+]
+
 
 class Problem(object):
     """
-            Earth's field:
-            - Binc, Bdec : inclination and declination of Earth's mag field
-            - Bigrf : amplitude of earth's field in units of nT
+            Earth's field:
+            - Binc, Bdec : inclination and declination of Earth's mag field
+            - Bigrf : amplitude of earth's field in units of nT
+
+        Remnance:
+            - Q : Koenigsberger ratio
+            - Rinc, Rdec : inclination and declination of remnance in block
+
+        Forward:
+            - blockSize : number of receivers processed at once by the kernel
+            - n_workers : number of processes used to build G
+            - matrixFree : use a ForwardOperator instead of storing G
+            - useCache : share G with other problems through operatorCache
+            - store : SensitivityStore mapping G from disk, used instead
+                      of the operatorCache if set
+            - gradient : also compute the gradient tensor of the fields,
+                         set automatically for uType in gradientTypes
+            - precision : 'float64' | 'float32' storage of G, unused
+                          by the matrixFree operator which stores nothing
+
+        The inducing field survey.srcFieldParam = [|B|, Inc, Dec] can vary
+        across the survey, with arrays of nD values for any of the
+        parameters (see variableField).
+
+    """
+    #Bdec, Binc, Bigrf = 90., 0., 50000.
+    Q, rinc, rdec = 0., 0., 0.
+    uType, mType = 'tf', 'induced'
+    susc = 1.
+    blockSize = 1000
+    n_workers = 1
+    matrixFree = False
+    useCache = True
+    gradient = False
+    precision = 'float64'
+    store = None
+    prism = None
+    survey = None
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        return
+
+    @property
+    def variableField(self):
+        """
+            True if the inducing field is given for each receiver, in
+            which case the magnetizations Mind, Mrem are [3 x nD] arrays
+            of the magnetization seen by each receiver
+        """
+        return any(
+            np.ndim(val) > 0 for val in [self.Higrf, self.Hinc, self.Hdec]
+        )
+
+    @property
+    def Mind(self):
+        # Define magnetization direction as sum of induced and remanence
+        mind = MathUtils.dipazm_2_xyz(self.Hinc, self.Hdec)
+        if self.variableField:
+            mind = np.broadcast_to(mind, (self.survey.nD, 3))
+
+        R = MathUtils.rotationMatrix(-self.prism.pinc, -self.prism.pdec, normal=False)
+        Mind = self.susc*self.Higrf*R.dot(mind.T)
+        # Mind = self.susc*self.Higrf*PF.Magnetics.dipazm_2_xyz(self.Binc - self.prism.pinc,
+        #                                                self.Bdec - self.prism.pdec)
+        return Mind
+
+    @property
+    def Mrem(self):
+
+        mrem = MathUtils.dipazm_2_xyz(self.rinc, self.rdec)
+        if self.variableField:
+            mrem = np.broadcast_to(mrem, (self.survey.nD, 3))
+
+        R = MathUtils.rotationMatrix(-self.prism.pinc, -self.prism.pdec, normal=False)
+        Mrem = self.Q*self.susc*self.Higrf * R.dot(mrem.T)
+
+        return Mrem
+
+    @property
+    def Higrf(self):
+
+        if getattr(self, '_Higrf', None) is None:
+            self._Higrf = self.survey.srcFieldParam[0]
+
+        return self._Higrf * 1e-9 / mu_0
+
+    @property
+    def Hinc(self):
+
+        if getattr(self, '_Hinc', None) is None:
+            self._Hinc = self.survey.srcFieldParam[1]
+
+        return self._Hinc
+
+    @property
+    def Hdec(self):
+
+        if getattr(self, '_Hdec', None) is None:
+            self._Hdec = self.survey.srcFieldParam[2]
+
+        return self._Hdec
+
+    @property
+    def G(self):
+
+        gradient = self.gradient or (self.uType in gradientTypes)
+
+        # Rebuild if the gradient rows are missing
+        if (
+            getattr(self, '_G', None) is not None and gradient and
+            self._G.shape[0] < 9*self.survey.nD
+        ):
+            self._G = None
+
+        if getattr(self, '_G', None) is None:
+
+            rxLoc = self.survey.rxLoc
+
+            xLoc = rxLoc[:, 0] - self.prism.xc
+            yLoc = rxLoc[:, 1] - self.prism.yc
+            zLoc = rxLoc[:, 2] - self.prism.zc
+
+            R = MathUtils.rotationMatrix(-self.prism.pinc, -self.prism.pdec, normal=False)
+
+            rxLoc = R.dot(np.c_[xLoc, yLoc, zLoc].T).T
+
+            rxLoc = np.c_[rxLoc[:, 0] + self.prism.xc, rxLoc[:, 1] + self.prism.yc, rxLoc[:, 2] + self.prism.zc]
+
+            # Create the linear forward system
+            if self.matrixFree:
+                self._G = ForwardOperator(
+                    self.prism.xn, self.prism.yn, self.prism.zn, rxLoc,
+                    blockSize=self.blockSize, gradient=gradient
+                )
+            elif self.store is not None:
+                self._G = self.store.operator(
+                    self.prism.xn, self.prism.yn, self.prism.zn, rxLoc,
+                    blockSize=self.blockSize, n_workers=self.n_workers,
+                    gradient=gradient, precision=self.precision
+                )
+            elif self.useCache:
+                self._G = operatorCache.get(
+                    geometryKey(
+                        self.prism.xn, self.prism.yn, self.prism.zn,
+                        self.prism.pinc, self.prism.pdec, rxLoc, gradient,
+                        self.precision == 'float32'
+                    ),
+                    lambda: Intrgl_Fwr_Op(
+                        self.prism.xn, self.prism.yn, self.prism.zn, rxLoc,
+                        blockSize=self.blockSize, n_workers=self.n_workers,
+                        gradient=gradient, precision=self.precision
+                    )
+                )
+            else:
+                self._G = Intrgl_Fwr_Op(
+                    self.prism.xn, self.prism.yn, self.prism.zn, rxLoc,
+                    blockSize=self.blockSize, n_workers=self.n_workers,
+                    gradient=gradient, precision=self.precision
+                )
+
+        return self._G
+
+    def forward(self, M):
+        """
+            Product of G with magnetization vectors M [3, ...], or with
+            the magnetization seen by each receiver M [3, nD, ...] if the
+            inducing field varies across the survey. The rows of G are
+            then combined with the magnetization of their receiver in one
+            vectorized pass.
+        """
+
+        if not self.variableField:
+            return self.G.dot(M)
+
+        nD = self.survey.nD
+
+        # Fields of the unit magnetizations along each axis
+        G = np.reshape(self.G.dot(np.eye(3)), (-1, nD, 3))
+
+        b = np.einsum('kdj,jd...->kd...', G, M)
+
+        return np.reshape(b, (-1,) + M.shape[2:])
+
+    def fields(self):
+
+        if (self.mType == 'induced') or (self.mType == 'total'):
+
+            b = self.forward(self.Mind)
+            self.fieldi = self.extractFields(b)
+
+        if (self.mType == 'remanent') or (self.mType == 'total'):
+
+            b = self.forward(self.Mrem)
+
+            self.fieldr = self.extractFields(b)
+
+        if self.mType == 'induced':
+            return [self.fieldi]
+        elif self.mType == 'remanent':
+            return [self.fieldr]
+        elif self.mType == 'total':
+            return [self.fieldi, self.fieldr]
+
+    def fieldsAll(self):
+        """
+            All components of the induced, remanent and total fields,
+            from a single product with G and one rotation.
+
+            If gradient=True, the components of the gradient tensor
+            'bxx', 'bxy', 'bxz', 'byy', 'byz', 'bzz' are added.
+
+            OUTPUT
+            :param dict: fields['induced' | 'remanent' | 'total'] as dict of
+                         nD arrays for each of 'bx', 'by', 'bz' and 'tf'
+        """
+
+        bvec, gvec = self.rotateFields(
+            self.forward(np.stack([self.Mind, self.Mrem], axis=-1))
+        )
+
+        # Append the total field
+        bvec = np.concatenate([bvec, bvec.sum(axis=-1, keepdims=True)], axis=-1)
+
+        # Projection on the inducing field of each receiver
+        Ptmi = MathUtils.dipazm_2_xyz(self.Hinc, self.Hdec)
+        if self.variableField:
+            tf = np.einsum('di,idm->dm', np.broadcast_to(Ptmi, bvec.shape[1::-1]), bvec)
+        else:
+            tf = np.tensordot(Ptmi, bvec, axes=1)
+
+        if gvec is not None:
+            gvec = np.concatenate(
+                [gvec, gvec.sum(axis=-1, keepdims=True)], axis=-1
+            )
+
+        fields = {}
+        for ii, mType in enumerate(['induced', 'remanent', 'total']):
+            fields[mType] = {
+                'bx': bvec[0, :, ii], 'by': bvec[1, :, ii],
+                'bz': bvec[2, :, ii], 'tf': tf[:, ii]
+            }
+
+            if gvec is not None:
+                for uType in gradientTypes:
+                    fields[mType][uType] = gvec[
+                        'xyz'.index(uType[1]), 'xyz'.index(uType[2]), :, ii
+                    ]
+
+        return fields
+
+    def fieldsBatch(
+        self, susc=None, Q=None, rinc=None, rdec=None, Hinc=None, Hdec=None
+    ):
+        """
+            Fields for a batch of magnetization scenarios, computed with a
+            single product between G and the nS magnetization vectors.
+
+            Each parameter is a value or an array of nS values, and
+            defaults to the corresponding attribute of the problem.
+            Hinc, Hdec change the direction of the inducing field, and
+            of the projection for 'tf', at all receivers.
+
+            OUTPUT
+            :param array: u, nS-by-nD array of uType fields, sum of the
+                          induced and/or remanent parts set by mType
+        """
+
+        params = [
+            self.susc if susc is None else susc,
+            self.Q if Q is None else Q,
+            self.rinc if rinc is None else rinc,
+            self.rdec if rdec is None else rdec,
+            self.Hinc if Hinc is None else Hinc,
+            self.Hdec if Hdec is None else Hdec,
+        ]
+
+        # Scenarios along the first axis, and the receivers along the
+        # second if the inducing field varies across the survey
+        params = [
+            np.atleast_1d(np.asarray(val, dtype=float))[:, None]
+            for val in params[:4]
+        ] + [
+            np.reshape(np.asarray(field, dtype=float), (1, -1))
+            if val is None else
+            np.atleast_1d(np.asarray(val, dtype=float))[:, None]
+            for val, field in [(Hinc, self.Hinc), (Hdec, self.Hdec)]
+        ] + [np.reshape(np.asarray(self.Higrf, dtype=float), (1, -1))]
+
+        susc, Q, rinc, rdec, Hinc, Hdec, Higrf = np.broadcast_arrays(*params)
+
+        # Magnetization of all scenarios [nS x (nD | 1) x 3]
+        M = np.zeros(susc.shape + (3,))
+
+        if (self.mType == 'induced') or (self.mType == 'total'):
+            M += MathUtils.dipazm_2_xyz(Hinc, Hdec)
+
+        if (self.mType == 'remanent') or (self.mType == 'total'):
+            M += Q[..., None] * MathUtils.dipazm_2_xyz(rinc, rdec)
+
+        M *= (susc * Higrf)[..., None]
+
+        # Rotate in the frame of the prism and forward
+        R = MathUtils.rotationMatrix(-self.prism.pinc, -self.prism.pdec, normal=False)
+        M = np.einsum('ij,sdj->ids', R, M)
+
+        if M.shape[1] == 1:
+            bvec, gvec = self.rotateFields(self.G.dot(M[:, 0, :]))
+        else:
+            bvec, gvec = self.rotateFields(self.forward(M))
+
+        if self.uType in gradientTypes:
+            u = gvec['xyz'.index(self.uType[1]), 'xyz'.index(self.uType[2])].T
+
+        if self.uType == 'bx':
+            u = bvec[0, :, :].T
+
+        if self.uType == 'by':
+            u = bvec[1, :, :].T
+
+        if self.uType == 'bz':
+            u = bvec[2, :, :].T
+
+        if self.uType == 'tf':
+            # Projection matrix of each scenario and receiver
+            Ptmi = np.broadcast_to(
+                MathUtils.dipazm_2_xyz(Hinc, Hdec),
+                (bvec.shape[2], bvec.shape[1], 3)
+            )
+
+            u = np.einsum('sdi,ids->sd', Ptmi, bvec)
+
+        return u
+
+    def rotateFields(self, bvec):
+        """
+            Rotate the fields computed in the frame of the prism, ordered
+            as the rows of G, back to the global frame.
+
+            OUTPUT
+            :param array: bvec, [3, nD, ...] fields
+            :param array: gvec, [3, 3, nD, ...] gradient tensor,
+                          or None if G has no gradient rows
+        """
+
+        nD = self.survey.nD
+        R = MathUtils.rotationMatrix(self.prism.pinc, self.prism.pdec)
+
+        fields = np.reshape(bvec[:3*nD], (3, nD) + bvec.shape[1:])
+        fields = np.tensordot(R, fields, axes=1)
+
+        if bvec.shape[0] == 3*nD:
+            return fields, None
+
+        # Full symmetric tensor from the 6 gradient components
+        grad = np.reshape(bvec[3*nD:], (6, nD) + bvec.shape[1:])
+        grad = grad[[0, 1, 2, 1, 3, 4, 2, 4, 5]]
+        grad = np.reshape(grad, (3, 3, nD) + bvec.shape[1:])
+        grad = np.einsum('ai,bj,ij...->ab...', R, R, grad)
+
+        return fields, grad
+
+    def extractFields(self, bvec):
+
+        bvec, gvec = self.rotateFields(bvec)
+
+        if self.uType in gradientTypes:
+            u = gvec['xyz'.index(self.uType[1]), 'xyz'.index(self.uType[2])]
+            u = u.flatten()
+
+        if self.uType == 'bx':
+            u = bvec[0, :].flatten()
+
+        if self.uType == 'by':
+            u = bvec[1, :].flatten()
+
+        if self.uType == 'bz':
+            u = bvec[2, :].flatten()
+
+        if self.uType == 'tf':
+            # Projection matrix
+            Ptmi = MathUtils.dipazm_2_xyz(self.Hinc,
+                                         self.Hdec)
+
+            if self.variableField:
+                u = np.einsum('di,id->d', np.broadcast_to(Ptmi, bvec.shape[::-1]), bvec)
+            else:
+                u = Ptmi.dot(bvec).flatten()
+
+        return u
+
+
+def Intrgl_Fwr_Op(
+    xn, yn, zn, rxLoc, blockSize=1000, n_workers=1, backend=None,
+    gradient=False, flag='full', srcFieldParam=np.r_[50000, 90, 0], M=None,
+    cellBlockSize=1000, precision='float64'
+):
+
+    """
+
+    Magnetic forward operator in integral form
+
+    flag        = 'ind' | 'full'
+
+      1- ind : Magnetization fixed by user
+
+               TMI sensitivity stored with shape([ndata, nc]), for the
+               magnetization M per unit susceptibility [A/m] of each cell
+               (nc-by-3 or 3 array). The default M is induced by the
+               inducing field srcFieldParam = [|B|, Inc, Dec].
+               If the inducing field varies across the survey (arrays of
+               nD values, see inducingField), each row is projected on the
+               field of its receiver, and the default M is the
+               magnetization induced by that field.
+
+      3- full: Full tensor matrix stored with shape([3*ndata, 3*nc])
+               ordered as [bx, by, bz] along rows and [Mx, My, Mz] along
+               columns
+
+    The cells are the nc cells of the tensor mesh with nodes xn, yn, zn,
+    ordered as in cellNodes. A model m on a SimPEG TensorMesh is mapped
+    to this ordering by m.reshape(mesh.vnC, order='F').flatten().
+
+    The observation locations are processed by blocks of blockSize
+    receivers, and the cells by chunks of cellBlockSize cells, to limit
+    the memory used by the vectorized kernel.
+    If n_workers > 1, the blocks are computed by a pool of processes
+    writing directly in a shared output array. Each block fills its own
+    rows, so the result is identical to the serial computation.
+
+    If gradient=True (flag='full' only), the 6 components of the gradient
+    tensor [bxx, bxy, bxz, byy, byz, bzz] are stored below the fields, for
+    an operator of shape([9*ndata, 3*nc])
+
+    If precision='float32', the kernel is evaluated in double precision
+    and rounded (see calcTensor), and G is stored in single precision, for
+    half the memory of the default 'float64'.
+
+    Return
+    _G = Linear forward modeling operation
+
+     """
+
+    assert flag in ['ind', 'full'], "flag must be 'ind' | 'full'"
+
+    Xn, Yn, Zn = cellNodes(xn, yn, zn)
+
+    ndata = rxLoc.shape[0]
+    nC = Xn.shape[0]
+
+    if flag == 'ind':
+
+        assert not gradient, "Gradients are only available for flag='full'"
+
+        H, Ptmi = inducingField(srcFieldParam)
+        Mrx = None
+
+        if np.ndim(H) > 0:
+            Ptmi = np.broadcast_to(Ptmi, (ndata, 3))
+
+            if M is None:
+                # Magnetization induced by the field of each receiver
+                Mrx = np.broadcast_to(H, (ndata,))[:, None] * Ptmi
+
+        elif M is None:
+            M = H * Ptmi
+
+        if Mrx is None:
+            M = np.ones((nC, 3)) * np.asarray(M, dtype=float)
+
+        shape = (int(ndata), int(nC))
+
+    else:
+
+        M, Mrx, Ptmi = None, None, None
+
+        if gradient:
+            shape = (int(9*ndata), int(3*nC))
+        else:
+            shape = (int(3*ndata), int(3*nC))
+
+    if backend is None:
+        backend = kernel['backend']
+
+    options = {
+        'backend': backend, 'gradient': gradient,
+        'cellBlockSize': int(cellBlockSize), 'M': M, 'Mrx': Mrx,
+        'Ptmi': Ptmi, 'precision': precision
+    }
+
+    # Limits of the blocks of receivers
+    blocks = [
+        (start, np.min([start + int(blockSize), ndata]))
+        for start in range(0, ndata, int(blockSize))
+    ]
+
+    if n_workers > 1:
+
+        # Pre-allocate forward matrix in shared memory
+        Gshared = RawArray(
+            'f' if precision == 'float32' else 'd', int(np.prod(shape))
+        )
+
+        # The geometry is sent once to each worker at start up
+        with Pool(
+            int(n_workers), initializer=_initFwrWorker,
+            initargs=(Gshared, shape, Xn, Yn, Zn, rxLoc, options)
+        ) as pool:
+            pool.map(_fwrWorkerBlock, blocks)
+
+        G = np.frombuffer(Gshared, dtype=precision).reshape(shape)
+
+    else:
+
+        # Pre-allocate forward matrix
+        G = np.zeros(shape, dtype=precision)
+
+        for start, stop in blocks:
+            fillFwrBlock(G, Xn, Yn, Zn, rxLoc, start, stop, **options)
+
+    return G
+
+
+def cellNodes(xn, yn, zn):
+    """
+        Lower and upper node locations of all cells of a tensor mesh
+        defined by its nodes along each axis
+
+        OUTPUT
+        :param array: Xn, Yn, Zn, nC-by-2 arrays of node locations
+    """
+
+    yn2, xn2, zn2 = np.meshgrid(yn[1:], xn[1:], zn[1:])
+    yn1, xn1, zn1 = np.meshgrid(yn[0:-1], xn[0:-1], zn[0:-1])
+
+    Yn = np.c_[yn1.flatten(), yn2.flatten()]
+    Xn = np.c_[xn1.flatten(), xn2.flatten()]
+    Zn = np.c_[zn1.flatten(), zn2.flatten()]
+
+    return Xn, Yn, Zn
+
+
+def adaptiveFields(xn, yn, zn, rxLoc, M, theta=0.5, blockSize=1000):
+    """
+        Fields of a magnetized tensor mesh, with the distant cells
+        aggregated into parent prisms.
+
+        The cells are grouped in an octree of blocks of 2x2x2 cells. For
+        each receiver, the tree is traversed from its root: a block is
+        evaluated as a single prism of mean magnetization if its diagonal
+        is smaller than theta times its distance to the receiver, or split
+        into its children otherwise, down to the cells which are evaluated
+        exactly. The error decreases with theta, and theta=0 gives the
+        exact result of calcRow.
+
+        INPUT
+        :param array: xn, yn, zn, node locations of the cells along each axis
+        :param array: rxLoc, nD-by-3 array of observation locations
+        :param array: M, nC-by-3 array of magnetization [A/m], with the
+                      cells ordered as in cellNodes
+        :param float: theta, ratio of block size to distance [Default: 0.5]
+        :param int: blockSize, number of receivers traversing the tree
+                    together
+
+        OUTPUT
+        :param array: bvec, nD-by-3 array of fields [bx, by, bz] [nT]
+        :param array: nEval, nD array of prisms evaluated for each receiver
+    """
+
+    nodes = [np.asarray(vec, dtype=float) for vec in [xn, yn, zn]]
+    shape = tuple(len(vec) - 1 for vec in nodes)
+
+    # Levels of the tree from the cells to the root, with the sum of the
+    # magnetic moments, the number of magnetized cells and the indices of
+    # the nodes bounding each block
+    moment = np.reshape(M, shape + (3,)) * np.einsum(
+        'i,j,k->ijk', *[np.abs(np.diff(vec)) for vec in nodes]
+    )[:, :, :, None]
+    count = np.any(moment != 0, axis=3).astype(int)
+    edges = [np.arange(n + 1) for n in shape]
+
+    tree = [(moment, count, edges)]
+    while np.any(np.asarray(moment.shape[:3]) > 1):
+
+        pad = [(0, n % 2) for n in moment.shape[:3]]
+        moment = np.pad(moment, pad + [(0, 0)], mode='constant')
+        count = np.pad(count, pad, mode='constant')
+
+        nx, ny, nz = [n // 2 for n in moment.shape[:3]]
+        moment = moment.reshape((nx, 2, ny, 2, nz, 2, 3)).sum(axis=(1, 3, 5))
+        count = count.reshape((nx, 2, ny, 2, nz, 2)).sum(axis=(1, 3, 5))
+
+        edges = [
+            np.r_[edge[::2], edge[-1]] if (len(edge) % 2) == 0 else edge[::2]
+            for edge in edges
+        ]
+
+        tree += [(moment, count, edges)]
+
+    ndata = rxLoc.shape[0]
+    bvec = np.zeros((ndata, 3))
+    nEval = np.zeros(ndata, dtype=int)
+
+    for start in range(0, ndata, int(blockSize)):
+
+        stop = np.min([start + int(blockSize), ndata])
+        rx = rxLoc[start:stop, :]
+
+        # Pairs of receivers and blocks, starting from the root
+        pr = np.arange(stop - start)
+        pb = [np.zeros_like(pr) for ii in range(3)]
+
+        for level in range(len(tree) - 1, -1, -1):
+
+            moment, count, edges = tree[level]
+            mom = moment[pb[0], pb[1], pb[2], :]
+
+            # Skip the blocks without magnetized cells. The moments of the
+            # cells of a block can cancel, so the net moment is not used
+            ind = count[pb[0], pb[1], pb[2]] > 0
+            pr, pb, mom = pr[ind], [ijk[ind] for ijk in pb], mom[ind]
+
+            lims = [
+                (nodes[ii][edges[ii][pb[ii]]], nodes[ii][edges[ii][pb[ii] + 1]])
+                for ii in range(3)
+            ]
+
+            if level > 0:
+                size = np.sqrt(sum([(l2 - l1)**2. for l1, l2 in lims]))
+                dist = np.sqrt(sum([
+                    ((l1 + l2) / 2. - rx[pr, ii])**2.
+                    for ii, (l1, l2) in enumerate(lims)
+                ]))
+
+                far = size < theta * dist
+            else:
+                far = np.ones_like(pr, dtype=bool)
+
+            if np.any(far):
+
+                (x1, x2), (y1, y2), (z1, z2) = [
+                    (l1[far], l2[far]) for l1, l2 in lims
+                ]
+                r = rx[pr[far], :]
+
+                txx, txy, txz, tyy, tyz, tzz = calcTensor(
+                    x1 - r[:, 0], x2 - r[:, 0], y1 - r[:, 1],
+                    y2 - r[:, 1], z1 - r[:, 2], z2 - r[:, 2]
+                )
+
+                # Mean magnetization of each block
+                m = mom[far] / np.abs(
+                    (x2 - x1) * (y2 - y1) * (z2 - z1)
+                )[:, None]
+
+                b = [
+                    txx * m[:, 0] + txy * m[:, 1] + txz * m[:, 2],
+                    txy * m[:, 0] + tyy * m[:, 1] + tyz * m[:, 2],
+                    txz * m[:, 0] + tyz * m[:, 1] + tzz * m[:, 2]
+                ]
+
+                for ii in range(3):
+                    bvec[start:stop, ii] += np.bincount(
+                        pr[far], weights=b[ii], minlength=stop - start
+                    ) / 1e-9 * mu_0
+
+                nEval[start:stop] += np.bincount(
+                    pr[far], minlength=stop - start
+                )
+
+            if level == 0:
+                break
+
+            # Split the near blocks into their children
+            shapeChild = tree[level - 1][0].shape[:3]
+            pr, pb = pr[~far], [ijk[~far] for ijk in pb]
+
+            children = [[], [], [], []]
+            for offset in np.ndindex(2, 2, 2):
+                ijk = [2 * pb[ii] + offset[ii] for ii in range(3)]
+                ind = np.all([
+                    ijk[ii] < shapeChild[ii] for ii in range(3)
+                ], axis=0)
+
+                children[0] += [pr[ind]]
+                for ii in range(3):
+                    children[ii + 1] += [ijk[ii][ind]]
+
+            pr = np.concatenate(children[0])
+            pb = [np.concatenate(child) for child in children[1:]]
+
+    return bvec, nEval
+
+
+def fftFields(
+    xn, yn, zn, M, hx, hy, z=0., uType='tf',
+    srcFieldParam=np.r_[50000, 90, 0]
+):
+    """
+        Fields of a magnetized tensor mesh on a regular grid of receivers,
+        computed layer by layer as 2D convolutions with the prism kernel.
+
+        The horizontal cells of the mesh and the receivers must share the
+        same spacing, with any offset between the two grids. The response
+        of each layer of cells is then the discrete convolution of its
+        magnetization with the kernel of a single cell, evaluated at the
+        lattice of receiver-cell offsets. The convolutions are computed by
+        FFT on grids zero-padded to avoid any wrap-around, so that the
+        result is the same as the direct summation of calcRow, at a cost
+        of O(N log N) per layer.
+
+        INPUT
+        :param array: xn, yn, zn, node locations of the cells along each
+                      axis, with uniform spacing along xn and yn
+        :param array: M, nC-by-3 array of magnetization [A/m], with the
+                      cells ordered as in cellNodes
+        :param array: hx, hy, receiver locations along each axis, with the
+                      spacing of the mesh (as dataGrid.hx and dataGrid.hy)
+        :param float: z, elevation of the receivers
+        :param string: uType, 'tf' | 'bx' | 'by' | 'bz'
+        :param array: srcFieldParam, inducing field param [|B|, Inc, Dec]
+
+        OUTPUT
+        :param array: u, ny-by-nx grid of fields [nT], ordered as
+                      dataGrid.values
+    """
+
+    xn, yn, zn = [np.asarray(vec, dtype=float) for vec in [xn, yn, zn]]
+    hx, hy = np.asarray(hx, dtype=float), np.asarray(hy, dtype=float)
+
+    dx, dy = xn[1] - xn[0], yn[1] - yn[0]
+    assert np.allclose(np.diff(xn), dx) and np.allclose(np.diff(yn), dy), (
+        "Mesh must have a uniform spacing along x and y"
+    )
+
+    for h, d in zip([hx, hy], [dx, dy]):
+        assert len(h) == 1 or np.allclose(np.diff(h), d), (
+            "Receivers must have the spacing of the mesh"
+        )
+
+    nCx, nCy, nCz = len(xn) - 1, len(yn) - 1, len(zn) - 1
+    nx, ny = len(hx), len(hy)
+
+    # Size of the grids for a linear convolution
+    nPx, nPy = nx + nCx - 1, ny + nCy - 1
+
+    # Offsets between the receivers and the cells, wrapped on the
+    # padded grids [ny x nx]
+    lx = np.arange(nPx)
+    lx[lx >= nx] -= nPx
+    ly = np.arange(nPy)
+    ly[ly >= ny] -= nPy
+
+    sx = hx[0] - (xn[0] + dx / 2.) + lx * dx
+    sy = hy[0] - (yn[0] + dy / 2.) + ly * dy
+    Sx, Sy = np.meshgrid(sx, sy)
+
+    M = np.reshape(M, (nCx, nCy, nCz, 3))
+
+    Fb = np.zeros((3, nPy, nPx // 2 + 1), dtype=complex)
+    for k in range(nCz):
+
+        if not np.any(M[:, :, k, :]):
+            continue
+
+        # Kernel of a single cell of the layer
+        T = calcTensor(
+            -Sx - dx / 2., -Sx + dx / 2., -Sy - dy / 2., -Sy + dy / 2.,
+            np.ones_like(Sx) * (zn[k] - z), np.ones_like(Sx) * (zn[k+1] - z)
+        )
+        txx, txy, txz, tyy, tyz, tzz = [np.fft.rfft2(t) for t in T]
+
+        # Magnetization of the layer on the padded grid [ny x nx]
+        Fm = np.fft.rfft2(
+            np.transpose(M[:, :, k, :], (2, 1, 0)), s=(nPy, nPx)
+        )
+
+        Fb[0] += txx * Fm[0] + txy * Fm[1] + txz * Fm[2]
+        Fb[1] += txy * Fm[0] + tyy * Fm[1] + tyz * Fm[2]
+        Fb[2] += txz * Fm[0] + tyz * Fm[1] + tzz * Fm[2]
+
+    bvec = np.fft.irfft2(Fb, s=(nPy, nPx))[:, :ny, :nx] / 1e-9 * mu_0
+
+    return projectFields(
+        np.transpose(bvec, (1, 2, 0)), uType, srcFieldParam
+    )
+
+
+def tiledFields(
+    xn, yn, zn, M, rxLoc, maxNpoints=1000, overlap=0., expFact=1.3,
+    n_workers=1, store=None, blockSize=100
+):
+    """
+        Fields of a magnetized tensor mesh for large surveys, computed
+        tile by tile on local meshes.
+
+        The receivers are split in tiles of at most maxNpoints with
+        MathUtils.tileSurveyPoints. Each tile is modelled on a local mesh
+        keeping the cells of the global mesh over the tile, extended by
+        overlap (core), and merging the cells outside into padding cells
+        growing by expFact up to the limits of the global mesh (see
+        tileNodes). Since the local cells are unions of global cells, the
+        magnetic moment of the model is preserved exactly.
+
+        Each tile is computed by a worker process, with a matrix-free
+        ForwardOperator, or from a SensitivityStore if provided.
+
+        INPUT
+        :param array: xn, yn, zn, node locations of the cells along each axis
+        :param array: M, nC-by-3 array of magnetization [A/m], with the
+                      cells ordered as in cellNodes
+        :param array: rxLoc, nD-by-3 array of observation locations
+        :param int: maxNpoints, maximum number of receivers per tile
+        :param float: overlap, extent of the core of the local meshes
+                      beyond each tile
+        :param float: expFact, expansion factor of the padding cells
+        :param int: n_workers, number of processes
+        :param object: store, SensitivityStore of the tile operators
+        :param int: blockSize, number of receivers per block of the kernel
+
+        OUTPUT
+        :param array: bvec, nD-by-3 array of fields [bx, by, bz] [nT]
+    """
+
+    nodes = [np.asarray(vec, dtype=float) for vec in [xn, yn, zn]]
+    shape = tuple(len(vec) - 1 for vec in nodes)
+
+    # Magnetic moment of the global cells
+    moment = np.reshape(M, shape + (3,)) * np.einsum(
+        'i,j,k->ijk', *[np.abs(np.diff(vec)) for vec in nodes]
+    )[:, :, :, None]
+
+    # Tiles without overlap, covering all receivers
+    xy1, xy2 = MathUtils.tileSurveyPoints(rxLoc[:, :2], maxNpoints)
+
+    # Assign each receiver to the first tile containing it
+    tileIndex = -np.ones(rxLoc.shape[0], dtype=int)
+    for tt in range(xy1.shape[0]):
+        inTile = np.all(
+            (rxLoc[:, :2] >= xy1[tt, :]) & (rxLoc[:, :2] <= xy2[tt, :]),
+            axis=1
+        )
+        tileIndex[inTile & (tileIndex == -1)] = tt
+
+    assert np.all(tileIndex >= 0), "Receivers found outside of all tiles"
+
+    # The overlap only extends the core of the local meshes
+    xy1, xy2 = xy1 - overlap, xy2 + overlap
+
+    options = {'blockSize': blockSize}
+
+    def tiles():
+        for tt in range(xy1.shape[0]):
+
+            ind = np.where(tileIndex == tt)[0]
+            if len(ind) == 0:
+                continue
+
+            # Local nodes, with all the layers of the global mesh
+            index = [
+                tileNodes(nodes[ii], [xy1[tt, ii], xy2[tt, ii]], expFact)
+                for ii in range(2)
+            ] + [np.arange(shape[2] + 1)]
+
+            local = moment
+            for ii in range(3):
+                local = np.add.reduceat(local, index[ii][:-1], axis=ii)
+
+            localNodes = [nodes[ii][index[ii]] for ii in range(3)]
+            local /= np.einsum(
+                'i,j,k->ijk', *[np.abs(np.diff(vec)) for vec in localNodes]
+            )[:, :, :, None]
+
+            yield ind, (
+                localNodes, local.reshape((-1, 3)), rxLoc[ind, :], options,
+                store
+            )
+
+    bvec = np.zeros((rxLoc.shape[0], 3))
+
+    if n_workers > 1:
+
+        indices = []
+
+        def args():
+            for ind, arg in tiles():
+                indices.append(ind)
+                yield arg
+
+        with Pool(int(n_workers)) as pool:
+            for ii, b in enumerate(pool.imap(_tileFields, args())):
+                bvec[indices[ii], :] = b
+
+    else:
+        for ind, arg in tiles():
+            bvec[ind, :] = _tileFields(arg)
+
+    return bvec
+
+
+def _tileFields(args):
+    """
+        Fields of the receivers of a tile on its local mesh
+    """
+
+    (xn, yn, zn), M, rxLoc, options, store = args
+
+    if store is not None:
+        G = store.operator(xn, yn, zn, rxLoc, **options)
+    else:
+        G = ForwardOperator(xn, yn, zn, rxLoc, **options)
+
+    return G.dot(M.flatten(order='F')).reshape((3, -1)).T
+
+
+def tileNodes(nodes, limits, expFact=1.3):
+    """
+        Indices of a subset of the nodes of a mesh along one axis, keeping
+        all the nodes within limits (core), and nodes spaced by widths
+        growing by expFact outside (padding), up to both ends of the mesh.
+
+        INPUT
+        :param array: nodes, increasing node locations of the global mesh
+        :param list: limits, [min, max] of the core
+        :param float: expFact, expansion factor of the padding cells
+
+        OUTPUT
+        :param array: index, increasing indices of the nodes kept
+    """
+
+    nN = len(nodes)
+
+    core = np.where((nodes >= limits[0]) & (nodes <= limits[1]))[0]
+    if len(core) == 0:
+        core = [np.argmin(np.abs(nodes - np.mean(limits)))]
+
+    # Include the cells crossing the limits
+    start = int(np.max([core[0] - 1, 0]))
+    stop = int(np.min([core[-1] + 1, nN - 1]))
+
+    index = list(range(start, stop + 1))
+
+    for direction in [1, -1]:
+
+        ii = stop if direction == 1 else start
+        width = np.abs(nodes[ii] - nodes[ii - direction]) if (
+            0 < ii < nN - 1
+        ) else 0.
+
+        while 0 < ii < nN - 1:
+
+            width *= expFact
+            if direction == 1:
+                ii = int(np.searchsorted(nodes, nodes[ii] + width))
+                ii = int(np.min([ii, nN - 1]))
+            else:
+                ii = int(np.searchsorted(
+                    nodes, nodes[ii] - width, side='right'
+                )) - 1
+                ii = int(np.max([ii, 0]))
+
+            width = np.abs(
+                nodes[ii] - nodes[index[-1] if direction == 1 else index[0]]
+            )
+
+            if direction == 1:
+                index.append(ii)
+            else:
+                index.insert(0, ii)
+
+    return np.asarray(index)
+
+
+class ForwardOperator(LinearOperator):
+    """
+        Matrix-free version of the forward operator Intrgl_Fwr_Op
+
+        The products G*m and G.T*d are computed on the fly by blocks of
+        blockSize receivers, so that G of shape [3*nD, 3*nC] is never
+        stored. Memory use scales with blockSize*nC.
+
+        INPUT
+        :param array: xn, yn, zn, node locations of the cells along each axis
+        :param array: rxLoc, nD-by-3 array of observation locations
+        :param int: blockSize, number of receivers per block [Default: 1000]
+        :param string: backend, kernel implementation 'numpy' | 'numba'
+        :param bool: gradient, add the rows of the gradient tensor
+                     as in Intrgl_Fwr_Op
+    """
+
+    def __init__(
+        self, xn, yn, zn, rxLoc, blockSize=1000, backend=None, gradient=False
+    ):
+
+        self.Xn, self.Yn, self.Zn = cellNodes(xn, yn, zn)
+        self.rxLoc = rxLoc
+        self.blockSize = int(blockSize)
+        self.backend = backend
+        self.gradient = gradient
+
+        self.nD = rxLoc.shape[0]
+        self.nC = self.Xn.shape[0]
+
+        nRows = 9 if gradient else 3
+
+        super(ForwardOperator, self).__init__(
+            dtype=np.dtype(float),
+            shape=(int(nRows*self.nD), int(3*self.nC))
+        )
+
+    def blocks(self):
+        """
+            Iterate over the blocks of receivers and the corresponding
+            rows of the kernel [Tx, Ty, Tz, ...] in nT/(A/m)
+        """
+        for start in range(0, self.nD, self.blockSize):
+
+            ind = np.arange(start, np.min([start + self.blockSize, self.nD]))
+
+            rows = calcRows(
+                self.Xn, self.Yn, self.Zn, self.rxLoc[ind, :],
+                backend=self.backend, gradient=self.gradient
+            )
+
+            yield ind, [T / 1e-9 * mu_0 for T in rows]
+
+    def _matmat(self, m):
+
+        d = np.zeros((self.shape[0], m.shape[1]))
+        for ind, rows in self.blocks():
+            for ii, T in enumerate(rows):
+                d[ind + ii*self.nD, :] = T.dot(m)
+
+        return d
+
+    def _matvec(self, m):
+        return self._matmat(np.reshape(m, (-1, 1))).flatten()
+
+    def _rmatmat(self, d):
+
+        m = np.zeros((self.shape[1], d.shape[1]))
+        for ind, rows in self.blocks():
+            for ii, T in enumerate(rows):
+                m += T.T.dot(d[ind + ii*self.nD, :])
+
+        return m
+
+    def _rmatvec(self, d):
+        return self._rmatmat(np.reshape(d, (-1, 1))).flatten()
+
+    def _adjoint(self):
+        return _AdjointForwardOperator(self)
+
+
+class _AdjointForwardOperator(LinearOperator):
+    """
+        Transpose of a ForwardOperator, computing G.T*d by blocks
+    """
+
+    def __init__(self, G):
+        self.G = G
+        super(_AdjointForwardOperator, self).__init__(
+            dtype=G.dtype, shape=(G.shape[1], G.shape[0])
+        )
+
+    def _matmat(self, d):
+        return self.G._rmatmat(d)
+
+    def _matvec(self, d):
+        return self.G._rmatvec(d)
+
+    def _rmatvec(self, m):
+        return self.G._matvec(m)
+
+    def _adjoint(self):
+        return self.G
+
+
+class CompressedOperator(LinearOperator):
+    """
+        Wavelet-compressed forward operator of a tensor mesh
+
+        Each row of the operator of Intrgl_Fwr_Op is transformed with the
+        orthonormal wavelet transform MathUtils.waveletTransform over the
+        cells of the mesh, one magnetization component at a time, then
+        thresholded so that the discarded coefficients hold less than
+        tol of the norm of the row. The rows are computed by blocks of
+        receivers, so that the dense operator is never stored.
+
+        Since the transform is orthonormal, G*m = Gw*W(m) and
+        G.T*d = W^-1(Gw.T*d): products only need the transform of the
+        model, applied to the compressed sparse matrix Gw.
+
+        The memory saved grows with the number of cells and the
+        tolerance: at the default tol=1e-2, the operator of a 32x32x8 mesh
+        is about 8 times smaller than the dense one, and about 27 times
+        for a 64x64x16 mesh (3 and 10 times at tol=1e-3).
+
+        INPUT
+        :param array: xn, yn, zn, node locations of the cells along each axis
+        :param array: rxLoc, nD-by-3 array of observation locations
+        :param float: tol, relative accuracy of each row [Default: 1e-2]
+        :param kwargs: options of Intrgl_Fwr_Op, 'flag', 'srcFieldParam',
+                       'M', 'gradient', 'blockSize', 'cellBlockSize'
+                       and 'backend'
+    """
+
+    def __init__(self, xn, yn, zn, rxLoc, tol=1e-2, **kwargs):
+
+        flag = kwargs.get('flag', 'full')
+        blockSize = int(kwargs.get('blockSize', 1000))
+
+        self.tol = tol
+        self.meshShape = (len(xn) - 1, len(yn) - 1, len(zn) - 1)
+        self.nC = int(np.prod(self.meshShape))
+        self.nComp = 1 if flag == 'ind' else 3
+
+        nD = rxLoc.shape[0]
+        nW = int(np.prod(MathUtils.waveletLevels(self.meshShape)[1]))
+
+        rows, cols, vals = [], [], []
+        for start in range(0, nD, blockSize):
+
+            stop = np.min([start + blockSize, nD])
+
+            # Dense rows of the block, ordered as in Intrgl_Fwr_Op
+            G = Intrgl_Fwr_Op(
+                xn, yn, zn, rxLoc[start:stop, :], **kwargs
+            )
+            nRows = G.shape[0] // (stop - start)
+
+            W = MathUtils.waveletTransform(
+                G.reshape((G.shape[0], self.nComp, self.nC)), self.meshShape
+            ).reshape((G.shape[0], self.nComp * nW))
+
+            # Keep the largest coefficients of each row
+            order = np.argsort(W**2., axis=1)
+            energy = np.cumsum(np.take_along_axis(W**2., order, axis=1), axis=1)
+            nDrop = np.sum(
+                energy <= tol**2. * energy[:, -1:], axis=1
+            )
+
+            keep = np.ones(W.shape, dtype=bool)
+            keep[
+                np.repeat(np.arange(W.shape[0]), nDrop),
+                order[np.arange(W.shape[1])[None, :] < nDrop[:, None]]
+            ] = False
+
+            row, col = np.where(keep)
+
+            # Global row of each receiver of the block for each component
+            ind = np.arange(start, stop)
+            ind = (np.arange(nRows)[:, None] * nD + ind[None, :]).flatten()
+
+            rows += [ind[row]]
+            cols += [col]
+            vals += [W[row, col]]
+
+        self.Gw = csr_matrix(
+            (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(nRows * nD, self.nComp * nW)
+        )
+
+        super(CompressedOperator, self).__init__(
+            dtype=np.dtype(float), shape=(nRows * nD, self.nComp * self.nC)
+        )
+
+    @property
+    def compression(self):
+        """
+            Ratio of the memory of the dense operator to the compressed one
+        """
+        nbytes = (
+            self.Gw.data.nbytes + self.Gw.indices.nbytes +
+            self.Gw.indptr.nbytes
+        )
+
+        return np.prod(self.shape) * 8. / nbytes
+
+    def _matmat(self, m):
+
+        m = np.reshape(m.T, (m.shape[1], self.nComp, self.nC))
+        w = MathUtils.waveletTransform(m, self.meshShape)
+
+        return self.Gw.dot(np.reshape(w, (m.shape[0], -1)).T)
+
+    def _matvec(self, m):
+        return self._matmat(np.reshape(m, (-1, 1))).flatten()
+
+    def _rmatmat(self, d):
+
+        w = self.Gw.T.dot(d).T
+        w = np.reshape(w, (d.shape[1], self.nComp, -1))
+        m = MathUtils.waveletTransform(w, self.meshShape, inverse=True)
+
+        return np.reshape(m, (d.shape[1], -1)).T
+
+    def _rmatvec(self, d):
+        return self._rmatmat(np.reshape(d, (-1, 1))).flatten()
+
+    def _adjoint(self):
+        return _AdjointForwardOperator(self)
+
+
+def fillFwrBlock(
+    G, Xn, Yn, Zn, rxLoc, start, stop, backend=None, gradient=False,
+    cellBlockSize=1000, M=None, Ptmi=None, precision='float64', Mrx=None
+):
+    """
+        Compute the rows of the forward operator G for the
+        receivers rxLoc[start:stop, :], by chunks of cellBlockSize cells.
+
+        If M is given, G is the TMI sensitivity of the cells magnetized
+        along M, projected on Ptmi, as in Intrgl_Fwr_Op(flag='ind').
+        Ptmi is a [3] direction or an nD-by-3 array of directions for each
+        receiver. Mrx is used instead of M for an nD-by-3 magnetization of
+        all the cells, seen by each receiver.
+    """
+
+    ndata = rxLoc.shape[0]
+    nC = Xn.shape[0]
+
+    for cstart in range(0, nC, cellBlockSize):
+
+        cstop = np.min([cstart + cellBlockSize, nC])
+        nc = cstop - cstart
+
+        rows = calcRows(
+            Xn[cstart:cstop], Yn[cstart:cstop], Zn[cstart:cstop],
+            rxLoc[start:stop, :], backend=backend, gradient=gradient,
+            precision=precision
+        )
+
+        if M is not None or Mrx is not None:
+
+            P = Ptmi if Ptmi.ndim == 1 else Ptmi[start:stop, None, :]
+
+            # TMI kernel of the magnetization along each axis [nB x 3 x nc]
+            T = np.zeros((stop - start, 3 * nc))
+            for ii in range(3):
+                T += P[..., ii] * rows[ii]
+
+            T = T.reshape((stop - start, 3, nc))
+
+            if Mrx is not None:
+                G[start:stop, cstart:cstop] = np.einsum(
+                    'bic,bi->bc', T, Mrx[start:stop]
+                ) / 1e-9 * mu_0
+            else:
+                G[start:stop, cstart:cstop] = np.einsum(
+                    'bic,ci->bc', T, M[cstart:cstop]
+                ) / 1e-9 * mu_0
+
+            continue
+
+        for ii, T in enumerate(rows):
+            for jj in range(3):
+                G[
+                    start+ii*ndata:stop+ii*ndata,
+                    cstart+jj*nC:cstop+jj*nC
+                ] = T[:, jj*nc:(jj+1)*nc] / 1e-9 * mu_0
+
+
+# Shared state of the forward workers, set once per process
+_fwrWorker = {}
+
+
+def _initFwrWorker(Gshared, shape, Xn, Yn, Zn, rxLoc, options):
+    _fwrWorker['G'] = np.frombuffer(
+        Gshared, dtype=options['precision']
+    ).reshape(shape)
+    _fwrWorker['geometry'] = (Xn, Yn, Zn, rxLoc)
+    _fwrWorker['options'] = options
+
+
+def _fwrWorkerBlock(block):
+    Xn, Yn, Zn, rxLoc = _fwrWorker['geometry']
+    fillFwrBlock(
+        _fwrWorker['G'], Xn, Yn, Zn, rxLoc, block[0], block[1],
+        **_fwrWorker['options']
+    )
+
+
+def prismFields(
+    rxLoc, centers, sizes, pinc=0., pdec=0., susc=1., Q=0., rinc=0.,
+    rdec=0., srcFieldParam=np.r_[50000, 90, 0], uType='tf', blockSize=1e+6,
+    useCache=False, farRatio=None
+):
+    """
+        Summed magnetic response of a collection of rotated prisms.
+        All prisms are evaluated in one vectorized pass, with the
+        rotations of the receivers in the frame of each prism batched
+        together.
+
+        INPUT
+        :param array: rxLoc, nD-by-3 array of observation locations
+        :param array: centers, nP-by-3 array of prism centers
+        :param array: sizes, nP-by-3 array of prism dimensions [dx, dy, dz]
+        :param array: pinc, pdec, value or nP array of prism orientations
+        :param array: susc, value or nP array of susceptibilities
+        :param array: Q, value or nP array of Koenigsberger ratios
+        :param array: rinc, rdec, value or nP array of remanence orientations
+        :param array: srcFieldParam, inducing field param [|B|, Inc, Dec],
+                      each a value or an nD array (see inducingField)
+        :param string: uType, 'tf' | 'bx' | 'by' | 'bz'
+        :param int: blockSize, maximum number of receiver-prism pairs
+                    evaluated at once
+        :param bool: useCache, store the operator of the prisms in the
+                     operatorCache, so that later calls on the same geometry
+                     only cost a matrix-vector product
+        :param float: farRatio, distance to diagonal ratio beyond which the
+                      prisms are approximated by dipoles (prismBlockTensor)
+
+        OUTPUT
+        :param array: u, nD array of fields summed over all prisms [nT]
+    """
+
+    rxLoc = np.atleast_2d(rxLoc)
+    centers = np.atleast_2d(np.asarray(centers, dtype=float))
+    sizes = np.atleast_2d(np.asarray(sizes, dtype=float))
+
+    nP = centers.shape[0]
+    ndata = rxLoc.shape[0]
+
+    pinc, pdec, susc, Q, rinc, rdec = [
+        np.ones(nP) * np.asarray(val, dtype=float)
+        for val in [pinc, pdec, susc, Q, rinc, rdec]
+    ]
+
+    # Rotations to and from the frame of each prism
+    Rp = MathUtils.rotationMatrix(-pinc, -pdec, normal=False)
+    Rb = MathUtils.rotationMatrix(pinc, pdec)
+
+    variable = np.ndim(inducingField(srcFieldParam)[0]) > 0
+
+    if useCache:
+
+        G = operatorCache.get(
+            geometryKey(
+                rxLoc, centers, sizes, pinc, pdec,
+                -1 if farRatio is None else farRatio
+            ),
+            lambda: prismOperator(
+                rxLoc, centers, sizes, pinc=pinc, pdec=pdec,
+                blockSize=blockSize, farRatio=farRatio
+            )
+        )
+
+        M = prismMagnetization(susc, Q, rinc, rdec, srcFieldParam)
+
+        if variable:
+            bvec = np.einsum(
+                'idjp,pdj->di', G.reshape((3, ndata, 3, nP)),
+                np.broadcast_to(M, (nP, ndata, 3))
+            )
+        else:
+            bvec = G.dot(M.flatten(order='F')).reshape((3, ndata)).T
+
+        return projectFields(bvec, uType, srcFieldParam)
+
+    if not variable:
+        M = prismMagnetization(susc, Q, rinc, rdec, srcFieldParam, Rp=Rp)
+
+    bvec = np.zeros((ndata, 3))
+    nB = int(np.max([blockSize // nP, 1]))
+    for start in range(0, ndata, nB):
+
+        ind = np.arange(start, np.min([start + nB, ndata]))
+
+        if variable:
+            M = prismMagnetization(
+                susc, Q, rinc, rdec, srcFieldParam, Rp=Rp, ind=ind
+            )
+
+        b = prismBlockFields(
+            rxLoc[None, ind, :], centers, sizes, Rp, M, farRatio=farRatio
+        )
+
+        # Rotate back and sum over all prisms
+        bvec[ind, :] = np.einsum('pij,pjb->bi', Rb, b) / 1e-9 * mu_0
+
+    return projectFields(bvec, uType, srcFieldParam)
+
+
+def prismBlockFields(rxLoc, centers, sizes, Rp, M, farRatio=None):
+    """
+        Fields of each prism in its own frame, for a block of receivers
+
+        INPUT
+        :param array: rxLoc, [1 | nP] x nB x 3 array of observation locations
+        :param array: centers, nP-by-3 array of prism centers
+        :param array: sizes, nP-by-3 array of prism dimensions [dx, dy, dz]
+        :param array: Rp, nP x 3 x 3 rotations into the frame of each prism
+        :param array: M, nP-by-3 magnetization in the frame of each prism,
+                      or nP x nB x 3 magnetization seen by each receiver
+        :param float: farRatio, see prismBlockTensor
+
+        OUTPUT
+        :param array: b, nP x 3 x nB array of fields [bx, by, bz]
+    """
+
+    txx, txy, txz, tyy, tyz, tzz = prismBlockTensor(
+        rxLoc, centers, sizes, Rp, farRatio=farRatio
+    )
+
+    if M.ndim == 2:
+        M = M[:, None, :]
+
+    return np.stack([
+        txx * M[..., 0] + txy * M[..., 1] + txz * M[..., 2],
+        txy * M[..., 0] + tyy * M[..., 1] + tyz * M[..., 2],
+        txz * M[..., 0] + tyz * M[..., 1] + tzz * M[..., 2]
+    ], axis=1)
+
+
+def prismBlockTensor(rxLoc, centers, sizes, Rp, farRatio=None):
+    """
+        Magnetic tensor of each prism in its own frame, for a block of
+        receivers.
+
+        If farRatio is given, the receiver-prism pairs further apart than
+        farRatio times the diagonal of the prism use the tensor of a
+        dipole of the same volume (see dipoleTensor) instead of the prism
+        kernel. Since the prisms are symmetric, the error decreases as
+        (diagonal / distance)**2. The number of pairs evaluated with each
+        formula is added to kernelCounts.
+
+        INPUT
+        :param array: rxLoc, [1 | nP] x nB x 3 array of observation locations
+        :param array: centers, nP-by-3 array of prism centers
+        :param array: sizes, nP-by-3 array of prism dimensions [dx, dy, dz]
+        :param array: Rp, nP x 3 x 3 rotations into the frame of each prism
+        :param float: farRatio, distance to diagonal ratio of the far field
+                      [Default: None, prism kernel everywhere]
+
+        OUTPUT
+        :param list: [txx, txy, txz, tyy, tyz, tzz] nP-by-nB arrays
+    """
+
+    # Nodes of the prisms relative to their centers
+    nodes1, nodes2 = -sizes / 2., sizes / 2.
+
+    # Receivers in the frame of each prism [nP x nB x 3]
+    xyz = np.einsum('pij,pbj->pbi', Rp, rxLoc - centers[:, None, :])
+
+    if farRatio is None:
+        far = np.zeros(xyz.shape[:2], dtype=bool)
+    else:
+        far = np.sum(xyz**2., axis=2) > (
+            farRatio**2. * np.sum(sizes**2., axis=1)[:, None]
+        )
+
+    nFar = int(np.sum(far))
+    kernelCounts['prism'] += far.size - nFar
+    kernelCounts['dipole'] += nFar
+
+    if nFar == 0:
+        return calcTensor(
+            nodes1[:, 0:1] - xyz[:, :, 0], nodes2[:, 0:1] - xyz[:, :, 0],
+            nodes1[:, 1:2] - xyz[:, :, 1], nodes2[:, 1:2] - xyz[:, :, 1],
+            nodes1[:, 2:3] - xyz[:, :, 2], nodes2[:, 2:3] - xyz[:, :, 2]
+        )
+
+    # Dipoles everywhere, then the prism kernel on the near pairs only
+    T = dipoleTensor(xyz, np.prod(sizes, axis=1)[:, None])
+
+    p, b = np.where(~far)
+    tensor = calcTensor(
+        nodes1[p, 0] - xyz[p, b, 0], nodes2[p, 0] - xyz[p, b, 0],
+        nodes1[p, 1] - xyz[p, b, 1], nodes2[p, 1] - xyz[p, b, 1],
+        nodes1[p, 2] - xyz[p, b, 2], nodes2[p, 2] - xyz[p, b, 2]
+    )
+    for t, tp in zip(T, tensor):
+        t[p, b] = tp
+
+    return T
+
+
+def dipoleTensor(xyz, volume):
+    """
+        Magnetic tensor of a dipole, in the same units as calcTensor:
+        T = volume / (4*pi) * (3*r*r' - |r|**2 * I) / |r|**5
+
+        INPUT
+        :param array: xyz, [...] x 3 array of receivers relative to the dipoles
+        :param array: volume, [...] array of volumes of the sources
+
+        OUTPUT
+        :param list: [txx, txy, txz, tyy, tyz, tzz] [...] arrays
+    """
+
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+
+    r2 = x**2. + y**2. + z**2.
+    scale = volume / (4. * np.pi * r2**2.5)
+
+    return [
+        scale * (3. * x * x - r2), scale * 3. * x * y, scale * 3. * x * z,
+        scale * (3. * y * y - r2), scale * 3. * y * z,
+        scale * (3. * z * z - r2)
+    ]
+
+
+def projectFields(bvec, uType, srcFieldParam):
+    """
+        Extract a component from an [...] x nD-by-3 array of
+        fields [bx, by, bz]. The total field is projected on the
+        inducing field of each receiver if it varies across the survey.
+    """
+
+    if uType == 'bx':
+        u = bvec[..., 0]
+
+    if uType == 'by':
+        u = bvec[..., 1]
+
+    if uType == 'bz':
+        u = bvec[..., 2]
+
+    if uType == 'tf':
+        # Projection matrix
+        Ptmi = inducingField(srcFieldParam)[1]
+
+        if Ptmi.ndim > 1:
+            u = np.sum(bvec * Ptmi, axis=-1)
+        else:
+            u = bvec.dot(Ptmi)
+
+    return u
+
+
+def inducingField(srcFieldParam):
+    """
+        Amplitude and direction of the inducing field
+        srcFieldParam = [|B|, Inc, Dec] [nT, deg, deg].
+
+        Each parameter is a value, or an array of values at each receiver
+        for an inducing field varying across the survey.
+
+        OUTPUT
+        :param array: H, value or [nD] array of amplitudes [A/m]
+        :param array: mind, [3] or [nD] x 3 array of unit directions
+    """
+
+    B, inc, dec = np.broadcast_arrays(
+        *[np.asarray(val, dtype=float) for val in srcFieldParam[:3]]
+    )
+
+    return B * 1e-9 / mu_0, MathUtils.dipazm_2_xyz(inc, dec)
+
+
+def prismMagnetization(susc, Q, rinc, rdec, srcFieldParam, Rp=None, ind=None):
+    """
+        Sum of the induced and remanent magnetization of prisms [A/m]
+
+        INPUT
+        :param array: susc, Q, rinc, rdec, nP arrays of prism properties
+        :param array: srcFieldParam, inducing field param [|B|, Inc, Dec]
+        :param array: Rp, nP x 3 x 3 rotations into the frame of each
+                      prism [Optional]
+        :param array: ind, indices of the receivers seeing the
+                      magnetization, if the inducing field varies [Optional]
+
+        OUTPUT
+        :param array: M, nP-by-3 magnetization, or nP x nB x 3 magnetization
+                      seen by each receiver if the inducing field varies
+    """
+
+    H, mind = inducingField(srcFieldParam)
+    mrem = MathUtils.dipazm_2_xyz(rinc, rdec)
+
+    if np.ndim(H) > 0:
+
+        if ind is not None:
+            H, mind = H[ind], mind[ind]
+
+        M = (susc[:, None] * H[None, :])[:, :, None] * (
+            mind[None, :, :] + (Q[:, None] * mrem)[:, None, :]
+        )
+
+    else:
+        M = (susc * H)[:, None] * (mind[None, :] + Q[:, None] * mrem)
+
+    if Rp is not None:
+        M = np.einsum('pij,p...j->p...i', Rp, M)
+
+    return M
+
+
+def prismOperator(
+    rxLoc, centers, sizes, pinc=0., pdec=0., blockSize=1e+6, farRatio=None
+):
+    """
+        Linear operator of a collection of rotated prisms, mapping the
+        magnetization of each prism to the fields at the receivers, both
+        in the global frame.
+
+        INPUT
+        :param array: rxLoc, nD-by-3 array of observation locations
+        :param array: centers, nP-by-3 array of prism centers
+        :param array: sizes, nP-by-3 array of prism dimensions [dx, dy, dz]
+        :param array: pinc, pdec, value or nP array of prism orientations
+        :param int: blockSize, maximum number of receiver-prism pairs
+                    evaluated at once
+        :param float: farRatio, distance to diagonal ratio beyond which the
+                      prisms are approximated by dipoles (prismBlockTensor)
+
+        OUTPUT
+        :param array: G, [3*nD, 3*nP] operator ordered as [bx, by, bz]
+                      along rows and [Mx, My, Mz] along columns
+    """
+
+    rxLoc = np.atleast_2d(rxLoc)
+    centers = np.atleast_2d(np.asarray(centers, dtype=float))
+    sizes = np.atleast_2d(np.asarray(sizes, dtype=float))
+
+    nP = centers.shape[0]
+    ndata = rxLoc.shape[0]
+
+    pinc, pdec = [
+        np.ones(nP) * np.asarray(val, dtype=float) for val in [pinc, pdec]
+    ]
+
+    # Rotations to and from the frame of each prism
+    Rp = MathUtils.rotationMatrix(-pinc, -pdec, normal=False)
+    Rb = MathUtils.rotationMatrix(pinc, pdec)
+
+    G = np.zeros((3, ndata, 3, nP))
+    nB = int(np.max([blockSize // nP, 1]))
+    for start in range(0, ndata, nB):
+
+        ind = np.arange(start, np.min([start + nB, ndata]))
+
+        txx, txy, txz, tyy, tyz, tzz = prismBlockTensor(
+            rxLoc[None, ind, :], centers, sizes, Rp, farRatio=farRatio
+        )
+
+        # Tensor in the frame of each prism [nP x nB x 3 x 3]
+        T = np.stack([
+            np.stack([txx, txy, txz], axis=-1),
+            np.stack([txy, tyy, tyz], axis=-1),
+            np.stack([txz, tyz, tzz], axis=-1)
+        ], axis=-2)
+
+        # Rotate the magnetization in, and the fields out of each prism
+        A = np.einsum('pij,pbjk,pkl->iblp', Rb, T, Rp)
+
+        G[:, ind, :, :] = A / 1e-9 * mu_0
+
+    return G.reshape((3*ndata, 3*nP))
+
+
+def prismResponse(
+    rxLoc, params, srcFieldParam=np.r_[50000, 90, 0], uType='tf',
+    blockSize=1e+6, farRatio=None
+):
+    """
+        Magnetic response of each prism of a collection, described by the
+        parameters listed in prismParameters. Unlike prismFields, the
+        fields are not summed over the prisms, and each prism can be
+        observed at its own set of receivers.
+
+        INPUT
+        :param array: rxLoc, nD-by-3 array of observation locations, or
+                      nP x nD x 3 array of locations for each prism
+        :param array: params, nP-by-12 array of prism parameters
+        :param array: srcFieldParam, inducing field param [|B|, Inc, Dec],
+                      each a value or an nD array (see inducingField)
+        :param string: uType, 'tf' | 'bx' | 'by' | 'bz'
+        :param int: blockSize, maximum number of receiver-prism pairs
+                    evaluated at once
+        :param float: farRatio, distance to diagonal ratio beyond which the
+                      prisms are approximated by dipoles (prismBlockTensor)
+
+        OUTPUT
+        :param array: u, nP-by-nD array of fields of each prism [nT]
+    """
+
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    x0, y0, z0, dx, dy, dz, pinc, pdec, susc, Q, rinc, rdec = params.T
+
+    rxLoc = np.asarray(rxLoc, dtype=float)
+    if rxLoc.ndim == 2:
+        rxLoc = rxLoc[None, :, :]
+
+    nP = params.shape[0]
+    ndata = rxLoc.shape[1]
+
+    # Top of the prism at z0, as in Simulator.definePrism
+    centers = np.c_[x0, y0, z0 - dz / 2.]
+    sizes = np.abs(np.c_[dx, dy, dz])
+
+    Rp = MathUtils.rotationMatrix(-pinc, -pdec, normal=False)
+    Rb = MathUtils.rotationMatrix(pinc, pdec)
+
+    variable = np.ndim(inducingField(srcFieldParam)[0]) > 0
+
+    if not variable:
+        M = prismMagnetization(susc, Q, rinc, rdec, srcFieldParam, Rp=Rp)
+
+    bvec = np.zeros((nP, ndata, 3))
+    nB = int(np.max([blockSize // nP, 1]))
+    for start in range(0, ndata, nB):
+
+        ind = np.arange(start, np.min([start + nB, ndata]))
+
+        if variable:
+            M = prismMagnetization(
+                susc, Q, rinc, rdec, srcFieldParam, Rp=Rp, ind=ind
+            )
+
+        b = prismBlockFields(
+            rxLoc[:, ind, :], centers, sizes, Rp, M, farRatio=farRatio
+        )
+
+        bvec[:, ind, :] = np.einsum('pij,pjb->pbi', Rb, b) / 1e-9 * mu_0
+
+    return projectFields(bvec, uType, srcFieldParam)
+
+
+def prismJacobian(
+    rxLoc, params, active=None, srcFieldParam=np.r_[50000, 90, 0],
+    uType='tf', blockSize=1e+6
+):
+    """
+        Sensitivity of the response of each prism to its parameters,
+        computed by central differences. The perturbed prisms of all
+        parameters are evaluated together in a single call to
+        prismResponse.
+
+        INPUT
+        :param array: rxLoc, nD-by-3 or nP x nD x 3 array of locations
+        :param array: params, nP-by-12 array of prism parameters
+        :param list: active, names of the parameters in prismParameters
+                     [Default: all]
+
+        OUTPUT
+        :param array: J, nP x nD x nA array of derivatives of the fields
+                      with respect to the nA active parameters
+    """
+
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+
+    if active is None:
+        active = prismParameters
+
+    col = [prismParameters.index(name) for name in active]
+    nP, nA = params.shape[0], len(col)
+
+    # Steps relative to the size of the prism for lengths, in degrees
+    # for the angles, and to the value for susceptibility and Q
+    length = np.abs(params[:, 3:6]).mean(axis=1)
+    scale = np.c_[
+        np.outer(length, np.ones(6)), np.ones((nP, 2)) * 90.,
+        np.maximum(np.abs(params[:, 8]), 1e-3),
+        np.maximum(np.abs(params[:, 9]), 1.),
+        np.ones((nP, 2)) * 90.
+    ]
+    step = 1e-4 * scale[:, col]
+
+    # Perturbed prisms ordered as [prism, parameter, +/-]
+    perturbed = np.repeat(params[:, None, None, :], nA, axis=1)
+    perturbed = np.repeat(perturbed, 2, axis=2)
+    for ii, jj in enumerate(col):
+        perturbed[:, ii, 0, jj] += step[:, ii]
+        perturbed[:, ii, 1, jj] -= step[:, ii]
+
+    rxLoc = np.asarray(rxLoc, dtype=float)
+    if rxLoc.ndim == 3:
+        rxLoc = np.repeat(rxLoc, 2 * nA, axis=0)
+
+    u = prismResponse(
+        rxLoc, perturbed.reshape((-1, params.shape[1])),
+        srcFieldParam=srcFieldParam, uType=uType, blockSize=blockSize
+    )
+    u = u.reshape((nP, nA, 2, -1))
+
+    J = (u[:, :, 0, :] - u[:, :, 1, :]) / (2. * step[:, :, None])
+
+    return np.transpose(J, (0, 2, 1))
+
+
+def fitPrisms(
+    rxLoc, data, params0, active=None, std=None,
+    srcFieldParam=np.r_[50000, 90, 0], uType='tf', lower=None, upper=None,
+    maxIter=50, tol=1e-6, n_workers=1, blockSize=1e+6
+):
+    """
+        Least-squares fit of prisms to a collection of anomalies, by
+        Levenberg-Marquardt iterations. All anomalies are fitted together:
+        each iteration computes the Jacobians and trial steps of every
+        anomaly not yet converged in one vectorized pass.
+
+        Profiles of different lengths can be padded to the same number
+        of points, with an infinite std on the padding.
+
+        INPUT
+        :param array: rxLoc, nD-by-3 array of locations shared by all
+                      anomalies, or nA x nD x 3 array for each anomaly
+        :param array: data, nA-by-nD array of observed anomalies [nT]
+        :param array: params0, nA-by-12 array of starting parameters
+        :param list: active, names of the parameters to fit
+                     [Default: all of prismParameters]
+        :param array: std, value or nA-by-nD array of uncertainties,
+                      unit weights are used where std <= 0
+        :param array: srcFieldParam, inducing field param [|B|, Inc, Dec]
+        :param string: uType, 'tf' | 'bx' | 'by' | 'bz'
+        :param array: lower, upper, bounds on the 12 parameters
+                      [Default: positive dimensions and Q]
+        :param int: maxIter, maximum number of iterations
+        :param float: tol, relative decrease of the misfit at convergence
+        :param int: n_workers, number of processes sharing the anomalies
+
+        OUTPUT
+        :param array: params, nA-by-12 array of fitted parameters
+        :param dict: stats, 'converged', 'iterations', 'rms0' and 'rms'
+                     (weighted root mean square misfit) of each anomaly
+    """
+
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    params0 = np.atleast_2d(np.asarray(params0, dtype=float))
+    rxLoc = np.asarray(rxLoc, dtype=float)
+
+    nS = data.shape[0]
+
+    if rxLoc.ndim == 2:
+        rxLoc = np.repeat(rxLoc[None, :, :], nS, axis=0)
+
+    if std is None:
+        std = 1.
+
+    std = np.ones_like(data) * std
+
+    # Missing uncertainties (e.g. zeros of readMagneticsObservations)
+    if np.any(~(std > 0)):
+        print(
+            "Found " + str(np.sum(~(std > 0))) + " std <= 0. " +
+            "Using unit weights for these data"
+        )
+        std = np.where(std > 0, std, 1.)
+
+    kwargs = {
+        'active': active, 'srcFieldParam': srcFieldParam, 'uType': uType,
+        'lower': lower, 'upper': upper, 'maxIter': maxIter, 'tol': tol,
+        'blockSize': blockSize
+    }
+
+    if n_workers > 1 and nS > 1:
+
+        chunks = np.array_split(np.arange(nS), np.min([n_workers, nS]))
+
+        with Pool(len(chunks)) as pool:
+            results = pool.map(
+                _fitPrismsChunk, [
+                    (rxLoc[ind], data[ind], params0[ind], std[ind], kwargs)
+                    for ind in chunks
+                ]
+            )
+
+        params = np.vstack([result[0] for result in results])
+        stats = {
+            key: np.concatenate([result[1][key] for result in results])
+            for key in results[0][1]
+        }
+
+        return params, stats
+
+    return _fitPrismsChunk((rxLoc, data, params0, std, kwargs))
+
+
+def _fitPrismsChunk(args):
+    """
+        Levenberg-Marquardt iterations on a chunk of anomalies
+    """
+
+    rxLoc, data, params, std, kwargs = args
+
+    active = kwargs['active']
+    if active is None:
+        active = prismParameters
+
+    col = [prismParameters.index(name) for name in active]
+
+    lower, upper = kwargs['lower'], kwargs['upper']
+    if lower is None:
+        lower = np.r_[[-np.inf] * 3, [0.] * 3, [-np.inf] * 3, 0., [-np.inf] * 2]
+    if upper is None:
+        upper = np.ones(len(prismParameters)) * np.inf
+
+    lower, upper = np.asarray(lower), np.asarray(upper)
+
+    fwrArgs = {
+        'srcFieldParam': kwargs['srcFieldParam'], 'uType': kwargs['uType'],
+        'blockSize': kwargs['blockSize']
+    }
+
+    nS = data.shape[0]
+    params = np.clip(params.copy(), lower, upper)
+    weights = 1. / std
+    nD = np.sum(weights > 0, axis=1)
+
+    def residual(ind, params):
+        r = data[ind] - prismResponse(rxLoc[ind], params, **fwrArgs)
+        return np.where(weights[ind] > 0, r * weights[ind], 0.)
+
+    r = residual(np.arange(nS), params)
+    phi = np.sum(r**2., axis=1)
+    phi0 = phi.copy()
+
+    lam = np.ones(nS) * 1e-2
+    converged = np.zeros(nS, dtype=bool)
+    stalled = np.zeros(nS, dtype=bool)
+    iterations = np.zeros(nS, dtype=int)
+
+    for ii in range(kwargs['maxIter']):
+
+        ind = np.where(~converged & ~stalled)[0]
+
+        if len(ind) == 0:
+            break
+
+        J = prismJacobian(
+            rxLoc[ind], params[ind], active=active, **fwrArgs
+        ) * weights[ind, :, None]
+
+        # Damped normal equations, scaled by the diagonal of J'J
+        JtJ = np.einsum('sdi,sdj->sij', J, J)
+        Jtr = np.einsum('sdi,sd->si', J, r[ind])
+
+        diag = np.einsum('sii->si', JtJ)
+        diag = np.maximum(diag, 1e-12 * diag.max(axis=1, keepdims=True))
+
+        A = JtJ + lam[ind, None, None] * (
+            diag[:, :, None] * np.eye(len(col))[None, :, :]
+        )
+        dm = np.linalg.solve(A, Jtr[:, :, None])[:, :, 0]
+
+        trial = params[ind].copy()
+        trial[:, col] += dm
+        trial = np.clip(trial, lower, upper)
+
+        rt = residual(ind, trial)
+        phit = np.sum(rt**2., axis=1)
+
+        iterations[ind] += 1
+
+        accept = phit < phi[ind]
+        decrease = (phi[ind] - phit) <= kwargs['tol'] * phi[ind]
+
+        converged[ind[accept & decrease]] = True
+
+        acc = ind[accept]
+        params[acc], r[acc], phi[acc] = trial[accept], rt[accept], phit[accept]
+
+        lam[acc] /= 10.
+        lam[ind[~accept]] *= 10.
+
+        # Steps no longer decrease the misfit
+        stalled[ind[~accept]] = lam[ind[~accept]] > 1e+8
+
+    # A perfect fit cannot decrease further
+    converged |= phi <= 1e-20 * phi0
+
+    # No convergence without a finite misfit
+    converged &= np.isfinite(phi)
+
+    stats = {
+        'converged': converged,
+        'iterations': iterations,
+        'rms0': np.sqrt(phi0 / nD),
+        'rms': np.sqrt(phi / nD)
+    }
+
+    return params, stats
+
+
+def geometryKey(*arrays):
+    """
+        Hash of a list of arrays (geometry, receivers, orientations),
+        used as key in the operatorCache
+    """
 
-        Remnance:
-            - Q : Koenigsberger ratio
-            - Rinc, Rdec : inclination and declination of remnance in block
+    key = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=float)
+        key.update(str(array.shape).encode())
+        key.update(array.tobytes())
+
+    return key.hexdigest()
 
+
+class OperatorCache(object):
     """
-    #Bdec, Binc, Bigrf = 90., 0., 50000.
-    Q, rinc, rdec = 0., 0., 0.
-    uType, mType = 'tf', 'induced'
-    susc = 1.
-    prism = None
-    survey = None
+        Least-recently-used cache of dense forward operators, shared by
+        all Problem instances and keyed by a hash of the geometry and
+        receiver locations (see geometryKey).
+
+        Operators are stored read-only. The least recently used ones are
+        dropped once the total size exceeds maxBytes.
+    """
+
+    maxBytes = 1e+9
 
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+        self.operators = OrderedDict()
+        self.hits, self.misses = 0, 0
+
         return
 
     @property
-    def Mind(self):
-        # Define magnetization direction as sum of induced and remanence
-        mind = MathUtils.dipazm_2_xyz(self.Hinc, self.Hdec)
-        R = MathUtils.rotationMatrix(-self.prism.pinc, -self.prism.pdec, normal=False)
-        Mind = self.susc*self.Higrf*R.dot(mind.T)
-        # Mind = self.susc*self.Higrf*PF.Magnetics.dipazm_2_xyz(self.Binc - self.prism.pinc,
-        #                                                self.Bdec - self.prism.pdec)
-        return Mind
+    def nbytes(self):
+        return int(np.sum([G.nbytes for G in self.operators.values()]))
 
-    @property
-    def Mrem(self):
+    def get(self, key, builder):
+        """
+            Return the operator stored under key, or build it with
+            builder() and store it
+        """
 
-        mrem = MathUtils.dipazm_2_xyz(self.rinc, self.rdec)
-        R = MathUtils.rotationMatrix(-self.prism.pinc, -self.prism.pdec, normal=False)
-        Mrem = self.Q*self.susc*self.Higrf * R.dot(mrem.T)
+        if key in self.operators:
+            self.hits += 1
+            self.operators.move_to_end(key)
 
-        return Mrem
+            return self.operators[key]
 
-    @property
-    def Higrf(self):
+        self.misses += 1
+        G = builder()
 
-        if getattr(self, '_Higrf', None) is None:
-            self._Higrf = self.survey.srcFieldParam[0]
+        if G.nbytes <= self.maxBytes:
+            G.flags.writeable = False
+            self.operators[key] = G
 
-        return self._Higrf * 1e-9 / mu_0
+            while self.nbytes > self.maxBytes:
+                self.operators.popitem(last=False)
 
-    @property
-    def Hinc(self):
+        return G
 
-        if getattr(self, '_Hinc', None) is None:
-            self._Hinc = self.survey.srcFieldParam[1]
+    def clear(self):
+        self.operators.clear()
+        self.hits, self.misses = 0, 0
 
-        return self._Hinc
 
-    @property
-    def Hdec(self):
+operatorCache = OperatorCache()
 
-        if getattr(self, '_Hdec', None) is None:
-            self._Hdec = self.survey.srcFieldParam[2]
 
-        return self._Hdec
+class SensitivityStore(object):
+    """
+        Disk-backed store of the forward operators of Intrgl_Fwr_Op, kept
+        across sessions.
+
+        Each operator is saved in a folder of path named by a hash of the
+        mesh and of the options changing the sensitivities (flag, gradient,
+        srcFieldParam, M and precision). The rows of each chunk of chunkSize
+        receivers are saved as a .npy file named by a hash of its
+        receivers, and listed in the header.json of the folder with its
+        size, checksum and time of last use. Chunks are memory-mapped when reused, so that only
+        the chunks of new receivers are computed when part of a survey
+        changes.
+
+        A chunk failing the integrity checks (size, shape, and the sha1
+        checksum if verify=True) is computed again. The least recently used
+        chunks of all operators in path are deleted once their total size
+        exceeds maxBytes.
+
+        A store can be shared by several processes: the headers are only
+        read and written, and chunks evicted, while holding the lock file
+        of the store. Chunks are computed outside of the lock.
+    """
 
-    @property
-    def G(self):
+    path = os.path.join(os.path.expanduser('~'), '.GeoToolkit', 'sensitivity')
+    maxBytes = 1e+10
+    chunkSize = 1000
+    verify = True
 
-        if getattr(self, '_G', None) is None:
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
 
-            rxLoc = self.survey.rxLoc
+        self.hits, self.misses = 0, 0
 
-            xLoc = rxLoc[:, 0] - self.prism.xc
-            yLoc = rxLoc[:, 1] - self.prism.yc
-            zLoc = rxLoc[:, 2] - self.prism.zc
+        return
 
-            R = MathUtils.rotationMatrix(-self.prism.pinc, -self.prism.pdec, normal=False)
+    def operator(self, xn, yn, zn, rxLoc, **kwargs):
+        """
+            Map the operator of Intrgl_Fwr_Op(xn, yn, zn, rxLoc, **kwargs)
+            from the store, computing and saving the missing chunks.
 
-            rxLoc = R.dot(np.c_[xLoc, yLoc, zLoc].T).T
+            OUTPUT
+            :param object: G, StoredOperator on the memory-mapped chunks
+        """
 
-            rxLoc = np.c_[rxLoc[:, 0] + self.prism.xc, rxLoc[:, 1] + self.prism.yc, rxLoc[:, 2] + self.prism.zc]
+        flag = kwargs.get('flag', 'full')
+        gradient = kwargs.get('gradient', False)
+        srcFieldParam = kwargs.get('srcFieldParam', np.r_[50000, 90, 0])
+        M = kwargs.get('M', None)
+        precision = kwargs.get('precision', 'float64')
+
+        # A field varying per receiver is saved with the chunks instead
+        variable = flag == 'ind' and np.ndim(inducingField(srcFieldParam)[0]) > 0
+        ndata = rxLoc.shape[0]
+
+        if variable:
+            srcFieldParam = np.broadcast_arrays(
+                *[np.asarray(val, dtype=float) for val in srcFieldParam[:3]]
+                + [np.zeros(ndata)]
+            )[:3]
+
+        key = geometryKey(
+            xn, yn, zn, ['full', 'ind'].index(flag), gradient,
+            -2 if variable else (srcFieldParam if flag == 'ind' else 0),
+            -1 if (M is None or flag == 'full') else M,
+            precision == 'float32'
+        )
+
+        folder = os.path.join(self.path, key)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        # Chunks of the receivers, and their options
+        names, options = [], []
+        for start in range(0, ndata, int(self.chunkSize)):
+
+            stop = np.min([start + int(self.chunkSize), ndata])
+
+            if variable:
+                field = [val[start:stop] for val in srcFieldParam]
+                options += [(start, stop, dict(kwargs, srcFieldParam=field))]
+                names += [geometryKey(rxLoc[start:stop, :], *field)]
+            else:
+                options += [(start, stop, kwargs)]
+                names += [geometryKey(rxLoc[start:stop, :])]
+
+        # Map the saved chunks
+        with self.lock():
+            header = self.readHeader(folder)
+            chunks = [
+                self.loadChunk(folder, header, name, precision)
+                for name in names
+            ]
+
+        # Compute the missing chunks, without holding the lock
+        entries = {}
+        for ii, (start, stop, option) in enumerate(options):
+
+            if chunks[ii] is not None:
+                self.hits += 1
+                continue
+
+            self.misses += 1
+            chunks[ii], entries[names[ii]] = self.saveChunk(
+                folder, names[ii],
+                Intrgl_Fwr_Op(xn, yn, zn, rxLoc[start:stop, :], **option)
+            )
+
+        # Update the header as left by other processes, then evict
+        with self.lock():
+            header = self.readHeader(folder)
+            header['mesh'] = [len(xn) - 1, len(yn) - 1, len(zn) - 1]
+            header['flag'], header['gradient'] = flag, bool(gradient)
+            header['precision'] = precision
+            header['chunks'].update(entries)
+
+            for name in names:
+                if name in header['chunks']:
+                    header['chunks'][name]['lastUsed'] = time.time()
+
+            self.writeHeader(folder, header)
+            self.evict(keep=[(folder, name) for name in names])
+
+        return StoredOperator(chunks, ndata)
+
+    @contextmanager
+    def lock(self, timeout=600.):
+        """
+            Lock file of the store, held while reading and writing the
+            headers, so that processes sharing the store (e.g. the
+            workers of tiledFields) do not overwrite each other's updates.
+            A lock older than timeout [s] is considered left by a dead
+            process and taken over.
+        """
 
-            # Create the linear forward system
-            self._G = Intrgl_Fwr_Op(self.prism.xn, self.prism.yn, self.prism.zn, rxLoc)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
 
-        return self._G
+        fileName = os.path.join(self.path, '.lock')
+        tic = time.time()
 
-    def fields(self):
+        while True:
+            try:
+                fid = os.open(fileName, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fid)
+                break
+            except FileExistsError:
+                try:
+                    stale = time.time() - os.path.getmtime(fileName) > timeout
+                except OSError:
+                    stale = False
 
-        if (self.mType == 'induced') or (self.mType == 'total'):
+                if stale or time.time() - tic > timeout:
+                    warnings.warn("Lock of " + self.path + " taken over")
+                    break
 
-            b = self.G.dot(self.Mind)
-            self.fieldi = self.extractFields(b)
+                time.sleep(0.01)
 
-        if (self.mType == 'remanent') or (self.mType == 'total'):
+        try:
+            yield
+        finally:
+            if os.path.exists(fileName):
+                os.remove(fileName)
 
-            b = self.G.dot(self.Mrem)
+    def readHeader(self, folder):
+        """
+            Read the header of an operator. A corrupted header is reset,
+            and the chunks of the folder deleted, so that the operator is
+            computed again
+        """
 
-            self.fieldr = self.extractFields(b)
+        fileName = os.path.join(folder, 'header.json')
+        if not os.path.exists(fileName):
+            return {'chunks': {}}
 
-        if self.mType == 'induced':
-            return [self.fieldi]
-        elif self.mType == 'remanent':
-            return [self.fieldr]
-        elif self.mType == 'total':
-            return [self.fieldi, self.fieldr]
+        try:
+            with open(fileName, 'r') as f:
+                header = json.load(f)
 
-    def extractFields(self, bvec):
+            if not isinstance(header['chunks'], dict):
+                raise ValueError("Chunks of the header must be a dict")
 
-        nD = int(bvec.shape[0]/3)
-        bvec = np.reshape(bvec, (3, nD))
+            return header
 
-        R = MathUtils.rotationMatrix(self.prism.pinc, self.prism.pdec)
-        bvec = R.dot(bvec)
+        except (ValueError, KeyError, TypeError):
+            warnings.warn(
+                "Corrupted header in " + folder + ", operator rebuilt"
+            )
 
-        if self.uType == 'bx':
-            u = bvec[0, :].flatten()
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
 
-        if self.uType == 'by':
-            u = bvec[1, :].flatten()
+        return {'chunks': {}}
 
-        if self.uType == 'bz':
-            u = bvec[2, :].flatten()
+    def writeHeader(self, folder, header):
 
-        if self.uType == 'tf':
-            # Projection matrix
-            Ptmi = MathUtils.dipazm_2_xyz(self.Hinc,
-                                         self.Hdec)
+        # Write and rename, so that the header is never left incomplete
+        fileName = os.path.join(folder, 'header.json')
+        with open(fileName + '.tmp', 'w') as f:
+            json.dump(header, f, indent=1)
 
-            u = Ptmi.dot(bvec).flatten()
+        os.replace(fileName + '.tmp', fileName)
 
-        return u
+    def loadChunk(self, folder, header, name, precision='float64'):
+        """
+            Memory-map a chunk after checking its integrity, or return None
+        """
 
+        if name not in header['chunks']:
+            return None
+
+        entry = header['chunks'][name]
+        fileName = os.path.join(folder, name + '.npy')
+
+        if (
+            not os.path.exists(fileName) or
+            os.path.getsize(fileName) != entry['nbytes'] or
+            (self.verify and fileChecksum(fileName) != entry['sha1'])
+        ):
+            del header['chunks'][name]
+            return None
+
+        try:
+            G = np.load(fileName, mmap_mode='r')
+        except ValueError:
+            del header['chunks'][name]
+            return None
+
+        if list(G.shape) != entry['shape'] or G.dtype != np.dtype(precision):
+            del header['chunks'][name]
+            return None
+
+        return G
+
+    def saveChunk(self, folder, name, G):
+        """
+            Save a chunk, then memory-map it
+
+            OUTPUT
+            :param array: G, memory-mapped chunk
+            :param dict: entry, description of the chunk for the header
+        """
+
+        fileName = os.path.join(folder, name + '.npy')
+
+        # Temporary file of this process, renamed once complete
+        tmpName = fileName + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpName, 'wb') as f:
+            np.save(f, G)
+
+        entry = {
+            'shape': list(G.shape),
+            'nbytes': os.path.getsize(tmpName),
+            'sha1': fileChecksum(tmpName),
+            'lastUsed': time.time()
+        }
+
+        os.replace(tmpName, fileName)
+
+        return np.load(fileName, mmap_mode='r'), entry
+
+    @property
+    def nbytes(self):
+        return int(np.sum([
+            entry['nbytes'] for folder, name, entry in self.entries()
+        ]))
+
+    def entries(self):
+        """
+            List the chunks of all operators in path
+        """
+
+        if not os.path.exists(self.path):
+            return []
+
+        entries = []
+        for key in os.listdir(self.path):
+            folder = os.path.join(self.path, key)
+            if os.path.isdir(folder):
+                header = self.readHeader(folder)
+                entries += [
+                    (folder, name, entry)
+                    for name, entry in header['chunks'].items()
+                ]
+
+        return entries
+
+    def evict(self, keep=None):
+        """
+            Delete the least recently used chunks, except those in keep,
+            until the store fits in maxBytes. Called with the lock held.
+        """
+
+        if keep is None:
+            keep = []
+
+        entries = sorted(
+            self.entries(), key=lambda entry: entry[2]['lastUsed']
+        )
+
+        nbytes = np.sum([entry['nbytes'] for folder, name, entry in entries])
 
-def Intrgl_Fwr_Op(xn, yn, zn, rxLoc):
+        for folder, name, entry in entries:
 
+            if nbytes <= self.maxBytes:
+                break
+
+            if (folder, name) in keep:
+                continue
+
+            header = self.readHeader(folder)
+            del header['chunks'][name]
+            self.writeHeader(folder, header)
+
+            fileName = os.path.join(folder, name + '.npy')
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+            nbytes -= entry['nbytes']
+
+    def clear(self):
+        """
+            Delete all operators of the store
+        """
+
+        self.hits, self.misses = 0, 0
+
+        if not os.path.isdir(self.path):
+            return
+
+        with self.lock():
+            for folder, name, entry in self.entries():
+                fileName = os.path.join(folder, name + '.npy')
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+
+            for key in os.listdir(self.path):
+                fileName = os.path.join(self.path, key, 'header.json')
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+                    os.rmdir(os.path.join(self.path, key))
+
+
+def fileChecksum(fileName, blockSize=2**24):
+    """
+        sha1 checksum of a file, read by blocks
     """
 
-    Magnetic forward operator in integral form
+    key = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            key.update(block)
 
-    flag        = 'ind' | 'full'
+    return key.hexdigest()
 
-      1- ind : Magnetization fixed by user
 
-      3- full: Full tensor matrix stored with shape([3*ndata, 3*nc])
+class StoredOperator(LinearOperator):
+    """
+        Forward operator assembled from chunks of rows of Intrgl_Fwr_Op,
+        each for a consecutive block of receivers (see SensitivityStore)
 
-    Return
-    _G = Linear forward modeling operation
+        INPUT
+        :param list: chunks, arrays of the rows of each block of receivers
+        :param int: nD, total number of receivers
+    """
 
-     """
+    def __init__(self, chunks, nD):
 
-    yn2, xn2, zn2 = np.meshgrid(yn[1:], xn[1:], zn[1:])
-    yn1, xn1, zn1 = np.meshgrid(yn[0:-1], xn[0:-1], zn[0:-1])
+        self.chunks = chunks
+        self.nD = nD
 
-    Yn = np.c_[yn1.flatten(), yn2.flatten()]
-    Xn = np.c_[xn1.flatten(), xn2.flatten()]
-    Zn = np.c_[zn1.flatten(), zn2.flatten()]
+        # Receivers of each chunk
+        nRx = [chunk.shape[0] for chunk in chunks]
+        self.nRows = int(np.sum(nRx) // nD)
+        self.limits = np.r_[0, np.cumsum(nRx) // self.nRows]
 
-    ndata = rxLoc.shape[0]
+        super(StoredOperator, self).__init__(
+            dtype=np.dtype(float),
+            shape=(int(self.nRows * nD), int(chunks[0].shape[1]))
+        )
 
-    # Pre-allocate forward matrix
-    G = np.zeros((int(3*ndata), 3))
+    def _matmat(self, m):
 
-    for ii in range(ndata):
+        d = np.zeros((self.shape[0], m.shape[1]))
+        for chunk, start, stop in zip(
+            self.chunks, self.limits[:-1], self.limits[1:]
+        ):
+            nb = stop - start
+            for ii in range(self.nRows):
+                d[start + ii*self.nD:stop + ii*self.nD, :] = (
+                    chunk[ii*nb:(ii+1)*nb, :].dot(m)
+                )
 
-        tx, ty, tz = calcRow(Xn, Yn, Zn, rxLoc[ii, :])
+        return d
 
-        G[ii, :] = tx / 1e-9 * mu_0
-        G[ii+ndata, :] = ty / 1e-9 * mu_0
-        G[ii+2*ndata, :] = tz / 1e-9 * mu_0
+    def _matvec(self, m):
+        return self._matmat(np.reshape(m, (-1, 1))).flatten()
 
-    return G
+    def _rmatmat(self, d):
+
+        m = np.zeros((self.shape[1], d.shape[1]))
+        for chunk, start, stop in zip(
+            self.chunks, self.limits[:-1], self.limits[1:]
+        ):
+            nb = stop - start
+            for ii in range(self.nRows):
+                m += chunk[ii*nb:(ii+1)*nb, :].T.dot(
+                    d[start + ii*self.nD:stop + ii*self.nD, :]
+                )
+
+        return m
+
+    def _rmatvec(self, d):
+        return self._rmatmat(np.reshape(d, (-1, 1))).flatten()
+
+    def _adjoint(self):
+        return _AdjointForwardOperator(self)
 
 
 def createMagSurvey(xyz, EarthField=np.r_[50000, 90, 0], data=None):
@@ -189,6 +2517,8 @@ def createMagSurvey(xyz, EarthField=np.r_[50000, 90, 0], data=None):
         INPUT
         :param array: xyz, n-by-4 array of observation locations
         :param array: EarthField [Default 50000,90,0], 1-by-3 array of inducing field param [|B|, Inc, Dec]
+                      each parameter can be an n array of values at each
+                      receiver, for a field varying across the survey
 
         OPTIONAL
         :param array: data, n-by-4 array of data
@@ -280,8 +2610,7 @@ def calcRow(Xn, Yn, Zn, rxLoc):
 
     where each elements have dimension 1-by-nC.
     Only the upper half 5 elements have to be computed since symetric.
-    Currently done as for-loops but will eventually be changed to vector
-    indexing, once the topography has been figured out.
+    The computations are done by calcRows on a block of one location.
 
     Created on Oct, 20th 2015
 
@@ -289,23 +2618,136 @@ def calcRow(Xn, Yn, Zn, rxLoc):
 
      """
 
-    eps = 1e-8  # add a small value to the locations to avoid /0
+    return calcRows(Xn, Yn, Zn, np.reshape(rxLoc, (1, 3)))
 
-    nC = Xn.shape[0]
 
-    # Pre-allocate space for 1D array
-    Tx = np.zeros((1, 3*nC))
-    Ty = np.zeros((1, 3*nC))
-    Tz = np.zeros((1, 3*nC))
+def calcRows(
+    Xn, Yn, Zn, rxLoc, backend=None, gradient=False, precision='float64'
+):
+    """
+    Vectorized version of calcRow for a block of observation locations.
+    All receiver-cell pairs are evaluated at once, so the memory used
+    scales with nB*nC.
+
+    INPUT:
+    Xn, Yn, Zn: Node location matrix for the lower and upper most corners of
+                all cells in the mesh shape[nC,2]
+    rxLoc: Observation locations shape[nB,3]
+    backend: Kernel implementation 'numpy' | 'numba'
+             [Default: None, as set by setKernelBackend]
+    gradient: Also return the rows of the gradient tensor
+              (only computed by the 'numpy' backend)
+    precision: 'float64' | 'float32' (only computed by the 'numpy'
+               backend), see calcTensor
+
+    OUTPUT:
+    Tx = [Txx Txy Txz]
+    Ty = [Tyx Tyy Tyz]
+    Tz = [Tzx Tzy Tzz]
+
+    and if gradient=True
+    Txx = [Txxx Txxy Txxz], Txy = [Txyx Txyy Txyz], Txz = [Txzx Txzy Txzz]
+    Tyy = [Tyyx Tyyy Tyyz], Tyz = [Tyzx Tyzy Tyzz], Tzz = [Tzzx Tzzy Tzzz]
+
+    where each elements have dimension nB-by-nC.
+
+    """
+
+    rxLoc = np.atleast_2d(rxLoc)
+
+    if backend is None:
+        backend = kernel['backend']
+
+    if (
+        backend == 'numba' and njit is not None and not gradient and
+        precision == 'float64'
+    ):
+
+        nC = Xn.shape[0]
+        Tx = np.empty((rxLoc.shape[0], 3*nC))
+        Ty = np.empty((rxLoc.shape[0], 3*nC))
+        Tz = np.empty((rxLoc.shape[0], 3*nC))
+
+        calcRowsJit(
+            np.ascontiguousarray(Xn, dtype=float),
+            np.ascontiguousarray(Yn, dtype=float),
+            np.ascontiguousarray(Zn, dtype=float),
+            np.ascontiguousarray(rxLoc, dtype=float),
+            Tx, Ty, Tz
+        )
+
+        return Tx, Ty, Tz
+
+    # Distances from the observation locations (rows) to the nodes (columns)
+    dx1 = Xn[:, 0] - rxLoc[:, 0:1]
+    dx2 = Xn[:, 1] - rxLoc[:, 0:1]
+    dy1 = Yn[:, 0] - rxLoc[:, 1:2]
+    dy2 = Yn[:, 1] - rxLoc[:, 1:2]
+    dz1 = Zn[:, 0] - rxLoc[:, 2:3]
+    dz2 = Zn[:, 1] - rxLoc[:, 2:3]
+
+    T = calcTensor(
+        dx1, dx2, dy1, dy2, dz1, dz2, gradient=gradient, precision=precision
+    )
+    txx, txy, txz, tyy, tyz, tzz = T[:6]
+
+    Tx = np.hstack([txx, txy, txz])
+    Ty = np.hstack([txy, tyy, tyz])
+    Tz = np.hstack([txz, tyz, tzz])
+
+    if not gradient:
+        return Tx, Ty, Tz
+
+    txxx, txxy, txxz, txyy, txyz, txzz, tyyy, tyyz, tyzz, tzzz = T[6:]
+
+    return (
+        Tx, Ty, Tz,
+        np.hstack([txxx, txxy, txxz]), np.hstack([txxy, txyy, txyz]),
+        np.hstack([txxz, txyz, txzz]), np.hstack([txyy, tyyy, tyyz]),
+        np.hstack([txyz, tyyz, tyzz]), np.hstack([txzz, tyzz, tzzz])
+    )
+
+
+def calcTensor(
+    dx1, dx2, dy1, dy2, dz1, dz2, gradient=False, precision='float64'
+):
+    """
+    Magnetic tensor of rectangular prisms from the distances between the
+    observation locations and the lower (1) and upper (2) prism faces.
+    All inputs must broadcast to a common shape, which is the shape of
+    each of the outputs.
+
+    OUTPUT:
+    Txx, Txy, Txz, Tyy, Tyz, Tzz
+
+    Only the 5 upper elements are computed, Tzz is obtained from the
+    trace of the tensor.
 
-    dz2 = Zn[:, 1] - rxLoc[2] + eps
-    dz1 = Zn[:, 0] - rxLoc[2] + eps
+    If gradient=True, the derivatives of the tensor with respect to the
+    observation location are appended, computed from the same corner
+    distances:
+    Txxx, Txxy, Txxz, Txyy, Txyz, Txzz, Tyyy, Tyyz, Tyzz, Tzzz
 
-    dy2 = Yn[:, 1] - rxLoc[1] + eps
-    dy1 = Yn[:, 0] - rxLoc[1] + eps
+    The derivatives of the log terms are rational functions of the
+    corners, the remaining components follow from Laplace's equation.
 
-    dx2 = Xn[:, 1] - rxLoc[0] + eps
-    dx1 = Xn[:, 0] - rxLoc[0] + eps
+    All sums are evaluated in double precision, as the alternating corner
+    terms of both the arctan2 and the log sums cancel away from the
+    prisms. If precision='float32', the outputs are only rounded to single
+    precision on return.
+
+    """
+
+    eps = 1e-8  # add a small value to the locations to avoid /0
+
+    dz2 = dz2 + eps
+    dz1 = dz1 + eps
+
+    dy2 = dy2 + eps
+    dy1 = dy1 + eps
+
+    dx2 = dx2 + eps
+    dx1 = dx1 + eps
 
     dx2dx2 = dx2**2.
     dx1dx1 = dx1**2.
@@ -330,7 +2772,7 @@ def calcRow(Xn, Yn, Zn, rxLoc):
     arg7 = np.sqrt(dz1dz1 + R4)
     arg8 = np.sqrt(dz1dz1 + R3)
 
-    Tx[0, 0:nC] = (
+    Txx = (
         np.arctan2(dy1 * dz2, (dx2 * arg5 + eps)) -
         np.arctan2(dy2 * dz2, (dx2 * arg2 + eps)) +
         np.arctan2(dy2 * dz1, (dx2 * arg3 + eps)) -
@@ -341,14 +2783,14 @@ def calcRow(Xn, Yn, Zn, rxLoc):
         np.arctan2(dy2 * dz1, (dx1 * arg4 + eps))
     )
 
-    Ty[0, 0:nC] = (
+    Txy = (
         np.log((dz2 + arg2 + eps) / (dz1 + arg3 + eps)) -
         np.log((dz2 + arg1 + eps) / (dz1 + arg4 + eps)) +
         np.log((dz2 + arg6 + eps) / (dz1 + arg7 + eps)) -
         np.log((dz2 + arg5 + eps) / (dz1 + arg8 + eps))
     )
 
-    Ty[0, nC:2*nC] = (
+    Tyy = (
         np.arctan2(dx1 * dz2, (dy2 * arg1 + eps)) -
         np.arctan2(dx2 * dz2, (dy2 * arg2 + eps)) +
         np.arctan2(dx2 * dz1, (dy2 * arg3 + eps)) -
@@ -364,7 +2806,7 @@ def calcRow(Xn, Yn, Zn, rxLoc):
     R3 = (dy1dy1 + dz1dz1)
     R4 = (dy1dy1 + dz2dz2)
 
-    Ty[0, 2*nC:] = (
+    Tyz = (
         np.log((dx1 + np.sqrt(dx1dx1 + R1) + eps) /
                (dx2 + np.sqrt(dx2dx2 + R1) + eps)) -
         np.log((dx1 + np.sqrt(dx1dx1 + R2) + eps) /
@@ -380,7 +2822,7 @@ def calcRow(Xn, Yn, Zn, rxLoc):
     R3 = (dx1dx1 + dz1dz1)
     R4 = (dx1dx1 + dz2dz2)
 
-    Tx[0, 2*nC:] = (
+    Txz = (
         np.log((dy1 + np.sqrt(dy1dy1 + R1) + eps) /
                (dy2 + np.sqrt(dy2dy2 + R1) + eps)) -
         np.log((dy1 + np.sqrt(dy1dy1 + R2) + eps) /
@@ -391,16 +2833,190 @@ def calcRow(Xn, Yn, Zn, rxLoc):
                (dy2 + np.sqrt(dy2dy2 + R3) + eps))
     )
 
-    Tz[0, 2*nC:] = -(Ty[0, nC:2*nC] + Tx[0, 0:nC])
-    Tz[0, nC:2*nC] = Ty[0, 2*nC:]
-    Tx[0, nC:2*nC] = Ty[0, 0:nC]
-    Tz[0, 0:nC] = Tx[0, 2*nC:]
+    Tzz = -(Tyy + Txx)
+
+    T = tuple(
+        np.asarray(t/(4*np.pi), dtype=precision)
+        for t in [Txx, Txy, Txz, Tyy, Tyz, Tzz]
+    )
+
+    if not gradient:
+        return T
+
+    # Corners of the prisms and their sign in the alternating sums
+    corners = [
+        (dx1, dy2, dz2, dx1dx1, dy2dy2, dz2dz2, arg1, -1.),
+        (dx2, dy2, dz2, dx2dx2, dy2dy2, dz2dz2, arg2, 1.),
+        (dx2, dy2, dz1, dx2dx2, dy2dy2, dz1dz1, arg3, -1.),
+        (dx1, dy2, dz1, dx1dx1, dy2dy2, dz1dz1, arg4, 1.),
+        (dx2, dy1, dz2, dx2dx2, dy1dy1, dz2dz2, arg5, -1.),
+        (dx1, dy1, dz2, dx1dx1, dy1dy1, dz2dz2, arg6, 1.),
+        (dx1, dy1, dz1, dx1dx1, dy1dy1, dz1dz1, arg7, -1.),
+        (dx2, dy1, dz1, dx2dx2, dy1dy1, dz1dz1, arg8, 1.),
+    ]
+
+    Txxy, Txyy, Txyz, Txxz, Txzz, Tyyz, Tyzz = 0., 0., 0., 0., 0., 0., 0.
+    for dx, dy, dz, dxdx, dydy, dzdz, r, sign in corners:
+
+        # Derivatives of log(dz + r), log(dy + r) and log(dx + r)
+        invR = sign / r
+        invZ = invR * invSum(dz, r, dxdx + dydy)
+        invY = invR * invSum(dy, r, dxdx + dzdz)
+        invX = invR * invSum(dx, r, dydy + dzdz)
+
+        # Distances are measured from the observation location,
+        # hence the change of sign
+        Txxy -= dx * invZ
+        Txyy -= dy * invZ
+        Txyz -= invR
+        Txxz -= dx * invY
+        Txzz -= dz * invY
+        Tyyz -= dy * invX
+        Tyzz -= dz * invX
+
+    Txxx = -(Txyy + Txzz)
+    Tyyy = -(Txxy + Tyzz)
+    Tzzz = -(Txxz + Tyyz)
+
+    return T + tuple(
+        np.asarray(dT, dtype=precision)/(4*np.pi) for dT in [
+            Txxx, Txxy, Txxz, Txyy, Txyz, Txzz, Tyyy, Tyyz, Tyzz, Tzzz
+        ]
+    )
+
+
+def invSum(a, r, rho2):
+    """
+    Evaluate 1/(a + r), with r = sqrt(a**2 + rho2), without cancellation
+    for negative a
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(a >= 0, 1. / (a + r), (r - a) / rho2)
+
+
+def calcRowsLoop(Xn, Yn, Zn, rxLoc, Tx, Ty, Tz):
+    """
+    Loop implementation of calcRows, compiled by numba when available.
+    The 8 corner distances, 16 arctan2 and 12 log of each cell are
+    evaluated in a single pass without temporary arrays.
+    The rows of the pre-allocated Tx, Ty, Tz [nB-by-3*nC] are filled
+    in place.
+
+    """
+
+    eps = 1e-8  # add a small value to the locations to avoid /0
+
+    nC = Xn.shape[0]
+    scale = 1. / (4*np.pi)
+
+    for ii in range(rxLoc.shape[0]):
+        for jj in range(nC):
+
+            dx1 = Xn[jj, 0] - rxLoc[ii, 0] + eps
+            dx2 = Xn[jj, 1] - rxLoc[ii, 0] + eps
+            dy1 = Yn[jj, 0] - rxLoc[ii, 1] + eps
+            dy2 = Yn[jj, 1] - rxLoc[ii, 1] + eps
+            dz1 = Zn[jj, 0] - rxLoc[ii, 2] + eps
+            dz2 = Zn[jj, 1] - rxLoc[ii, 2] + eps
+
+            dx1dx1, dx2dx2 = dx1*dx1, dx2*dx2
+            dy1dy1, dy2dy2 = dy1*dy1, dy2*dy2
+            dz1dz1, dz2dz2 = dz1*dz1, dz2*dz2
+
+            # Distances to the 8 corners
+            arg1 = math.sqrt(dz2dz2 + dy2dy2 + dx1dx1)
+            arg2 = math.sqrt(dz2dz2 + dy2dy2 + dx2dx2)
+            arg3 = math.sqrt(dz1dz1 + dy2dy2 + dx2dx2)
+            arg4 = math.sqrt(dz1dz1 + dy2dy2 + dx1dx1)
+            arg5 = math.sqrt(dz2dz2 + dy1dy1 + dx2dx2)
+            arg6 = math.sqrt(dz2dz2 + dy1dy1 + dx1dx1)
+            arg7 = math.sqrt(dz1dz1 + dy1dy1 + dx1dx1)
+            arg8 = math.sqrt(dz1dz1 + dy1dy1 + dx2dx2)
+
+            txx = (
+                math.atan2(dy1 * dz2, (dx2 * arg5 + eps)) -
+                math.atan2(dy2 * dz2, (dx2 * arg2 + eps)) +
+                math.atan2(dy2 * dz1, (dx2 * arg3 + eps)) -
+                math.atan2(dy1 * dz1, (dx2 * arg8 + eps)) +
+                math.atan2(dy2 * dz2, (dx1 * arg1 + eps)) -
+                math.atan2(dy1 * dz2, (dx1 * arg6 + eps)) +
+                math.atan2(dy1 * dz1, (dx1 * arg7 + eps)) -
+                math.atan2(dy2 * dz1, (dx1 * arg4 + eps))
+            )
+
+            txy = (
+                math.log((dz2 + arg2 + eps) / (dz1 + arg3 + eps)) -
+                math.log((dz2 + arg1 + eps) / (dz1 + arg4 + eps)) +
+                math.log((dz2 + arg6 + eps) / (dz1 + arg7 + eps)) -
+                math.log((dz2 + arg5 + eps) / (dz1 + arg8 + eps))
+            )
+
+            tyy = (
+                math.atan2(dx1 * dz2, (dy2 * arg1 + eps)) -
+                math.atan2(dx2 * dz2, (dy2 * arg2 + eps)) +
+                math.atan2(dx2 * dz1, (dy2 * arg3 + eps)) -
+                math.atan2(dx1 * dz1, (dy2 * arg4 + eps)) +
+                math.atan2(dx2 * dz2, (dy1 * arg5 + eps)) -
+                math.atan2(dx1 * dz2, (dy1 * arg6 + eps)) +
+                math.atan2(dx1 * dz1, (dy1 * arg7 + eps)) -
+                math.atan2(dx2 * dz1, (dy1 * arg8 + eps))
+            )
+
+            tyz = (
+                math.log((dx1 + arg4 + eps) / (dx2 + arg3 + eps)) -
+                math.log((dx1 + arg1 + eps) / (dx2 + arg2 + eps)) +
+                math.log((dx1 + arg6 + eps) / (dx2 + arg5 + eps)) -
+                math.log((dx1 + arg7 + eps) / (dx2 + arg8 + eps))
+            )
+
+            txz = (
+                math.log((dy1 + arg8 + eps) / (dy2 + arg3 + eps)) -
+                math.log((dy1 + arg5 + eps) / (dy2 + arg2 + eps)) +
+                math.log((dy1 + arg6 + eps) / (dy2 + arg1 + eps)) -
+                math.log((dy1 + arg7 + eps) / (dy2 + arg4 + eps))
+            )
+
+            Tx[ii, jj] = txx * scale
+            Tx[ii, jj + nC] = txy * scale
+            Tx[ii, jj + 2*nC] = txz * scale
+
+            Ty[ii, jj] = txy * scale
+            Ty[ii, jj + nC] = tyy * scale
+            Ty[ii, jj + 2*nC] = tyz * scale
+
+            Tz[ii, jj] = txz * scale
+            Tz[ii, jj + nC] = tyz * scale
+            Tz[ii, jj + 2*nC] = -(tyy + txx) * scale
+
+
+if njit is not None:
+    calcRowsJit = njit(calcRowsLoop, cache=True)
+else:
+    calcRowsJit = None
+
+
+def setKernelBackend(backend):
+    """
+        Select the implementation of the prism kernel used by
+        calcRow, calcRows and Intrgl_Fwr_Op
+
+        :param string: backend, 'numpy' [Default] | 'numba'
+
+        Falls back to 'numpy' if numba is not installed.
+    """
+
+    assert backend in ['numpy', 'numba'], (
+        "Kernel backend must be 'numpy' | 'numba'"
+    )
+
+    if backend == 'numba' and njit is None:
+        print("numba module not installed. Using the 'numpy' kernel backend")
+        backend = 'numpy'
 
-    Tx = Tx/(4*np.pi)
-    Ty = Ty/(4*np.pi)
-    Tz = Tz/(4*np.pi)
+    kernel['backend'] = backend
 
-    return Tx, Ty, Tz
+    return backend
 
 
 class Survey():
@@ -1,11 +1,16 @@
 import numpy as np
 import scipy as sp
+import scipy.linalg
+import hashlib
+import warnings
+from collections import OrderedDict
+from multiprocessing import Pool, RawArray
 from scipy.spatial import cKDTree
 # from SimPEG.Utils import mkvc, speye
 from scipy.sparse.linalg import bicgstab
 import matplotlib.pyplot as plt
 from scipy.spatial import Delaunay
-from scipy.interpolate import LinearNDInterpolator
+from scipy.interpolate import LinearNDInterpolator, RegularGridInterpolator
 from tqdm import tqdm
 
 
@@ -13,23 +18,33 @@ def rotationMatrix(inc, dec, normal=True):
     """
         Take an inclination and declination angle and return a rotation matrix
 
+        If arrays of angles are provided, a stack of matrices
+        of shape [n-by-3-by-3] is returned.
+
     """
 
-    phi = -np.deg2rad(np.asarray(inc))
-    theta = -np.deg2rad(np.asarray(dec))
+    phi = -np.deg2rad(np.asarray(inc, dtype=float))
+    theta = -np.deg2rad(np.asarray(dec, dtype=float))
+    phi, theta = np.broadcast_arrays(phi, theta)
+
+    zero, one = np.zeros_like(phi), np.ones_like(phi)
 
-    Rx = np.asarray([[1, 0, 0],
-                    [0, np.cos(phi), -np.sin(phi)],
-                    [0, np.sin(phi), np.cos(phi)]])
+    Rx = np.stack([
+        np.stack([one, zero, zero], axis=-1),
+        np.stack([zero, np.cos(phi), -np.sin(phi)], axis=-1),
+        np.stack([zero, np.sin(phi), np.cos(phi)], axis=-1)
+    ], axis=-2)
 
-    Rz = np.asarray([[np.cos(theta), -np.sin(theta), 0],
-                    [np.sin(theta), np.cos(theta), 0],
-                    [0, 0, 1]])
+    Rz = np.stack([
+        np.stack([np.cos(theta), -np.sin(theta), zero], axis=-1),
+        np.stack([np.sin(theta), np.cos(theta), zero], axis=-1),
+        np.stack([zero, zero, one], axis=-1)
+    ], axis=-2)
 
     if normal:
-        R = Rz.dot(Rx)
+        R = np.matmul(Rz, Rx)
     else:
-        R = Rx.dot(Rz)
+        R = np.matmul(Rx, Rz)
 
     return R
 
@@ -47,6 +62,7 @@ def dipazm_2_xyz(dip, azm_N):
 
     OUTPUT
     M       : [n-by-3] Array of xyz components of a unit vector in cartesian
+              or [3] array if the angles are scalars
 
     Created on Dec, 20th 2015
 
@@ -54,16 +70,16 @@ def dipazm_2_xyz(dip, azm_N):
     """
 
     # Modify azimuth from North to Cartesian-X
-    azm_X = (450. - azm_N) % 360.
+    azm_X = (450. - np.asarray(azm_N, dtype=float)) % 360.
 
-    M = np.zeros(3)
-
-    inc = -np.deg2rad(np.asarray(dip))
+    inc = -np.deg2rad(np.asarray(dip, dtype=float))
     dec = np.deg2rad(azm_X)
 
-    M[0] = np.cos(inc) * np.cos(dec)
-    M[1] = np.cos(inc) * np.sin(dec)
-    M[2] = np.sin(inc)
+    M = np.stack([
+        np.cos(inc) * np.cos(dec),
+        np.cos(inc) * np.sin(dec),
+        np.sin(inc) * np.ones_like(dec)
+    ], axis=-1)
 
     return M
 
@@ -92,7 +108,7 @@ def minCurvatureInterp(
     xyz, data, xyzOut=None,
     vectorX=None, vectorY=None, vectorZ=None, gridSize=10,
     tol=1e-5, iterMax=None, method='spline', maxDistance=None,
-    nPoints=5, overlap=0
+    nPoints=5, overlap=0, tension=0.25, blockSize=1e+5, n_workers=1
 ):
     """
     Interpolate properties with a minimum curvature interpolation
@@ -103,8 +119,19 @@ def minCurvatureInterp(
     :param vectorZ: numpy.ndarray Gridded locations along z-axis [Default:None]
     :param gridSize: numpy float Grid point seperation in meters [DEFAULT:10]
     :param method: 'relaxation' || 'spline' [Default]
-    :param tol: float tol=1e-5 [Default] Convergence criteria
+    :param tol: float tol=1e-5 [Default] Convergence criteria of the
+                'relaxation'. The 'spline' systems are solved directly
     :param iterMax: int iterMax=None [Default] Maximum number of iterations
+    :param tension: float tension=0.25 [Default] Tension of the
+                    'relaxation' surface, see minCurvatureGrid
+    :param blockSize: int blockSize=1e+5 [Default] Maximum number of
+                      grid-data pairs evaluated at once by the 'spline'
+    :param n_workers: int n_workers=1 [Default] Number of processes sharing
+                      the tiles of the 'spline'
+
+    The 'relaxation' method solves the minimum curvature surface on the
+    regular grid (minCurvatureGrid), in 2D only. Output locations xyzOut
+    are interpolated from the grid of gridSize covering the data and xyzOut.
 
     :return: numpy.array of size nC-by-m of interpolated values
 
@@ -194,29 +221,40 @@ def minCurvatureInterp(
 
     if method == 'relaxation':
 
-        # Ave = aveCC2F(gridCx)
+        assert ndim == 2, "method='relaxation' is only available in 2D"
+
+        if xyzOut is not None:
+            # Regular grid covering the data and the output locations
+            xyAll = np.r_[xyz[:, :2], xyzOut[:, :2]]
+            vectorX = np.arange(
+                xyAll[:, 0].min(), xyAll[:, 0].max() + gridSize, gridSize
+            )
+            vectorY = np.arange(
+                xyAll[:, 1].min(), xyAll[:, 1].max() + gridSize, gridSize
+            )
 
-        # count = 0
-        # residual = 1.
+        m = minCurvatureGrid(
+            vectorX, vectorY, xyz[:, :2], data, tension=tension, tol=tol,
+            iterMax=iterMax
+        )
 
-        # m = np.zeros((gridCC.shape[0], data.shape[1]))
+        if xyzOut is not None:
+            m = RegularGridInterpolator((vectorY, vectorX), m)(
+                xyzOut[:, [1, 0]]
+            )
 
-        # # Begin with neighrest primers
-        # for ii in range(m.shape[1]):
-        #     # F = NearestNDInterpolator(mesh.gridCC[ijk], data[:, ii])
-        #     m[:, ii] = data[ind, ii]
+        # If max distance given, mask out the far values with NaNs
+        if maxDistance is not None:
+            tree = cKDTree(xyz[:, :2])
 
-        # while np.all([count < iterMax, residual > tol]):
-        #     for ii in range(m.shape[1]):
-        #         # F = NearestNDInterpolator(mesh.gridCC[ijk], data[:, ii])
-        #         m[:, ii] = data[ind, ii]
-        #     mtemp = m
-        #     m = Ave.T * (Ave * m)
-        #     residual = np.linalg.norm(m-mtemp)/np.linalg.norm(mtemp)
-        #     count += 1
+            if xyzOut is None:
+                dists, _ = tree.query(gridCC[:, :2])
+                m[(dists > maxDistance).reshape(m.shape, order='F')] = np.nan
+            else:
+                dists, _ = tree.query(xyzOut[:, :2])
+                m[dists > maxDistance] = np.nan
 
-        # return gridCC, m
-        NotImplementedError("method='relaxation' not yet implemented")
+        return gridCC, m
 
     elif method == 'spline':
 
@@ -245,71 +283,540 @@ def minCurvatureInterp(
         m = np.zeros(gridCC.shape[0])
         maskOut = np.zeros(gridCC.shape[0], dtype='bool')
         weights = np.zeros(gridCC.shape[0])
-        # Loop over the tiles and compute interpolation
-        for tt in range(X1.shape[0]):
 
-            # Grab the interpolated points within a tile
-            lims = np.r_[X1[tt], X2[tt], Y1[tt], Y2[tt]]
+        # Limits of the tiles
+        tileLims = [
+            np.r_[X1[tt], X2[tt], Y1[tt], Y2[tt]] for tt in range(X1.shape[0])
+        ]
+        options = {'nPoints': nPoints, 'blockSize': blockSize}
+
+        def blend(results):
+            # Blend the tiles with their tapers
+            for inAll, mInterp, tapper in results:
+                maskOut[inAll] = True
+                m[inAll] += (mInterp * tapper)
+                weights[inAll] += tapper
+
+        if n_workers > 1:
+
+            # Copy the inputs once in shared memory, read by all workers
+            shared = []
+            for array in [gridCC, xyz, data, inRadius]:
+                array = np.asarray(array, dtype=float)
+                arrayShared = RawArray('d', int(array.size))
+                np.frombuffer(arrayShared).reshape(array.shape)[:] = array
+                shared += [(arrayShared, array.shape)]
+
+            # Tiles are blended in order, for the same sums as in serial
+            with Pool(
+                int(n_workers), initializer=_initGridWorker,
+                initargs=(shared, options)
+            ) as pool:
+                blend(pool.imap(_gridWorkerTile, tileLims))
 
-            inTile = np.all(
-                [
-                    gridCC[:, 0] >= lims[0], gridCC[:, 0] <= lims[1],
-                    gridCC[:, 1] >= lims[2], gridCC[:, 1] <= lims[3]
-                ], axis=0
+        else:
+
+            blend(
+                splineTile(
+                    gridCC, xyz, data, tree, inRadius, lims, **options
+                ) for lims in tileLims
             )
 
-            inAll = (inTile * inRadius) == 1
-            maskOut[inAll] = True
+        m[maskOut] /= weights[maskOut]
+        m[maskOut == 0] = np.nan
 
-            # Tapper the grid
-            r = (
-                (gridCC[inAll, 0] - np.mean(gridCC[inAll, 0]))**2. +
-                (gridCC[inAll, 1] - np.mean(gridCC[inAll, 1]))**2.
-            )**0.5
+        if xyzOut is None:
+            m = m.reshape(gridCx.shape, order='F')
 
-            tapper = (1.01 - r/r.max())
+        return gridCC, m
 
-            rQuery, indexes = tree.query(gridCC[inAll, :], k=nPoints)
+    else:
 
-            # Get closest querry points
-            indx = np.unique(indexes)
+        raise NotImplementedError("Only methods 'relaxation' || 'spline' are available" )
 
-            if tt == 0:
-                baseLine = len(indx)
 
-            ndat = xyz.shape[0]
+def splineTile(
+    gridCC, xyz, data, tree, inRadius, lims, nPoints=5, blockSize=1e+5
+):
+    """
+    Spline interpolation of the grid points within one tile of
+    minCurvatureInterp, from the nPoints data closest to each grid point
 
-            X, Y = np.meshgrid(xyz[indx, 0], xyz[indx, 1])
-            # for i in range(ndat):
+    :param tree: cKDTree of the data locations xyz
+    :param inRadius: numpy.array of bool, grid points to be interpolated
+    :param lims: numpy.array of the tile limits [xmin, xmax, ymin, ymax]
 
-            r = (X.T - X)**2. + (Y.T - Y)**2. + 1e-8
-            A = r.T * (np.log((r.T)**0.5) - 1.)
+    :return: tuple (index, values, tapper) of the grid points in the tile,
+             their interpolated values and their blending weights
+    """
 
-            # # Solve system for the green parameters
-            # Scale the tolerance on the number data points
-            g = sp.sparse.linalg.bicgstab(A, data[indx], tol=tol*baseLine/len(indx))
+    # Grab the interpolated points within a tile
+    inAll = np.where(np.all(
+        [
+            gridCC[:, 0] >= lims[0], gridCC[:, 0] <= lims[1],
+            gridCC[:, 1] >= lims[2], gridCC[:, 1] <= lims[3],
+            inRadius
+        ], axis=0
+    ))[0]
 
-            # We can parallelize this part later
-            mInterp = np.zeros(inAll.sum())
-            for ii in range(indx.shape[0]):
+    if inAll.shape[0] == 0:
+        return inAll, np.zeros(0), np.zeros(0)
 
-                r = (gridCC[inAll, 0] - xyz[indx[ii], 0])**2. + (gridCC[inAll, 1] - xyz[indx[ii], 1])**2. + 1e-8
-                mInterp += g[0][ii] * (r).T * (np.log((r.T)**0.5) - 1.)
+    # Tapper the grid
+    r = (
+        (gridCC[inAll, 0] - np.mean(gridCC[inAll, 0]))**2. +
+        (gridCC[inAll, 1] - np.mean(gridCC[inAll, 1]))**2.
+    )**0.5
 
-            m[inAll] += (mInterp * tapper)
-            weights[inAll] += tapper
+    tapper = (1.01 - r/np.max([r.max(), 1e-8]))
 
-        m[maskOut] /= weights[maskOut]
-        m[maskOut == 0] = np.nan
+    rQuery, indexes = tree.query(gridCC[inAll, :], k=nPoints)
 
-        if xyzOut is None:
-            m = m.reshape(gridCx.shape, order='F')
+    # Get closest querry points
+    indx = np.unique(indexes)
 
-        return gridCC, m
+    # Solve system for the green parameters, with the factorization
+    # of the points reused from the splineCache
+    g = splineSolve(xyz[indx, :2], data[indx])
 
-    else:
+    mInterp = splineEval(
+        gridCC[inAll, :2], xyz[indx, :2], g, blockSize=blockSize
+    )
+
+    return inAll, mInterp, tapper
+
+
+# Shared state of the gridding workers, set once per process
+_gridWorker = {}
+
+
+def _initGridWorker(shared, options):
+    gridCC, xyz, data, inRadius = [
+        np.frombuffer(array).reshape(shape) for array, shape in shared
+    ]
+    _gridWorker['inputs'] = (
+        gridCC, xyz, data, cKDTree(xyz[:, :2]), inRadius.astype(bool)
+    )
+    _gridWorker['options'] = options
+
+
+def _gridWorkerTile(lims):
+    return splineTile(
+        *_gridWorker['inputs'], lims, **_gridWorker['options']
+    )
+
+
+class SplineCache(object):
+    """
+        Least-recently-used cache of the LU factorizations of the spline
+        systems of minCurvatureInterp, keyed by a hash of the point
+        locations, so that gridding other data on the same locations
+        skips the factorizations.
+
+        The least recently used factorizations are dropped once their
+        total size exceeds maxBytes.
+    """
+
+    maxBytes = 1e+9
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        self.factors = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+        return
+
+    @property
+    def nbytes(self):
+        return int(np.sum([
+            factor[0].nbytes for factor in self.factors.values()
+        ]))
+
+    def get(self, xy):
+        """
+            Return the factorization of the spline system of the points xy,
+            computing it if needed
+        """
+
+        xy = np.ascontiguousarray(xy, dtype=float)
+        key = hashlib.sha1(str(xy.shape).encode() + xy.tobytes()).hexdigest()
+
+        if key in self.factors:
+            self.hits += 1
+            self.factors.move_to_end(key)
+
+            return self.factors[key]
+
+        self.misses += 1
+        factor = splineFactor(xy)
+
+        if factor[0].nbytes <= self.maxBytes:
+            self.factors[key] = factor
+
+            while self.nbytes > self.maxBytes:
+                self.factors.popitem(last=False)
+
+        return factor
+
+    def clear(self):
+        self.factors.clear()
+        self.hits, self.misses = 0, 0
+
+
+splineCache = SplineCache()
+
+
+def splineFactor(xy):
+    """
+    LU factorization of the Green's function matrix of the points xy
+    (see splineEval), computed by LAPACK.
+
+    Matrices too ill-conditioned for the LU, for instance with repeated
+    locations, are replaced by their pseudo-inverse, giving the least
+    squares weights.
+
+    :return: tuple (lu, piv) of scipy.linalg.lu_factor, or (pinv, None)
+    """
+
+    A = splineKernel(xy, xy)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        lu, piv = sp.linalg.lu_factor(A, check_finite=False)
+
+    # Reciprocal condition number of the factored matrix
+    rcond, info = sp.linalg.lapack.dgecon(lu, np.abs(A).sum(axis=0).max())
+
+    if info != 0 or not np.isfinite(rcond) or rcond < 1e-13:
+        print(
+            "Spline system of " + str(xy.shape[0]) + " points is singular " +
+            "(duplicate locations?). Using the least squares solution"
+        )
+        return np.linalg.pinv(A), None
+
+    return lu, piv
+
+
+def splineSolve(xy, data):
+    """
+    Weights of the Green's function spline of minimum curvature of the
+    points xy honoring the data (n or n-by-m values), from the factorization
+    stored in the splineCache
+
+    :return: numpy.array of weights with the shape of data
+    """
+
+    factor, piv = splineCache.get(xy)
+
+    if piv is None:
+        return factor.dot(data)
+
+    return sp.linalg.lu_solve((factor, piv), data, check_finite=False)
+
+
+def splineKernel(xyOut, xyIn):
+    """
+    Green's function matrix r^2 * (log(r) - 1) of the distances between
+    the locations xyOut and xyIn, from the squared distances expanded
+    as |x|^2 + |y|^2 - 2 x.y on coordinates centered on the sources.
+
+    :return: numpy.array of size nOut-by-n
+    """
+
+    center = np.mean(xyIn, axis=0)
+    xyIn = xyIn - center
+    xyOut = xyOut - center
+
+    # Squared distances, in place to limit the memory traffic
+    r = xyOut.dot(xyIn.T)
+    r *= -2.
+    r += np.sum(xyOut**2., axis=1)[:, None]
+    r += np.sum(xyIn**2., axis=1)[None, :]
+    np.maximum(r, 0., out=r)
+    r += 1e-8
+
+    kernel = np.log(r)
+    kernel *= 0.5
+    kernel -= 1.
+    kernel *= r
+
+    return kernel
+
+
+def splineEval(xyOut, xyIn, weights, blockSize=1e+5):
+    """
+    Evaluate the Green's function spline of minimum curvature
+
+        f(x) = sum_j weights_j * r_j^2 * (log(r_j) - 1)
+
+    with r_j the distance from x to xyIn_j, at the locations xyOut.
+
+    The kernel is computed by blocks of locations, of at most blockSize
+    location-source pairs (see splineKernel), and contracted with the
+    weights by a matrix product.
+
+    :param xyOut: numpy.array of size nOut-by-2 of evaluation locations
+    :param xyIn: numpy.array of size n-by-2 of source locations
+    :param weights: numpy.array of size n or n-by-m of spline weights
+    :param blockSize: int Maximum number of pairs evaluated at once
+
+    :return: numpy.array of size nOut or nOut-by-m of values
+    """
+
+    weights = np.asarray(weights)
+
+    values = np.zeros((xyOut.shape[0],) + weights.shape[1:])
+    nB = int(np.max([blockSize // np.max([xyIn.shape[0], 1]), 1]))
+    for start in range(0, xyOut.shape[0], nB):
+
+        stop = np.min([start + nB, xyOut.shape[0]])
+
+        values[start:stop] = splineKernel(xyOut[start:stop], xyIn).dot(weights)
+
+    return values
+
+
+def minCurvatureGrid(
+    vectorX, vectorY, xy, data, tension=0.25, tol=1e-5, iterMax=None
+):
+    """
+    Minimum curvature surface with tension on a regular grid
+    (Briggs, 1974; Smith & Wessel, 1990), minimizing
+
+        (1 - tension) * (u_xx^2 + 2 u_xy^2 + u_yy^2) +
+        tension * (u_x^2 + u_y^2)
+
+    summed over the grid, with the data snapped to the nearest grid nodes
+    (averaged if several fall on the same node). The interior nodes
+    satisfy (1 - tension) * del^4(u) - tension * del^2(u) = 0, with the
+    natural conditions of a free surface along the edges.
+
+    The sparse system of the free nodes is solved by conjugate gradients
+    preconditioned with a multigrid V-cycle (Jacobi smoothing, bilinear
+    interpolation between grids of twice the node spacing and Galerkin
+    coarse operators), for a cost O(nodes) per iteration and a number of
+    iterations independent of the grid size.
+
+    :param vectorX: numpy.ndarray Regular grid locations along x-axis
+    :param vectorY: numpy.ndarray Regular grid locations along y-axis
+    :param xy: numpy.array of size n-by-2 of data locations
+    :param data: numpy.array of size n of values to be interpolated
+    :param tension: float tension=0.25 [Default] 0 for minimum curvature,
+                    1 for a harmonic surface
+    :param tol: float tol=1e-5 [Default] Convergence criteria on the
+                relative residual
+    :param iterMax: int iterMax=None [Default] Maximum number of
+                    iterations [200]
+
+    :return: numpy.array of size ny-by-nx of gridded values
+    """
+
+    vectorX = np.asarray(vectorX, dtype=float)
+    vectorY = np.asarray(vectorY, dtype=float)
+    data = np.asarray(data, dtype=float).flatten()
+
+    nx, ny = vectorX.shape[0], vectorY.shape[0]
+
+    assert np.min([nx, ny]) >= 3, "The grid needs at least 3 nodes along each axis"
+
+    dx = vectorX[1] - vectorX[0]
+    dy = vectorY[1] - vectorY[0]
+
+    if iterMax is None:
+        iterMax = 200
+
+    # Snap the data to the nearest nodes, ordered with x first
+    ix = np.clip(np.round((xy[:, 0] - vectorX[0]) / dx), 0, nx - 1)
+    iy = np.clip(np.round((xy[:, 1] - vectorY[0]) / dy), 0, ny - 1)
+    node = (iy * nx + ix).astype(int)
 
-        NotImplementedError("Only methods 'relaxation' || 'spline' are available" )
+    count = np.bincount(node, minlength=nx * ny)
+    fixed = count > 0
+
+    grid = np.bincount(node, weights=data, minlength=nx * ny)
+    grid[fixed] /= count[fixed]
+
+    free = ~fixed
+
+    A = curvatureOperator(nx, ny, ratio=dy / dx, tension=tension)
+
+    Aff = A[free, :][:, free]
+    b = -A[free, :][:, fixed].dot(grid[fixed])
+
+    levels = multigridLevels(Aff, nx, ny, free=free)
+
+    # Conjugate gradients preconditioned by a V-cycle
+    x = np.zeros(free.sum())
+    r = b.copy()
+    z = multigridCycle(levels, r)
+    p = z.copy()
+    rz = r.dot(z)
+    normB = np.linalg.norm(b)
+
+    converged = normB == 0
+    for count in range(int(iterMax)):
+
+        if converged:
+            break
+
+        Ap = Aff.dot(p)
+        alpha = rz / p.dot(Ap)
+        x += alpha * p
+        r -= alpha * Ap
+
+        if np.linalg.norm(r) < tol * normB:
+            converged = True
+            break
+
+        z = multigridCycle(levels, r)
+        rzNew = r.dot(z)
+        p = z + rzNew / rz * p
+        rz = rzNew
+
+    if not converged:
+        print(
+            "minCurvatureGrid did not converge in " + str(iterMax) +
+            " iterations. Increase iterMax or tol"
+        )
+
+    grid[free] = x
+
+    return grid.reshape((ny, nx))
+
+
+def curvatureOperator(nx, ny, ratio=1., tension=0.25):
+    """
+    Sparse matrix of the quadratic form of the curvature with tension on a
+    regular grid of nx-by-ny nodes (x first), in units of the node spacing
+    along x. The spacing along y is ratio times the spacing along x.
+
+    :return: scipy.sparse.csr_matrix of shape (nx*ny, nx*ny)
+    """
+
+    def difference(n, order):
+        if order == 1:
+            return sp.sparse.diags(
+                [-np.ones(n - 1), np.ones(n - 1)], [0, 1], shape=(n - 1, n)
+            )
+
+        return sp.sparse.diags(
+            [np.ones(n - 2), -2. * np.ones(n - 2), np.ones(n - 2)],
+            [0, 1, 2], shape=(n - 2, n)
+        )
+
+    Ix, Iy = sp.sparse.identity(nx), sp.sparse.identity(ny)
+
+    Dxx = sp.sparse.kron(Iy, difference(nx, 2))
+    Dyy = sp.sparse.kron(difference(ny, 2), Ix) / ratio**2.
+    Dxy = sp.sparse.kron(difference(ny, 1), difference(nx, 1)) / ratio
+    Dx = sp.sparse.kron(Iy, difference(nx, 1))
+    Dy = sp.sparse.kron(difference(ny, 1), Ix) / ratio
+
+    A = (1. - tension) * (
+        Dxx.T.dot(Dxx) + 2. * Dxy.T.dot(Dxy) + Dyy.T.dot(Dyy)
+    ) + tension * (Dx.T.dot(Dx) + Dy.T.dot(Dy))
+
+    return A.tocsr()
+
+
+def interpolationMatrix(n):
+    """
+    Linear interpolation from every second node of n nodes (and the last
+    node) to all nodes
+
+    :return: scipy.sparse.csr_matrix of shape (n, nCoarse)
+    """
+
+    coarse = np.unique(np.r_[np.arange(0, n, 2), n - 1])
+
+    # Coarse interval and weight of each node
+    ind = np.clip(
+        np.searchsorted(coarse, np.arange(n), side='right') - 1,
+        0, coarse.shape[0] - 2
+    )
+    weight = (np.arange(n) - coarse[ind]) / (coarse[ind + 1] - coarse[ind])
+
+    return sp.sparse.csr_matrix(
+        (
+            np.r_[1. - weight, weight],
+            (np.r_[np.arange(n), np.arange(n)], np.r_[ind, ind + 1])
+        ),
+        shape=(n, coarse.shape[0])
+    )
+
+
+def multigridLevels(A, nx, ny, free=None, nMin=500):
+    """
+    Hierarchy of Galerkin coarse operators of a grid operator A, on grids
+    of twice the node spacing, down to nMin unknowns. If free is given,
+    A only acts on the free nodes of the nx-by-ny grid.
+
+    :return: list of dict of the operator 'A', the Jacobi weights 'dinv',
+             the damping 'omega' and the interpolation 'P' of each level,
+             and the inverse 'Ainv' on the coarsest level
+    """
+
+    levels = []
+    while True:
+
+        d = A.diagonal()
+        dinv = np.zeros_like(d)
+        dinv[d > 0] = 1. / d[d > 0]
+
+        # Largest eigenvalue of D^-1 A by power iterations
+        v = np.random.RandomState(0).rand(A.shape[0])
+        for ii in range(10):
+            w = dinv * A.dot(v)
+            rho = np.linalg.norm(w) / np.linalg.norm(v)
+            v = w
+
+        levels.append({'A': A, 'dinv': dinv, 'omega': 1. / (1.1 * rho)})
+
+        if A.shape[0] <= nMin or np.min([nx, ny]) < 4:
+            levels[-1]['Ainv'] = np.linalg.pinv(A.toarray())
+            break
+
+        Px, Py = interpolationMatrix(nx), interpolationMatrix(ny)
+        P = sp.sparse.kron(Py, Px).tocsr()
+
+        if free is not None:
+            P, free = P[free, :], None
+
+        levels[-1]['P'] = P
+
+        A = P.T.dot(A.dot(P)).tocsr()
+        nx, ny = Px.shape[1], Py.shape[1]
+
+    return levels
+
+
+def multigridCycle(levels, b, level=0, nSmooth=2):
+    """
+    Symmetric multigrid V-cycle approximating the solution of A x = b,
+    with nSmooth damped Jacobi sweeps before and after each coarse
+    correction
+    """
+
+    L = levels[level]
+
+    if 'Ainv' in L:
+        return L['Ainv'].dot(b)
+
+    x = L['omega'] * L['dinv'] * b
+    for ii in range(nSmooth - 1):
+        x += L['omega'] * L['dinv'] * (b - L['A'].dot(x))
+
+    r = b - L['A'].dot(x)
+    x += L['P'].dot(
+        multigridCycle(levels, L['P'].T.dot(r), level + 1, nSmooth)
+    )
+
+    for ii in range(nSmooth):
+        x += L['omega'] * L['dinv'] * (b - L['A'].dot(x))
+
+    return x
 
 
 def decimalDegrees2DMS(value, type):
@@ -433,10 +940,18 @@ def estimateDepth(grid, method="tiltAngleDerivative"):
 
 def tileSurveyPoints(xyLocs, maxNpoints, overlap=[0, 0]):
     """
-        Function to tile an survey points into smaller square subsets of points
+        Function to tile an survey points into smaller rectangular subsets
+        of points, by recursive median splits (kd-tree) of the survey
+        extent along the longest side of each tile, until each tile holds
+        at most maxNpoints. Tiles cover the full extent of the points, with
+        boundaries falling between points.
+
+        Each split partitions the points of a tile in linear time, so that
+        the tiling costs O(n log n).
 
         :param numpy.ndarray xyLocs: n x 2 array of locations [x,y]
         :param integer maxNpoints: maximum number of points in each tile
+        :param list overlap: extension [dx, dy] of the tiles on each side
 
         RETURNS:
         :param numpy.ndarray: Return a list of arrays  for the SW and NE
@@ -444,69 +959,76 @@ def tileSurveyPoints(xyLocs, maxNpoints, overlap=[0, 0]):
 
     """
 
-    # Initialize variables
-    nNx = 2
-    nNy = 1
-    nObs = 1e+8
-    countx = 0
-    county = 0
-    xlim = [xyLocs[:, 0].min(), xyLocs[:, 0].max()]
-    ylim = [xyLocs[:, 1].min(), xyLocs[:, 1].max()]
+    xy = np.asarray(xyLocs)[:, :2]
+    maxNpoints = int(np.max([maxNpoints, 1]))
 
-    # Refine the brake recursively
-    while nObs > maxNpoints:
+    # Stack of tiles to split, as the index of their points and limits
+    stack = [(
+        np.arange(xy.shape[0]),
+        np.r_[xy[:, 0].min(), xy[:, 1].min()],
+        np.r_[xy[:, 0].max(), xy[:, 1].max()]
+    )]
+    xy1, xy2 = [], []
 
-        nObs = 0
+    while stack:
 
-        if countx > county:
-            nNx += 1
-        else:
-            nNy += 1
+        index, lim1, lim2 = stack.pop()
+
+        if index.shape[0] > maxNpoints:
 
-        countx = 0
-        county = 0
-        xtiles = np.linspace(xlim[0], xlim[1], nNx)
-        ytiles = np.linspace(ylim[0], ylim[1], nNy)
+            # Split along the longest side, or the other if all points
+            # share the same coordinate
+            axes = [0, 1] if (lim2 - lim1)[0] >= (lim2 - lim1)[1] else [1, 0]
 
-        # Remove tiles without points in
-        filt = np.ones((nNx-1)*(nNy-1), dtype='bool')
+            for axis in axes:
 
-        for ii in range(xtiles.shape[0]-1):
-            for jj in range(ytiles.shape[0]-1):
-                # Mask along x axis
-                maskx = np.all([xyLocs[:, 0] >= xtiles[ii],
-                               xyLocs[:, 0] <= xtiles[int(ii+1)]], axis=0)
+                # Median split, with the boundary between the two points
+                # around the median
+                half = index.shape[0] // 2
+                order = np.argpartition(xy[index, axis], [half - 1, half])
+                left = xy[index[order[half - 1]], axis]
+                right = xy[index[order[half]], axis]
 
-                # Mask along y axis
-                masky = np.all([xyLocs[:, 1] >= ytiles[jj],
-                               xyLocs[:, 1] <= ytiles[int(jj+1)]], axis=0)
+                if left < right:
+                    split = (left + right) / 2.
+                    break
 
-                # Remember which axis has the most points (for next split)
-                countx = np.max([np.sum(maskx), countx])
-                county = np.max([np.sum(masky), county])
+                # Move the median on the next distinct coordinate
+                values = xy[index, axis]
+                lower = values < left
+                if 0 < lower.sum():
+                    split = (values[lower].max() + left) / 2.
+                    break
 
-                # Full mask
-                mask = np.all([maskx, masky], axis=0)
-                nObs = np.max([nObs, np.sum(mask)])
+                upper = values > left
+                if 0 < upper.sum():
+                    split = (values[upper].min() + left) / 2.
+                    break
 
-                # Check if at least one point is picked
-                if np.sum(mask) == 0:
-                    filt[jj + ii*(nNy-1)] = False
+            else:
+                # Points at a single location cannot be split
+                xy1 += [lim1]
+                xy2 += [lim2]
+                continue
 
-    x1, x2 = xtiles[:-1], xtiles[1:]
-    y1, y2 = ytiles[:-1], ytiles[1:]
+            inLeft = xy[index, axis] < split
 
-    X1, Y1 = np.meshgrid(x1, y1)
-    xy1 = np.c_[
-        X1.flatten(order="F")[filt] - overlap[0],
-        Y1.flatten(order="F")[filt] - overlap[1]
-    ]
+            upper = lim2.copy()
+            upper[axis] = split
+            lower = lim1.copy()
+            lower[axis] = split
 
-    X2, Y2 = np.meshgrid(x2, y2)
-    xy2 = np.c_[
-        X2.flatten(order="F")[filt] + overlap[0],
-        Y2.flatten(order="F")[filt] + overlap[1]
-    ]
+            stack += [
+                (index[~inLeft], lower, lim2),
+                (index[inLeft], lim1, upper),
+            ]
+
+        else:
+            xy1 += [lim1]
+            xy2 += [lim2]
+
+    xy1 = np.vstack(xy1) - np.r_[overlap[0], overlap[1]]
+    xy2 = np.vstack(xy2) + np.r_[overlap[0], overlap[1]]
 
     return [xy1, xy2]
 
@@ -588,3 +1110,116 @@ def progress(iter, prog, final):
         prog = arg
 
     return prog
+
+
+# Daubechies-4 scaling and wavelet filters
+D4 = np.r_[1. + 3.**0.5, 3. + 3.**0.5, 3. - 3.**0.5, 1. - 3.**0.5] / (4. * 2.**0.5)
+D4w = D4[::-1] * np.r_[1., -1., 1., -1.]
+
+
+def waveletLevels(shape):
+    """
+    waveletLevels(shape)
+
+    Number of levels of the wavelet transform along each axis of a grid,
+    and the shape of the grid padded to a multiple of 2**levels. The
+    coarsest level keeps at least 4 samples.
+
+    INPUT
+    shape   : Number of cells along each axis
+
+    OUTPUT
+    levels  : Number of levels along each axis
+    shapePad: Padded number of cells along each axis
+    """
+
+    levels, shapePad = [], []
+    for n in shape:
+
+        nLev = int(np.max([np.floor(np.log2(n)) - 2, 0]))
+
+        levels += [nLev]
+        shapePad += [int(np.ceil(n / 2.**nLev) * 2**nLev)]
+
+    return levels, shapePad
+
+
+def waveletTransform(x, shape, inverse=False):
+    """
+    waveletTransform(x, shape, inverse=False)
+
+    Orthonormal, separable Daubechies-4 wavelet transform over the cells of
+    a grid, with periodic boundaries. The grid is padded with zeros to a
+    multiple of 2**levels along each axis (see waveletLevels), so that the
+    transform preserves dot products: x.dot(y) = W(x).dot(W(y)).
+
+    INPUT
+    x       : [...-by-nC] Array of values on the grid, with cells ordered as
+              np.reshape(x, shape) (or of coefficients if inverse=True)
+    shape   : Number of cells along each axis of the grid
+    inverse : Compute the inverse transform
+
+    OUTPUT
+    w       : [...-by-nW] Array of wavelet coefficients (or [...-by-nC]
+              values if inverse=True)
+    """
+
+    levels, shapePad = waveletLevels(shape)
+    batch = x.shape[:-1]
+    nAxes = len(shape)
+
+    if inverse:
+        w = np.reshape(x, batch + tuple(shapePad)).copy()
+
+    else:
+        w = np.zeros(batch + tuple(shapePad))
+        w[(Ellipsis,) + tuple(slice(0, n) for n in shape)] = np.reshape(
+            x, batch + tuple(shape)
+        )
+
+    for axis in range(nAxes):
+
+        w = np.moveaxis(w, len(batch) + axis, -1)
+
+        # Length of the approximation at each level, from fine to coarse
+        lengths = [shapePad[axis] // 2**lev for lev in range(levels[axis])]
+        if inverse:
+            lengths = lengths[::-1]
+
+        for n in lengths:
+
+            if inverse:
+                a, d = w[..., :n//2], w[..., n//2:n]
+
+                even = (
+                    D4[0] * a + D4w[0] * d +
+                    D4[2] * np.roll(a, 1, axis=-1) +
+                    D4w[2] * np.roll(d, 1, axis=-1)
+                )
+                odd = (
+                    D4[1] * a + D4w[1] * d +
+                    D4[3] * np.roll(a, 1, axis=-1) +
+                    D4w[3] * np.roll(d, 1, axis=-1)
+                )
+
+                w[..., 0:n:2], w[..., 1:n:2] = even, odd
+
+            else:
+                even, odd = w[..., 0:n:2], w[..., 1:n:2]
+                even1 = np.roll(even, -1, axis=-1)
+                odd1 = np.roll(odd, -1, axis=-1)
+
+                a = D4[0] * even + D4[1] * odd + D4[2] * even1 + D4[3] * odd1
+                d = (
+                    D4w[0] * even + D4w[1] * odd + D4w[2] * even1 +
+                    D4w[3] * odd1
+                )
+
+                w[..., :n//2], w[..., n//2:n] = a, d
+
+        w = np.moveaxis(w, -1, len(batch) + axis)
+
+    if inverse:
+        w = w[(Ellipsis,) + tuple(slice(0, n) for n in shape)]
+
+    return np.reshape(w, batch + (-1,))
@@ -1,5 +1,9 @@
 
 import numpy as np
+import json
+import os
+import re
+from multiprocessing import Pool
 from GeoToolkit.Mag import Simulator, DataIO, MathUtils, Mag
 # from SimPEG import PF, Utils, Mesh, Maps
 import ipywidgets as widgets
@@ -28,11 +32,15 @@ def blockModel():
 
 
 def setSyntheticProblem(
-        rxLocs, EarthField=[50000, 90, 0], discretize=False
+        rxLocs, EarthField=[50000, 90, 0], discretize=False,
+        params=None, suscs=None
      ):
     """
         Set the synthetic problem with multiple blocks.
         Output the figure used in the doc
+
+        The blocks of blockModel are used unless params and suscs are
+        provided in the same format (e.g. from ScenarioRunner.sample)
     """
 
     if discretize:
@@ -63,7 +71,8 @@ def setSyntheticProblem(
     prisms = []
 
     # User defined parameters for the blocks
-    params, suscs = blockModel()
+    if params is None or suscs is None:
+        params, suscs = blockModel()
 
     # Create the synthetic blocks model and place
     # it at the center of the survey
@@ -75,11 +84,6 @@ def setSyntheticProblem(
         prism.pdec, prism.pinc = param[6], param[7]
         prisms.append(prism)
 
-        # Forward model data
-        prob = Mag.Problem(prism=prism, survey=survey)
-        prob.susc = susc
-        survey._dobs = survey.dobs + prob.fields()[0]
-
         if discretize:
             # Discretize onto mesh
             X, Y, Z = np.meshgrid(prism.xn, prism.yn, prism.zn)
@@ -93,9 +97,267 @@ def setSyntheticProblem(
 
             model[ind] += susc
 
+    # Forward model data for all blocks at once
+    survey._dobs = survey.dobs + Mag.prismFields(
+        survey.rxLoc,
+        np.vstack([[prism.xc, prism.yc, prism.zc] for prism in prisms]),
+        np.vstack([[prism.dx, prism.dy, prism.dz] for prism in prisms]),
+        pinc=[prism.pinc for prism in prisms],
+        pdec=[prism.pdec for prism in prisms],
+        susc=suscs[:len(prisms)],
+        srcFieldParam=survey.srcFieldParam, useCache=True
+    )
+
     return survey, mesh, model
 
 
+class ScenarioRunner(object):
+    """
+        Batch runner of Monte-Carlo scenarios of the synthetic block model.
+
+        Each scenario perturbs the parameters of blockModel with its own
+        random generator seeded by [seed, index], so that any scenario can
+        be reproduced alone (see sample) regardless of the chunks and
+        workers used. The blocks are placed over the survey as in
+        setSyntheticProblem and their data computed with Mag.prismResponse,
+        all the blocks of a chunk of scenarios at once.
+
+        Chunks of chunkSize scenarios are computed by a pool of n_workers
+        processes and saved in path as they complete, with a header.json
+        describing the runs. Calling run again on the same path resumes by
+        computing the missing chunks only, and can add scenarios to the
+        previous runs.
+
+        The perturbations are the standard deviations of
+        'position': shifts of the blocks [m]
+        'size': log of the dimensions
+        'rotation': rotations [deg]
+        'susc': log of the susceptibilities
+    """
+
+    path = os.path.join(os.path.expanduser('~'), '.GeoToolkit', 'scenarios')
+    chunkSize = 100
+    n_workers = 1
+    seed = 0
+    EarthField = [50000, 90, 0]
+    uType = 'tf'
+    blockSize = 1e+6
+
+    def __init__(self, **kwargs):
+
+        self.perturbations = {
+            'position': 100., 'size': 0.1, 'rotation': 5., 'susc': 0.1
+        }
+
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+        return
+
+    def sample(self, index):
+        """
+            Parameters of the blocks of scenario index, in the format
+            of blockModel
+        """
+
+        params, suscs = blockModel()
+        params = np.asarray(params, dtype=float)
+        suscs = np.asarray(suscs[:params.shape[0]], dtype=float)
+        nB = params.shape[0]
+
+        rng = np.random.RandomState([int(self.seed), int(index)])
+
+        params[:, :3] += rng.randn(nB, 3) * self.perturbations['position']
+        params[:, 3:6] *= np.exp(rng.randn(nB, 3) * self.perturbations['size'])
+        params[:, 6:8] += rng.randn(nB, 2) * self.perturbations['rotation']
+        suscs *= np.exp(rng.randn(nB) * self.perturbations['susc'])
+
+        return params, suscs
+
+    def prismParameters(self, rxLocs, params, suscs):
+        """
+            Parameters of the blocks listed in Mag.prismParameters, placed
+            over the survey as in setSyntheticProblem
+        """
+
+        cntr = np.mean(rxLocs, axis=0)
+
+        prisms = np.zeros((params.shape[0], len(Mag.prismParameters)))
+        prisms[:, 0] = cntr[0] + params[:, 0]
+        prisms[:, 1] = cntr[1] + params[:, 1]
+        prisms[:, 2] = rxLocs[:, 2].min() + params[:, 2]
+        prisms[:, 3:6] = params[:, 3:6]
+        prisms[:, 6], prisms[:, 7] = params[:, 7], params[:, 6]
+        prisms[:, 8] = suscs
+
+        return prisms
+
+    def header(self, rxLocs):
+        """
+            Description of the scenarios saved with the chunks, from the
+            sampling settings and the survey but not their number, so that
+            later runs can add scenarios
+        """
+
+        return {
+            'seed': int(self.seed),
+            'EarthField': [float(val) for val in self.EarthField],
+            'uType': self.uType,
+            'perturbations': {
+                key: float(val) for key, val in self.perturbations.items()
+            },
+            'blockModel': Mag.geometryKey(*blockModel()),
+            'survey': Mag.geometryKey(rxLocs)
+        }
+
+    def chunkFile(self, chunk):
+        return os.path.join(self.path, 'scenarios_%06i.npz' % chunk)
+
+    def chunkIndex(self, chunk, nScenarios):
+        return np.arange(
+            chunk * self.chunkSize,
+            np.min([(chunk + 1) * self.chunkSize, nScenarios])
+        )
+
+    def chunkComplete(self, chunk, nScenarios):
+        """
+            True if the chunk is saved with all its scenarios, the last
+            chunk of a previous run with fewer scenarios being partial
+        """
+
+        if not os.path.exists(self.chunkFile(chunk)):
+            return False
+
+        with np.load(self.chunkFile(chunk)) as saved:
+            return saved['index'].shape[0] >= len(
+                self.chunkIndex(chunk, nScenarios)
+            )
+
+    def run(self, rxLocs, nScenarios):
+        """
+            Compute the data of nScenarios scenarios observed at rxLocs,
+            skipping the chunks already saved in path
+
+            OUTPUT
+            :param list: chunks, indices of the chunks computed
+        """
+
+        # Centered at the origin as in setSyntheticProblem
+        rxLocs = np.asarray(rxLocs, dtype=float)
+        rxLocs = rxLocs - np.mean(rxLocs, axis=0)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        header = self.header(rxLocs)
+        headerFile = os.path.join(self.path, 'header.json')
+
+        if os.path.exists(headerFile):
+            with open(headerFile, 'r') as f:
+                saved = json.load(f)
+
+            # The chunks already saved set the chunk size
+            chunkSize = saved.pop('chunkSize', self.chunkSize)
+
+            assert saved == header, (
+                "The scenarios in " + self.path + " were run with other " +
+                "settings. Use a new path or delete the folder."
+            )
+
+            if chunkSize != self.chunkSize:
+                print(
+                    "Resuming with the chunkSize=" + str(chunkSize) +
+                    " of the saved scenarios"
+                )
+                self.chunkSize = chunkSize
+        else:
+            with open(headerFile, 'w') as f:
+                json.dump(
+                    dict(header, chunkSize=int(self.chunkSize)), f, indent=1
+                )
+
+            np.save(os.path.join(self.path, 'rxLocs.npy'), rxLocs)
+
+        nChunks = int(np.ceil(nScenarios / self.chunkSize))
+        chunks = [
+            chunk for chunk in range(nChunks)
+            if not self.chunkComplete(chunk, nScenarios)
+        ]
+
+        args = [(self, rxLocs, nScenarios, chunk) for chunk in chunks]
+
+        if self.n_workers > 1 and len(chunks) > 1:
+            with Pool(int(np.min([self.n_workers, len(chunks)]))) as pool:
+                for chunk in pool.imap_unordered(_runScenarioChunk, args):
+                    print("Saved chunk " + str(chunk + 1) + "/" + str(nChunks))
+        else:
+            for arg in args:
+                chunk = _runScenarioChunk(arg)
+                print("Saved chunk " + str(chunk + 1) + "/" + str(nChunks))
+
+        return chunks
+
+    def load(self):
+        """
+            Load the scenarios saved in path
+
+            OUTPUT
+            :param array: index, indices of the scenarios
+            :param array: params, nS x nB x 12 parameters of the blocks
+                          listed in Mag.prismParameters
+            :param array: data, nS x nD data of the scenarios
+            :param array: rxLocs, nD x 3 array of observation locations
+        """
+
+        files = sorted([
+            fileName for fileName in os.listdir(self.path)
+            if re.match(r'scenarios_\d+\.npz$', fileName)
+        ])
+
+        index, params, data = [], [], []
+        for fileName in files:
+            with np.load(os.path.join(self.path, fileName)) as chunk:
+                index.append(chunk['index'])
+                params.append(chunk['params'])
+                data.append(chunk['data'])
+
+        rxLocs = np.load(os.path.join(self.path, 'rxLocs.npy'))
+
+        return (
+            np.concatenate(index), np.concatenate(params),
+            np.concatenate(data), rxLocs
+        )
+
+
+def _runScenarioChunk(args):
+    """
+        Compute and save a chunk of scenarios of a ScenarioRunner
+    """
+
+    runner, rxLocs, nScenarios, chunk = args
+
+    index = runner.chunkIndex(chunk, nScenarios)
+
+    params = np.stack([
+        runner.prismParameters(rxLocs, *runner.sample(ii)) for ii in index
+    ])
+
+    # Fields of all the blocks of the chunk at once, summed per scenario
+    u = Mag.prismResponse(
+        rxLocs, params.reshape((-1, params.shape[2])),
+        srcFieldParam=np.asarray(runner.EarthField, dtype=float),
+        uType=runner.uType, blockSize=runner.blockSize
+    )
+    data = u.reshape((len(index), params.shape[1], -1)).sum(axis=1)
+
+    # Written under a temporary name so that interrupted chunks are redone
+    tempFile = runner.chunkFile(chunk)[:-4] + '.tmp.npz'
+    np.savez(tempFile, index=index, params=params, data=data)
+    os.replace(tempFile, runner.chunkFile(chunk))
+
+    return chunk
+
+
 def meshBuilder(xyz, h, padDist, meshGlobal=None,
                 expFact=1.3,
                 meshType='TENSOR',
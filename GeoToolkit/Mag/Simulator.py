@@ -503,7 +503,7 @@ def fitline(prism, survey):
                     susc, comp, irt, Q, rinc, rdec, update):
 
         # Get the line extent from the 2D survey for now
-        prob = Mag.problem()
+        prob = Mag.Problem()
         prob.prism = prism.result
 
         xyzLoc = survey.rxLoc.copy()
@@ -513,8 +513,8 @@ def fitline(prism, survey):
         # srcField = PF.BaseMag.SrcField([rxLoc], param=[Bigrf, Binc, Bdec])
         # survey2D = PF.BaseMag.LinearSurvey(srcField)
 
-        survey2D = Mag.Survey(np.c_[Bigrf, Binc, Bdec])
-        survey2D._rxLoc = xyz
+        survey2D = Mag.Survey(np.r_[Bigrf, Binc, Bdec])
+        survey2D._rxLoc = xyzLoc
 
         survey2D._dobs = survey.dobs
         prob.survey = survey2D
@@ -530,12 +530,7 @@ def fitline(prism, survey):
         for b in fields:
             dpred += (b + Bigrf)
 
-        a = np.r_[xyzLoc[:, 0].min(), 0]
-        b = np.r_[xyzLoc[:, 0].max(), 0]
-        return plotProfile2D(
-                  xyzLoc, [survey2D.dobs, dpred], a, b, 10,
-                  dType='2D', ylabel='nT',
-                )
+        return plotLineProfile(xyzLoc, [survey2D.dobs, dpred], ylabel='nT')
 
     Q = widgets.interactive(
         profiledata, Binc=widgets.FloatSlider(min=-90., max=90, step=5, value=90, continuous_update=False),
@@ -553,6 +548,80 @@ def fitline(prism, survey):
     return Q
 
 
+def fitPrismLine(
+    prism, survey, susc=1., Q=0., rinc=0., rdec=0.,
+    active=['x0', 'y0', 'z0', 'susc'], uType='tf', **kwargs
+):
+    """
+        Least-squares fit of a prism to the data of a survey, starting
+        from the current geometry of the prism. The prism is updated with
+        the fitted geometry, and the observed and predicted data are
+        plotted along the survey.
+
+        INPUT
+        :param object: prism, definePrism used as starting model
+        :param object: survey, Mag.Survey with observed data
+        :param float: susc, Q, rinc, rdec, starting magnetization
+        :param list: active, names in Mag.prismParameters to fit
+        :param string: uType, component of the data
+        :param kwargs: other options of Mag.fitPrisms
+
+        OUTPUT
+        :param array: params, fitted values of Mag.prismParameters
+        :param dict: stats, convergence of the fit
+    """
+
+    params0 = np.r_[
+        [getattr(prism, name) for name in Mag.prismParameters[:8]],
+        susc, Q, rinc, rdec
+    ]
+
+    params, stats = Mag.fitPrisms(
+        survey.rxLoc, survey.dobs, params0, active=active,
+        std=survey.std, srcFieldParam=survey.srcFieldParam, uType=uType,
+        **kwargs
+    )
+
+    for name, val in zip(Mag.prismParameters[:8], params[0, :8]):
+        setattr(prism, name, val)
+
+    dpred = Mag.prismResponse(
+        survey.rxLoc, params, srcFieldParam=survey.srcFieldParam,
+        uType=uType
+    )[0]
+
+    plotLineProfile(survey.rxLoc, [survey.dobs, dpred], ylabel='nT')
+
+    return params[0], stats
+
+
+def plotLineProfile(xyzLoc, data, ax=None, plotStr=['b', 'r'],
+                    ylabel='Data', linewidth=0.5):
+    """
+        Plot the data of a line survey against the distance from its first
+        station. Unlike plotProfile2D, the stations need not span an area
+    """
+
+    if ax is None:
+        plt.figure(figsize=(6, 4))
+        ax = plt.subplot()
+
+    distance = np.r_[
+        0., np.cumsum(np.linalg.norm(np.diff(xyzLoc[:, :2], axis=0), axis=1))
+    ]
+
+    if not isinstance(data, list):
+        data = [data]
+
+    for ii, d in enumerate(data):
+        ax.plot(distance, d, plotStr[ii], linewidth=linewidth)
+
+    ax.set_xlabel('Distance (m)')
+    ax.set_ylabel(ylabel)
+    ax.grid(True)
+    return ax
+
+
 class MidPointNorm(Normalize):
     """
       Color range normalization based on a mid-point
@@ -630,7 +699,7 @@ def plotDataHillside(x, y, z, axs=None, fill=True, contours=None,
                      clabel=True, cmap='Spectral_r', ve=1., alpha=0.5, alphaHS=0.5,
                      distMax=1000, midpoint=None, azdeg=315, altdeg=45,
                      equalizeHist='HistEqualized', minCurvature=True,
-                     scatterData=None, shapeFile=None):
+                     scatterData=None, shapeFile=None, n_workers=1):
 
     ls = LightSource(azdeg=azdeg, altdeg=altdeg)
 
@@ -643,6 +712,7 @@ def plotDataHillside(x, y, z, axs=None, fill=True, contours=None,
                 vectorX=None, vectorY=None, vectorZ=None,
                 gridSize=resolution,
                 tol=1e-5, iterMax=None, method='spline',
+                n_workers=n_workers,
             )
             X = gridCC[:, 0].reshape(d_grid.shape, order='F')
             Y = gridCC[:, 1].reshape(d_grid.shape, order='F')
@@ -1847,8 +1917,16 @@ def dataGriddingWidget(
     survey, EPSGcode=np.nan, saveAs="Output/MyGeoTiff", marker=True,
     shapeFile=None, inc=np.nan, dec=np.nan, dataColumn=-1, overlap=0,
     Method='minimumCurvature', Contours=None, omit=[], units="TMI",
-    dpi=200, resolution=25, maxDistance=200, nPoints=5,
+    dpi=200, resolution=25, maxDistance=200, nPoints=5, tension=0.25,
+    n_workers=1,
 ):
+    """
+        Small application to grid scattered data and export to GeoTiff
+
+        :param n_workers: int n_workers=1 [Default] Number of processes
+                          sharing the tiles of the 'minimumCurvatureSpline'
+                          Method. The other Methods run in a single process
+    """
 
     def plotWidget(
             Resolution, MaxDistance, Method,
@@ -1858,10 +1936,18 @@ def dataGriddingWidget(
          ):
 
         if Method == 'minimumCurvature':
+            gridCC, d_grid = MathUtils.minCurvatureInterp(
+                np.c_[xLoc, yLoc], data, maxDistance=MaxDistance,
+                gridSize=Resolution, method='relaxation', tension=tension,
+                )
+            X = gridCC[:, 0].reshape(d_grid.shape, order='F')
+            Y = gridCC[:, 1].reshape(d_grid.shape, order='F')
+
+        elif Method == 'minimumCurvatureSpline':
             gridCC, d_grid = MathUtils.minCurvatureInterp(
                 np.c_[xLoc, yLoc], data, maxDistance=MaxDistance,
                 gridSize=Resolution, method='spline', overlap=overlap,
-                nPoints=nPoints,
+                nPoints=nPoints, n_workers=n_workers,
                 )
             X = gridCC[:, 0].reshape(d_grid.shape, order='F')
             Y = gridCC[:, 1].reshape(d_grid.shape, order='F')
@@ -1987,7 +2073,7 @@ def dataGriddingWidget(
     Method = widgets.Dropdown(
         options=[
           'nearest', 'linear', 'cubic',
-          'minimumCurvature'
+          'minimumCurvature', 'minimumCurvatureSpline'
           ],
         value=Method,
         description='Method',
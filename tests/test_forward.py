@@ -0,0 +1,980 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+from GeoToolkit.Mag import Mag
+from GeoToolkit.Mag import MathUtils
+from GeoToolkit.Mag import ProblemSetter
+from GeoToolkit.Mag import Simulator
+
+
+class KernelBackend_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        np.random.seed(0)
+
+        # Cells of a small tensor mesh below a grid of receivers
+        xn = np.linspace(-100, 100, 5)
+        yn = np.linspace(-50, 50, 4)
+        zn = np.linspace(-200, -20, 3)
+
+        yn2, xn2, zn2 = np.meshgrid(yn[1:], xn[1:], zn[1:])
+        yn1, xn1, zn1 = np.meshgrid(yn[0:-1], xn[0:-1], zn[0:-1])
+
+        self.Xn = np.c_[xn1.flatten(), xn2.flatten()]
+        self.Yn = np.c_[yn1.flatten(), yn2.flatten()]
+        self.Zn = np.c_[zn1.flatten(), zn2.flatten()]
+
+        self.rxLoc = np.c_[
+            np.random.randn(50, 2) * 150., np.random.rand(50) * 20.
+        ]
+
+    def assertSameTensor(self, T, Tref):
+        for t, tref in zip(T, Tref):
+            self.assertTrue(
+                np.allclose(t, tref, rtol=1e-8, atol=1e-10 * np.abs(tref).max())
+            )
+
+    def test_calcRow_rows(self):
+
+        Tref = Mag.calcRows(
+            self.Xn, self.Yn, self.Zn, self.rxLoc, backend='numpy'
+        )
+
+        for ii in range(self.rxLoc.shape[0]):
+            T = Mag.calcRow(self.Xn, self.Yn, self.Zn, self.rxLoc[ii, :])
+            self.assertSameTensor(T, [tref[ii:ii+1, :] for tref in Tref])
+
+    def test_loop_numpy(self):
+
+        Tref = Mag.calcRows(
+            self.Xn, self.Yn, self.Zn, self.rxLoc, backend='numpy'
+        )
+
+        nC = self.Xn.shape[0]
+        T = [np.empty((self.rxLoc.shape[0], 3*nC)) for ii in range(3)]
+        Mag.calcRowsLoop(self.Xn, self.Yn, self.Zn, self.rxLoc, *T)
+
+        self.assertSameTensor(T, Tref)
+
+    def test_blocked_baseline(self):
+
+        xn = np.linspace(-100, 100, 5)
+        yn = np.linspace(-50, 50, 4)
+        zn = np.linspace(-200, -20, 3)
+
+        G = Mag.Intrgl_Fwr_Op(
+            xn, yn, zn, self.rxLoc, blockSize=7, cellBlockSize=5
+        )
+
+        # Baseline loop over the receivers, with the per-cell kernel
+        nC, nD = self.Xn.shape[0], self.rxLoc.shape[0]
+        Gref = np.zeros((3*nD, 3*nC))
+        for ii in range(nD):
+            T = [np.zeros((1, 3*nC)) for jj in range(3)]
+            Mag.calcRowsLoop(
+                self.Xn, self.Yn, self.Zn, self.rxLoc[ii:ii+1, :], *T
+            )
+            for jj in range(3):
+                Gref[ii + jj*nD, :] = T[jj] / 1e-9 * Mag.mu_0
+
+        self.assertTrue(
+            np.allclose(G, Gref, rtol=1e-8, atol=1e-10 * np.abs(Gref).max())
+        )
+
+    def test_numba_numpy(self):
+
+        if Mag.njit is None:
+            self.skipTest("numba not installed")
+
+        Tref = Mag.calcRows(
+            self.Xn, self.Yn, self.Zn, self.rxLoc, backend='numpy'
+        )
+        T = Mag.calcRows(
+            self.Xn, self.Yn, self.Zn, self.rxLoc, backend='numba'
+        )
+
+        self.assertSameTensor(T, Tref)
+
+
+class IntegralOperator_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        np.random.seed(0)
+
+        self.xn = np.linspace(-100, 100, 6)
+        self.yn = np.linspace(-80, 80, 5)
+        self.zn = np.linspace(-150, -10, 4)
+
+        self.rxLoc = np.c_[
+            np.random.randn(40, 2) * 150., np.random.rand(40) * 20.
+        ]
+
+    def test_cells_superposition(self):
+
+        G = Mag.Intrgl_Fwr_Op(
+            self.xn, self.yn, self.zn, self.rxLoc, blockSize=15,
+            cellBlockSize=7
+        )
+
+        nC = G.shape[1] // 3
+        self.assertEqual(G.shape, (120, 3 * 60))
+
+        # Uniform magnetization of all cells is a single large prism
+        M = np.r_[1., 2., -0.5]
+        Gp = Mag.Intrgl_Fwr_Op(
+            self.xn[[0, -1]], self.yn[[0, -1]], self.zn[[0, -1]], self.rxLoc
+        )
+
+        self.assertTrue(
+            np.allclose(G.dot(np.kron(M, np.ones(nC))), Gp.dot(M))
+        )
+
+    def test_workers(self):
+
+        G = Mag.Intrgl_Fwr_Op(
+            self.xn, self.yn, self.zn, self.rxLoc, blockSize=7
+        )
+        Gpool = Mag.Intrgl_Fwr_Op(
+            self.xn, self.yn, self.zn, self.rxLoc, blockSize=7, n_workers=2
+        )
+
+        # Each block fills its own rows of the shared array
+        self.assertTrue(np.array_equal(G, Gpool))
+
+    def test_matrix_free(self):
+
+        G = Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, self.rxLoc)
+        Gop = Mag.ForwardOperator(
+            self.xn, self.yn, self.zn, self.rxLoc, blockSize=15
+        )
+
+        self.assertEqual(Gop.shape, G.shape)
+
+        m = np.random.randn(G.shape[1])
+        d = np.random.randn(G.shape[0])
+        self.assertTrue(np.allclose(Gop.dot(m), G.dot(m)))
+        self.assertTrue(np.allclose(Gop.T.dot(d), G.T.dot(d)))
+        self.assertTrue(np.allclose(Gop.rmatvec(d), G.T.dot(d)))
+
+    def test_operatorCache(self):
+
+        key = Mag.geometryKey(self.xn, self.yn, self.zn, self.rxLoc)
+        G = Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, self.rxLoc)
+
+        # Room for two operators
+        cache = Mag.OperatorCache(maxBytes=2.5 * G.nbytes)
+
+        def builder(rxLoc):
+            return lambda: Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, rxLoc)
+
+        G1 = cache.get(key, builder(self.rxLoc))
+        self.assertTrue(np.array_equal(G1, G))
+        self.assertIs(cache.get(key, builder(self.rxLoc)), G1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertFalse(G1.flags.writeable)
+
+        # Same geometry, same key. Moved receivers, new key
+        self.assertEqual(
+            Mag.geometryKey(self.xn, self.yn, self.zn, self.rxLoc.copy()), key
+        )
+        rxLoc2, rxLoc3 = self.rxLoc + [0., 0., 1.], self.rxLoc + [0., 1., 0.]
+        key2 = Mag.geometryKey(self.xn, self.yn, self.zn, rxLoc2)
+        key3 = Mag.geometryKey(self.xn, self.yn, self.zn, rxLoc3)
+        self.assertEqual(len(set([key, key2, key3])), 3)
+        self.assertNotEqual(
+            Mag.geometryKey(self.xn, self.yn, self.zn + 1., self.rxLoc), key
+        )
+
+        # The least recently used operator is dropped
+        cache.get(key2, builder(rxLoc2))
+        cache.get(key, builder(self.rxLoc))
+        cache.get(key3, builder(rxLoc3))
+
+        self.assertEqual(list(cache.operators), [key, key3])
+        self.assertLessEqual(cache.nbytes, cache.maxBytes)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+    def test_ind_full(self):
+
+        srcFieldParam = np.r_[51000, 60, 15]
+
+        G = Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, self.rxLoc)
+        Gtmi = Mag.Intrgl_Fwr_Op(
+            self.xn, self.yn, self.zn, self.rxLoc, flag='ind',
+            srcFieldParam=srcFieldParam, cellBlockSize=13
+        )
+
+        nC = Gtmi.shape[1]
+        model = np.random.rand(nC)
+
+        # Induced magnetization and projection on the inducing field
+        Ptmi = MathUtils.dipazm_2_xyz(srcFieldParam[1], srcFieldParam[2])
+        M = srcFieldParam[0] * 1e-9 / Mag.mu_0 * Ptmi
+
+        b = G.dot(np.kron(M, model)).reshape((3, -1))
+
+        self.assertTrue(np.allclose(Gtmi.dot(model), Ptmi.dot(b)))
+
+    def test_gradient(self):
+
+        G = Mag.Intrgl_Fwr_Op(
+            self.xn, self.yn, self.zn, self.rxLoc, gradient=True
+        )
+        self.assertEqual(G.shape, (9 * 40, 3 * 60))
+
+        m = np.random.randn(G.shape[1])
+        grad = G.dot(m)[3 * 40:].reshape((6, 40))
+
+        # Centered finite differences of the fields rows
+        h = 1e-2
+        dbdx = []
+        for axis in range(3):
+            dx = np.eye(3)[axis] * h
+            bp = Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, self.rxLoc + dx)
+            bm = Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, self.rxLoc - dx)
+            dbdx += [(bp.dot(m) - bm.dot(m)).reshape((3, 40)) / (2. * h)]
+
+        for grad_ij, (ii, jj) in zip(
+            grad, [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+        ):
+            self.assertTrue(np.allclose(
+                grad_ij, dbdx[jj][ii], rtol=0., atol=1e-5 * np.abs(grad_ij).max()
+            ))
+
+    def test_gradient_tensor(self):
+
+        prism = Simulator.definePrism()
+        prism.x0, prism.y0, prism.z0 = 10., -20., -80.
+        prism.dx, prism.dy, prism.dz = 60., 40., 50.
+        prism.pinc, prism.pdec = 20., 35.
+
+        survey = Mag.createMagSurvey(self.rxLoc, EarthField=[50000, 60, 10])
+        prob = Mag.Problem(
+            prism=prism, survey=survey, susc=0.05, Q=0.5, rinc=-30.,
+            rdec=45., gradient=True, useCache=False
+        )
+
+        fields = prob.fieldsAll()['total']
+        T = np.array([
+            [fields['b' + ii + jj] if ii <= jj else fields['b' + jj + ii]
+             for jj in 'xyz'] for ii in 'xyz'
+        ])
+        scale = np.abs(T).max()
+
+        # Divergence free and curl free fields
+        self.assertTrue(np.all(np.abs(np.trace(T)) < 1e-8 * scale))
+
+        # Symmetry, from the derivatives of the rotated fields
+        h = 1e-2
+        dbdx = []
+        for axis in range(3):
+            dx = np.eye(3)[axis] * h
+            bp = Mag.Problem(
+                prism=prism, susc=0.05, Q=0.5, rinc=-30., rdec=45.,
+                survey=Mag.createMagSurvey(
+                    self.rxLoc + dx, EarthField=[50000, 60, 10]
+                ), useCache=False
+            ).fieldsAll()['total']
+            bm = Mag.Problem(
+                prism=prism, susc=0.05, Q=0.5, rinc=-30., rdec=45.,
+                survey=Mag.createMagSurvey(
+                    self.rxLoc - dx, EarthField=[50000, 60, 10]
+                ), useCache=False
+            ).fieldsAll()['total']
+            dbdx += [[
+                (bp['b' + comp] - bm['b' + comp]) / (2. * h)
+                for comp in 'xyz'
+            ]]
+
+        for ii in range(3):
+            for jj in range(3):
+                self.assertTrue(np.allclose(
+                    dbdx[jj][ii], T[ii, jj], rtol=0., atol=1e-5 * scale
+                ))
+                self.assertTrue(np.allclose(
+                    dbdx[ii][jj], T[ii, jj], rtol=0., atol=1e-5 * scale
+                ))
+
+    def test_compressed(self):
+
+        xn = np.linspace(-200, 200, 17)
+        G = Mag.Intrgl_Fwr_Op(xn, xn, self.zn, self.rxLoc)
+        Gw = Mag.CompressedOperator(
+            xn, xn, self.zn, self.rxLoc, tol=1e-3, blockSize=15
+        )
+
+        self.assertEqual(Gw.shape, G.shape)
+
+        # Rows of the operator within the tolerance
+        rows = Gw.T.dot(np.eye(G.shape[0])).T
+        err = np.linalg.norm(rows - G, axis=1) / np.linalg.norm(G, axis=1)
+        self.assertTrue(np.all(err <= 1e-3 * (1. + 1e-8)))
+
+        m = np.random.randn(G.shape[1])
+        d = np.random.randn(G.shape[0])
+        self.assertTrue(np.allclose(d.dot(Gw.dot(m)), m.dot(Gw.T.dot(d))))
+
+    def test_compressed_ratio(self):
+
+        xn = np.linspace(-400, 400, 33)
+        zn = np.linspace(-200, 0, 9)
+        G = Mag.Intrgl_Fwr_Op(xn, xn, zn, self.rxLoc)
+        Gw = Mag.CompressedOperator(xn, xn, zn, self.rxLoc)
+
+        # Memory saved at the default tolerance
+        self.assertEqual(Gw.tol, 1e-2)
+        self.assertTrue(Gw.compression > 5.)
+
+        rows = Gw.T.dot(np.eye(G.shape[0])).T
+        err = np.linalg.norm(rows - G, axis=1) / np.linalg.norm(G, axis=1)
+        self.assertTrue(np.all(err <= 1e-2 * (1. + 1e-8)))
+
+    def test_adaptive(self):
+
+        xn = np.linspace(-400, 400, 33)
+        G = Mag.Intrgl_Fwr_Op(xn, xn, self.zn, self.rxLoc)
+
+        M = np.random.rand(G.shape[1] // 3, 3)
+        bvec = G.dot(M.flatten(order='F')).reshape((3, -1)).T
+
+        b, nEval = Mag.adaptiveFields(xn, xn, self.zn, self.rxLoc, M, theta=0.)
+        self.assertTrue(np.allclose(b, bvec))
+
+        b, nEval = Mag.adaptiveFields(
+            xn, xn, self.zn, self.rxLoc, M, theta=0.3, blockSize=15
+        )
+        self.assertTrue(np.abs(b - bvec).max() < 1e-3 * np.abs(bvec).max())
+        self.assertTrue(np.all(nEval < M.shape[0]))
+
+    def test_adaptive_cancel(self):
+
+        xn = np.linspace(-80, 80, 9)
+        zn = np.r_[-60., -40., -20.]
+
+        # Opposite magnetizations in two cells of the same block
+        M = np.zeros((8 * 8 * 2, 3))
+        M[0, 2], M[1, 2] = 1., -1.
+
+        G = Mag.Intrgl_Fwr_Op(xn, xn, zn, self.rxLoc)
+        bvec = G.dot(M.flatten(order='F')).reshape((3, -1)).T
+
+        b, nEval = Mag.adaptiveFields(xn, xn, zn, self.rxLoc, M, theta=0.)
+        self.assertTrue(np.allclose(b, bvec))
+        self.assertTrue(np.all(nEval == 2))
+
+    def test_fft(self):
+
+        xn = np.linspace(-200, 200, 17)
+        hx = np.arange(-260., 280., 25.) + 3.
+        hy = np.arange(-230., 200., 25.) - 7.
+
+        M = np.random.randn(16 * 16 * 3, 3)
+        u = Mag.fftFields(xn, xn, self.zn, M, hx, hy, z=15., uType='bz')
+
+        X, Y = np.meshgrid(hx, hy)
+        rxLoc = np.c_[X.flatten(), Y.flatten(), np.ones(X.size) * 15.]
+        G = Mag.Intrgl_Fwr_Op(xn, xn, self.zn, rxLoc)
+        bz = G.dot(M.flatten(order='F')).reshape((3, -1))[2]
+
+        self.assertEqual(u.shape, X.shape)
+        self.assertTrue(np.allclose(u.flatten(), bz))
+
+    def test_store(self):
+
+        G = Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, self.rxLoc)
+
+        with tempfile.TemporaryDirectory() as path:
+
+            store = Mag.SensitivityStore(path=path, chunkSize=15)
+            Gs = store.operator(self.xn, self.yn, self.zn, self.rxLoc)
+
+            m = np.random.randn(G.shape[1])
+            self.assertTrue(np.allclose(Gs.dot(m), G.dot(m)))
+            self.assertEqual((store.hits, store.misses), (0, 3))
+
+            # Only the chunk of the moved receiver is computed again
+            rxLoc = self.rxLoc.copy()
+            rxLoc[20, 2] += 1.
+            Gs = store.operator(self.xn, self.yn, self.zn, rxLoc)
+            self.assertEqual((store.hits, store.misses), (2, 4))
+
+            G = Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, rxLoc)
+            self.assertTrue(np.allclose(Gs.dot(m), G.dot(m)))
+
+            store.clear()
+
+    def test_store_reset(self):
+
+        G = Mag.Intrgl_Fwr_Op(self.xn, self.yn, self.zn, self.rxLoc)
+        m = np.random.randn(G.shape[1])
+
+        with tempfile.TemporaryDirectory() as path:
+
+            # Nothing to delete in a new store
+            store = Mag.SensitivityStore(
+                path=os.path.join(path, 'store'), chunkSize=15
+            )
+            store.clear()
+
+            store.operator(self.xn, self.yn, self.zn, self.rxLoc)
+            folder = os.path.join(store.path, os.listdir(store.path)[0])
+
+            with open(os.path.join(folder, 'header.json'), 'w') as f:
+                f.write('{"chunks": ')
+
+            # A corrupted header rebuilds the operator
+            with self.assertWarns(UserWarning):
+                Gs = store.operator(self.xn, self.yn, self.zn, self.rxLoc)
+
+            self.assertEqual((store.hits, store.misses), (0, 6))
+            self.assertEqual(len(os.listdir(folder)), 4)
+            self.assertTrue(np.allclose(Gs.dot(m), G.dot(m)))
+
+            store.clear()
+            self.assertEqual(os.listdir(store.path), [])
+            store.clear()
+
+    def test_store_shared(self):
+
+        xn = np.linspace(-200, 200, 9)
+        M = np.random.randn(8 * 8 * 3, 3)
+
+        G = Mag.Intrgl_Fwr_Op(xn, xn, self.zn, self.rxLoc)
+        b = G.dot(M.flatten(order='F')).reshape((3, -1)).T
+
+        with tempfile.TemporaryDirectory() as path:
+
+            # Workers sharing a store small enough to evict chunks
+            store = Mag.SensitivityStore(path=path, chunkSize=5, maxBytes=1e+5)
+
+            for ii in range(2):
+                bt = Mag.tiledFields(
+                    xn, xn, self.zn, M, self.rxLoc, maxNpoints=10,
+                    expFact=1., n_workers=2, store=store
+                )
+                self.assertTrue(np.allclose(bt, b))
+
+            # Headers only list chunks found on disk
+            entries = store.entries()
+            self.assertTrue(len(entries) > 0)
+            for folder, name, entry in entries:
+                self.assertEqual(
+                    os.path.getsize(os.path.join(folder, name + '.npy')),
+                    entry['nbytes']
+                )
+            self.assertFalse(os.path.exists(os.path.join(path, '.lock')))
+
+            store.clear()
+
+    def test_variable_field(self):
+
+        field = [
+            50000. + np.random.randn(40) * 1000., 60. + np.random.randn(40),
+            np.random.randn(40) * 10.
+        ]
+
+        G = Mag.Intrgl_Fwr_Op(
+            self.xn, self.yn, self.zn, self.rxLoc, flag='ind',
+            srcFieldParam=field
+        )
+
+        # Same rows as one survey per receiver
+        for ii in range(0, 40, 13):
+            g = Mag.Intrgl_Fwr_Op(
+                self.xn, self.yn, self.zn, self.rxLoc[ii:ii+1, :], flag='ind',
+                srcFieldParam=np.r_[field[0][ii], field[1][ii], field[2][ii]]
+            )
+            self.assertTrue(np.allclose(G[ii, :], g[0, :]))
+
+            u = Mag.prismFields(
+                self.rxLoc[ii:ii+1, :], [[10., 0., -50.]], [[40., 50., 60.]],
+                susc=0.1, Q=0.5, rinc=20.,
+                srcFieldParam=np.r_[field[0][ii], field[1][ii], field[2][ii]]
+            )
+            self.assertTrue(np.allclose(
+                Mag.prismFields(
+                    self.rxLoc, [[10., 0., -50.]], [[40., 50., 60.]],
+                    susc=0.1, Q=0.5, rinc=20., srcFieldParam=field
+                )[ii], u
+            ))
+
+    def test_tiled(self):
+
+        xn = np.linspace(-200, 200, 17)
+        M = np.random.randn(16 * 16 * 3, 3)
+
+        G = Mag.Intrgl_Fwr_Op(xn, xn, self.zn, self.rxLoc)
+        b = G.dot(M.flatten(order='F')).reshape((3, -1)).T
+
+        # Without expansion the local meshes hold all the global cells
+        bt = Mag.tiledFields(
+            xn, xn, self.zn, M, self.rxLoc, maxNpoints=10, expFact=1.
+        )
+        self.assertTrue(np.allclose(bt, b))
+
+        bt = Mag.tiledFields(
+            xn, xn, self.zn, M, self.rxLoc, maxNpoints=10, overlap=50.,
+            n_workers=2
+        )
+        self.assertLess(np.abs(bt - b).max() / np.abs(b).max(), 5e-2)
+
+        # Overlaps not recovered exactly from the padded tile limits
+        for overlap in [0.1, 33.3, 64.1, 66.6]:
+            bt = Mag.tiledFields(
+                xn, xn, self.zn, M, self.rxLoc, maxNpoints=10, expFact=1.,
+                overlap=overlap
+            )
+            self.assertTrue(np.allclose(bt, b))
+
+
+class Problem_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        np.random.seed(0)
+
+        rxLoc = np.c_[np.random.randn(30, 2) * 200., np.ones(30) * 10.]
+        self.survey = Mag.createMagSurvey(rxLoc, EarthField=[52000, 65, 12])
+
+        self.prism = Simulator.definePrism()
+        self.prism.x0, self.prism.y0, self.prism.z0 = 20., -10., -40.
+        self.prism.dx, self.prism.dy, self.prism.dz = 80., 50., 60.
+        self.prism.pinc, self.prism.pdec = 15., 30.
+
+    def problem(self, **kwargs):
+        return Mag.Problem(
+            prism=self.prism, survey=self.survey, useCache=False, **kwargs
+        )
+
+    def test_fieldsBatch(self):
+
+        susc = np.r_[0.01, 0.05, 0.1]
+        Q = np.r_[0., 0.5, 2.]
+        rinc, rdec = np.r_[10., -45., 80.], np.r_[0., 90., -30.]
+
+        for uType in ['tf', 'bx', 'bz']:
+
+            u = self.problem(mType='total', uType=uType).fieldsBatch(
+                susc=susc, Q=Q, rinc=rinc, rdec=rdec
+            )
+            self.assertEqual(u.shape, (3, 30))
+
+            for ii in range(3):
+                prob = self.problem(
+                    mType='total', uType=uType, susc=susc[ii], Q=Q[ii],
+                    rinc=rinc[ii], rdec=rdec[ii]
+                )
+                self.assertTrue(
+                    np.allclose(u[ii], np.sum(prob.fields(), axis=0))
+                )
+
+    def test_fieldsAll(self):
+
+        options = {'susc': 0.05, 'Q': 0.8, 'rinc': -20., 'rdec': 60.}
+        fields = self.problem(**options).fieldsAll()
+
+        for mType in ['induced', 'remanent', 'total']:
+            for uType in ['tf', 'bx', 'by', 'bz']:
+
+                u = self.problem(mType=mType, uType=uType, **options).fields()
+                self.assertTrue(
+                    np.allclose(fields[mType][uType], np.sum(u, axis=0))
+                )
+
+
+    def test_prismFields(self):
+
+        params = np.c_[
+            np.random.randn(4, 2) * 100., -np.random.rand(4) * 50. - 20.,
+            np.random.rand(4, 3) * 60. + 20., np.random.randn(4, 2) * 30.,
+            np.random.rand(4) * 0.1, np.random.rand(4), np.random.randn(4, 2) * 40.
+        ]
+
+        for uType in ['tf', 'bx', 'by', 'bz']:
+
+            u = 0.
+            for param in params:
+                prism = Simulator.definePrism()
+                prism.x0, prism.y0, prism.z0 = param[:3]
+                prism.dx, prism.dy, prism.dz = param[3:6]
+                prism.pinc, prism.pdec = param[6:8]
+
+                prob = Mag.Problem(
+                    prism=prism, survey=self.survey, mType='total',
+                    uType=uType, susc=param[8], Q=param[9], rinc=param[10],
+                    rdec=param[11], useCache=False
+                )
+                u += np.sum(prob.fields(), axis=0)
+
+            # Prisms defined by their centers
+            centers = params[:, :3] - np.c_[0., 0., 0.5] * params[:, 5:6]
+
+            uPrisms = Mag.prismFields(
+                self.survey.rxLoc, centers, params[:, 3:6],
+                pinc=params[:, 6], pdec=params[:, 7], susc=params[:, 8],
+                Q=params[:, 9], rinc=params[:, 10], rdec=params[:, 11],
+                srcFieldParam=self.survey.srcFieldParam, uType=uType,
+                blockSize=50
+            )
+
+            self.assertTrue(np.allclose(uPrisms, u))
+
+
+class PrismFit_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        np.random.seed(0)
+
+        x = np.linspace(-500, 500, 81)
+        self.rxLoc = np.c_[x, np.zeros_like(x), np.ones_like(x) * 5.]
+        self.srcFieldParam = np.r_[52000, 65, 12]
+
+        # Anomalies of prisms at different positions, depths and
+        # susceptibilities
+        nA = 20
+        self.params = np.c_[
+            np.random.uniform(-100, 100, nA), np.zeros(nA),
+            np.random.uniform(-150, -30, nA), np.ones((nA, 3)) * 150.,
+            np.zeros((nA, 2)), np.random.uniform(0.01, 0.1, nA),
+            np.zeros((nA, 3))
+        ]
+
+    def test_jacobian(self):
+
+        J = Mag.prismJacobian(
+            self.rxLoc, self.params[:2], srcFieldParam=self.srcFieldParam
+        )
+
+        # Response is linear in the susceptibility
+        ind = Mag.prismParameters.index('susc')
+        u = Mag.prismResponse(
+            self.rxLoc, self.params[:2], srcFieldParam=self.srcFieldParam
+        )
+
+        self.assertTrue(
+            np.allclose(J[:, :, ind] * self.params[:2, ind:ind+1], u)
+        )
+
+    def test_far_field(self):
+
+        u = Mag.prismResponse(
+            self.rxLoc, self.params, srcFieldParam=self.srcFieldParam
+        )
+
+        Mag.kernelCounts.update(prism=0, dipole=0)
+        uFar = Mag.prismResponse(
+            self.rxLoc, self.params, srcFieldParam=self.srcFieldParam,
+            farRatio=2.
+        )
+
+        self.assertTrue(np.abs(uFar - u).max() < 1e-2 * np.abs(u).max())
+        self.assertEqual(
+            Mag.kernelCounts['prism'] + Mag.kernelCounts['dipole'], u.size
+        )
+        self.assertTrue(Mag.kernelCounts['dipole'] > 0)
+
+    def test_fit(self):
+
+        data = Mag.prismResponse(
+            self.rxLoc, self.params, srcFieldParam=self.srcFieldParam
+        )
+
+        params0 = self.params.copy()
+        params0[:, 0] += 30.
+        params0[:, 2] -= 20.
+        params0[:, 8] *= 2.
+
+        active = ['x0', 'z0', 'susc']
+        params, stats = Mag.fitPrisms(
+            self.rxLoc, data, params0, active=active,
+            srcFieldParam=self.srcFieldParam
+        )
+
+        self.assertTrue(np.all(stats['converged']))
+        self.assertTrue(np.all(stats['rms'] < 1e-3 * stats['rms0']))
+        self.assertTrue(np.allclose(params, self.params, rtol=1e-3, atol=0.1))
+
+    def test_zero_std(self):
+
+        data = Mag.prismResponse(
+            self.rxLoc, self.params[:3], srcFieldParam=self.srcFieldParam
+        )
+
+        params0 = self.params[:3].copy()
+        params0[:, 0] += 30.
+
+        params, stats = Mag.fitPrisms(
+            self.rxLoc, data, params0, active=['x0'], std=0.,
+            srcFieldParam=self.srcFieldParam
+        )
+
+        # Unit weights where no uncertainty is given
+        self.assertTrue(np.all(np.isfinite(stats['rms'])))
+        self.assertTrue(np.all(stats['converged']))
+        self.assertTrue(np.allclose(params, self.params[:3], atol=0.1))
+
+    def test_fitPrismLine(self):
+
+        data = Mag.prismResponse(
+            self.rxLoc, self.params[:1], srcFieldParam=self.srcFieldParam
+        )[0]
+
+        # Line survey without uncertainties, as read from a UBC file
+        survey = Mag.createMagSurvey(
+            self.rxLoc, EarthField=self.srcFieldParam, data=data
+        )
+        survey._std = np.zeros_like(data)
+
+        prism = Simulator.definePrism()
+        prism.x0, prism.y0, prism.z0 = self.params[0, :3] + [30., 0., -20.]
+        prism.dx, prism.dy, prism.dz = self.params[0, 3:6]
+        prism.pinc, prism.pdec = 0., 0.
+
+        params, stats = Simulator.fitPrismLine(
+            prism, survey, susc=self.params[0, 8] * 2.
+        )
+        Simulator.plt.close('all')
+
+        self.assertTrue(stats['converged'][0])
+        self.assertTrue(np.allclose(params, self.params[0], rtol=1e-3, atol=0.1))
+        self.assertAlmostEqual(prism.x0, self.params[0, 0], places=1)
+
+
+
+class Precision_Test(unittest.TestCase):
+    """
+        Accuracy of the single precision storage of the kernel, relative
+        to the amplitude of the fields at each receiver, on the blocks of
+        ProblemSetter.blockModel and on a small prism observed up to 10 km
+        away, where the corner sums of the kernel cancel.
+    """
+
+    def setUp(self):
+
+        x, y = np.meshgrid(
+            np.linspace(-5000, 5000, 51), np.linspace(-5000, 5000, 51)
+        )
+        dist = np.r_[200., 500., 1000., 3000., 6000., 10000.]
+        rxLoc = np.r_[
+            np.c_[x.flatten(), y.flatten(), np.zeros(x.size)],
+            np.c_[dist * 0.8, dist * 0.6, np.zeros(dist.size)]
+        ]
+
+        self.survey = Mag.createMagSurvey(rxLoc, EarthField=[50000, 60, 10])
+
+    def blockModelFields(self, uType, precision):
+
+        params, suscs = ProblemSetter.blockModel()
+
+        u = 0.
+        for param, susc in zip(params, suscs):
+
+            prism = Simulator.definePrism()
+            prism.x0, prism.y0, prism.z0 = param[0], param[1], param[2]
+            prism.dx, prism.dy, prism.dz = param[3], param[4], param[5]
+            prism.pdec, prism.pinc = param[6], param[7]
+
+            prob = Mag.Problem(
+                prism=prism, survey=self.survey, susc=susc, uType=uType,
+                precision=precision, useCache=False
+            )
+            u += np.sum(prob.fields(), axis=0)
+
+        return u
+
+    def test_blockModel(self):
+
+        u64 = {
+            uType: self.blockModelFields(uType, 'float64')
+            for uType in ['tf', 'bx', 'by', 'bz']
+        }
+        amplitude = (u64['bx']**2. + u64['by']**2. + u64['bz']**2.)**0.5
+
+        for uType in ['tf', 'bx', 'by', 'bz']:
+
+            u32 = self.blockModelFields(uType, 'float32')
+
+            self.assertTrue(
+                np.all(np.abs(u32 - u64[uType]) < 1e-6 * amplitude)
+            )
+
+    def test_farField(self):
+
+        # 100 m prism, observed from 200 m to 10 km
+        Xn, Yn, Zn = Mag.cellNodes(
+            np.r_[-50., 50.], np.r_[-50., 50.], np.r_[-150., -50.]
+        )
+        rxLoc = self.survey.rxLoc[-6:, :]
+
+        rows64 = Mag.calcRows(Xn, Yn, Zn, rxLoc)
+        rows32 = Mag.calcRows(Xn, Yn, Zn, rxLoc, precision='float32')
+
+        for T64, T32 in zip(rows64, rows32):
+
+            self.assertEqual(T32.dtype, np.float32)
+            self.assertTrue(np.all(
+                np.abs(T32 - T64).max(axis=1) <
+                1e-6 * np.abs(T64).max(axis=1)
+            ))
+
+
+class ScenarioRunner_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        x, y = np.meshgrid(
+            np.linspace(-2000, 2000, 11), np.linspace(-2000, 2000, 11)
+        )
+        self.rxLoc = np.c_[x.flatten(), y.flatten(), np.ones(x.size) * 100.]
+
+    def test_resume(self):
+
+        with tempfile.TemporaryDirectory() as path:
+
+            runner = ProblemSetter.ScenarioRunner(
+                path=path, chunkSize=4, n_workers=2, seed=1
+            )
+            self.assertEqual(runner.run(self.rxLoc, 10), [0, 1, 2])
+            self.assertEqual(runner.run(self.rxLoc, 10), [])
+
+            index, params, data, rxLoc = runner.load()
+            self.assertEqual(data.shape, (10, self.rxLoc.shape[0]))
+
+            # Scenarios are reproduced alone from their seed
+            prisms = runner.prismParameters(rxLoc, *runner.sample(5))
+            u = Mag.prismResponse(rxLoc, prisms).sum(axis=0)
+            self.assertTrue(np.allclose(u, data[5]))
+
+            # Only the missing chunk is computed again
+            os.remove(runner.chunkFile(1))
+            self.assertEqual(runner.run(self.rxLoc, 10), [1])
+            self.assertTrue(np.allclose(runner.load()[2], data))
+
+            # More scenarios complete the partial last chunk
+            runner = ProblemSetter.ScenarioRunner(path=path, seed=1)
+            self.assertEqual(runner.run(self.rxLoc, 14), [2, 3])
+            self.assertEqual(runner.chunkSize, 4)
+
+            index, params, data14, rxLoc = runner.load()
+            self.assertTrue(np.array_equal(index, np.arange(14)))
+            self.assertTrue(np.allclose(data14[:10], data))
+
+            # Other sampling settings cannot be mixed
+            runner = ProblemSetter.ScenarioRunner(path=path, seed=2)
+            self.assertRaises(AssertionError, runner.run, self.rxLoc, 14)
+
+
+
+class MinCurvature_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        np.random.seed(0)
+
+        self.xy = np.random.rand(500, 2) * [1000., 800.]
+        self.vectorX = np.arange(0., 1001., 10.)
+        self.vectorY = np.arange(0., 801., 20.)
+
+    def test_relaxation(self):
+
+        # Planes have no curvature
+        xy = np.round(self.xy / [10., 20.]) * [10., 20.]
+        data = 0.2 * xy[:, 0] - 0.1 * xy[:, 1] + 5.
+        grid = MathUtils.minCurvatureGrid(
+            self.vectorX, self.vectorY, xy, data, tension=0., tol=1e-10
+        )
+
+        X, Y = np.meshgrid(self.vectorX, self.vectorY)
+        self.assertTrue(np.allclose(grid, 0.2 * X - 0.1 * Y + 5.))
+
+        # Data snapped to the grid nodes are honored
+        data = np.sin(self.xy[:, 0] / 150.) * np.cos(self.xy[:, 1] / 200.)
+        gridCC, grid = MathUtils.minCurvatureInterp(
+            self.xy, data, vectorX=self.vectorX, vectorY=self.vectorY,
+            method='relaxation'
+        )
+
+        iy = np.round(self.xy[:, 1] / 20.).astype(int)
+        ix = np.round(self.xy[:, 0] / 10.).astype(int)
+
+        # Nodes with a single datum
+        count = np.bincount(iy * self.vectorX.shape[0] + ix)
+        ind = count[iy * self.vectorX.shape[0] + ix] == 1
+
+        self.assertTrue(np.allclose(grid[iy[ind], ix[ind]], data[ind]))
+
+
+    def test_splineEval(self):
+
+        xyOut = self.xy + [5e+5, 6e+6]
+        xyIn = np.random.rand(50, 2) * 1000. + [5e+5, 6e+6]
+        weights = np.random.randn(50)
+
+        r = np.sum((xyOut[:, None, :] - xyIn[None, :, :])**2., axis=2) + 1e-8
+        values = (r * (np.log(r**0.5) - 1.)).dot(weights)
+
+        self.assertTrue(np.allclose(
+            MathUtils.splineEval(xyOut, xyIn, weights, blockSize=1000),
+            values
+        ))
+
+    def test_splineSolve(self):
+
+        xy = np.random.rand(50, 2) * 1000.
+        data = np.random.randn(50)
+
+        MathUtils.splineCache.clear()
+        g = MathUtils.splineSolve(xy, data)
+        self.assertTrue(np.allclose(MathUtils.splineEval(xy, xy, g), data))
+
+        # Other data on the same locations reuse the factorization
+        MathUtils.splineSolve(xy.copy(), data * 2.)
+        self.assertEqual(MathUtils.splineCache.misses, 1)
+        self.assertEqual(MathUtils.splineCache.hits, 1)
+
+    def test_spline_workers(self):
+
+        xy = np.random.rand(2000, 2) * 1000.
+        data = np.sin(xy[:, 0] / 200.) * np.cos(xy[:, 1] / 300.)
+
+        _, grid = MathUtils.minCurvatureInterp(
+            xy, data, gridSize=20, overlap=50
+        )
+        _, gridPar = MathUtils.minCurvatureInterp(
+            xy, data, gridSize=20, overlap=50, n_workers=2
+        )
+
+        # Tiles blended in the same order, for identical sums
+        np.testing.assert_array_equal(grid, gridPar)
+
+    def test_tileSurveyPoints(self):
+
+        xy = np.r_[
+            np.random.rand(5000, 2) * [4000., 1000.],
+            np.random.randn(2000, 2) * 50. + 500.
+        ]
+        xy1, xy2 = MathUtils.tileSurveyPoints(xy, 300)
+
+        # Tiles partition the points, and cover the survey extent
+        count = [
+            np.sum(np.all((xy >= lim1) & (xy <= lim2), axis=1))
+            for lim1, lim2 in zip(xy1, xy2)
+        ]
+        self.assertLessEqual(np.max(count), 300)
+        self.assertEqual(np.sum(count), xy.shape[0])
+        self.assertAlmostEqual(
+            np.prod(xy2 - xy1, axis=1).sum(),
+            np.prod(xy.max(axis=0) - xy.min(axis=0))
+        )
+
+        xy1Over, xy2Over = MathUtils.tileSurveyPoints(xy, 300, overlap=[10, 20])
+        self.assertTrue(np.allclose(xy1Over, xy1 - [10, 20]))
+        self.assertTrue(np.allclose(xy2Over, xy2 + [10, 20]))
+
+
+if __name__ == '__main__':
+    unittest.main()